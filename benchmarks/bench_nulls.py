@@ -0,0 +1,69 @@
+"""
+Compares the old list-of-dicts null handling with the
+:class:`go_metrics.metrics.series.Series` null policies, on series with 10%
+of their values null. The cost of building each representation from
+graphite's datapoints is included, since the old null handling relied on
+that representation having been built first.
+
+Usage: python benchmarks/bench_nulls.py
+"""
+
+import random
+import timeit
+
+from go_metrics.metrics.series import (
+    Series, NULL, omit_nulls, zeroize_nulls, ffill_nulls, interpolate_nulls)
+
+
+def old_omit_nulls(datapoints):
+    return [d for d in datapoints if d['y'] is not None]
+
+
+def old_zeroize_nulls(datapoints):
+    return [{
+        'x': d['x'],
+        'y': d['y'] if d['y'] is not None else 0,
+    } for d in datapoints]
+
+
+def mk_datapoints(n, null_ratio=0.1):
+    rand = random.Random(n)
+    return [
+        [None if rand.random() < null_ratio else rand.random(), 60 * i]
+        for i in xrange(n)]
+
+
+def mk_points(datapoints):
+    return [{'x': x * 1000, 'y': y} for y, x in datapoints]
+
+
+def mk_series(datapoints):
+    return Series(
+        [x for _y, x in datapoints],
+        [NULL if y is None else y for y, _x in datapoints])
+
+
+def bench(name, func, arg, number):
+    best = min(timeit.repeat(lambda: func(arg), number=number, repeat=3))
+    print "  %-20s %8.3f ms" % (name, best / number * 1000)
+
+
+def main():
+    for n in (10000, 100000):
+        datapoints = mk_datapoints(n)
+        points = mk_points(datapoints)
+        series = mk_series(datapoints)
+        number = 1000000 // n
+        print "%d points:" % (n,)
+        bench("old parse", mk_points, datapoints, number)
+        bench("series parse", Series.from_datapoints, datapoints, number)
+        bench("old omit", old_omit_nulls, points, number)
+        bench("series omit", omit_nulls, series, number)
+        bench("old zeroize", old_zeroize_nulls, points, number)
+        bench("series zeroize", zeroize_nulls, series, number)
+        bench("series ffill", ffill_nulls, series, number)
+        bench("series linear", interpolate_nulls, series, number)
+
+
+if __name__ == '__main__':
+    main()
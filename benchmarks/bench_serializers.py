@@ -0,0 +1,44 @@
+"""
+Compares the serializers the api can be configured to write responses with,
+on a response of 10000 data points (the graphite backend's default
+``max_response_size``) spread across 10 metrics, with 10% of the values
+null. Serializers whose packages aren't installed are skipped.
+
+Usage: python benchmarks/bench_serializers.py
+"""
+
+import random
+import timeit
+
+from go_metrics import serializers
+from go_metrics.metrics.series import Series, NULL
+
+
+def mk_response(metrics, n, null_ratio=0.1):
+    rand = random.Random(n)
+    return dict(
+        ('stores.metric-%d.sum' % (i,), Series(
+            [60 * j for j in xrange(n)],
+            [NULL if rand.random() < null_ratio else rand.random() * 1000
+             for _ in xrange(n)]))
+        for i in xrange(metrics))
+
+
+def bench(name, func, arg, number):
+    best = min(timeit.repeat(lambda: func(arg), number=number, repeat=3))
+    print "  %-12s %8.3f ms" % (name, best / number * 1000)
+
+
+def main():
+    response = mk_response(10, 1000)
+    print "10 metrics x 1000 points:"
+    bench("json", serializers.json_dumps, response, 20)
+    bench("series", serializers.series_dumps, response, 20)
+    if serializers.simplejson is not None:
+        bench("simplejson", serializers.simplejson_dumps, response, 20)
+    if serializers.ujson is not None:
+        bench("ujson", serializers.ujson_dumps, response, 20)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Compares the cost of parsing the time specifiers and intervals used by
+``go_metrics.metrics.tests.test_graphite_time_parser`` uncached with
+``datetime.strptime()`` (as the parser used to), uncached with the
+hand-rolled parser, and cached.
+
+Usage: python benchmarks/bench_time_parser.py
+"""
+
+import timeit
+from datetime import datetime
+
+from go_metrics.metrics import graphite_time_parser
+from go_metrics.metrics.graphite_time_parser import (
+    interval_to_seconds, normalize_time, to_timestamp)
+
+
+INTERVALS = [
+    "0s", "1s", "60seconds", "1234567s", "012s", "1min", "60minutes",
+    "1h", "24hours", "1d", "60days", "1w", "4weeks", "1mon", "12months",
+    "1y", "5years",
+]
+
+TIMES = [
+    "-0s", "-1s", "-2w", "now", "today", "yesterday", "tomorrow",
+    "00:00_20150201", "00:00_19700101", "12:35_20150201",
+    "20150201", "19700101", "19010101", "99991231",
+    "1422748800", "0", "19000101", "20150132",
+]
+
+
+def strptime_normalize_time(time_str):
+    if ":" in time_str:
+        return to_timestamp(datetime.strptime(time_str, "%H:%M_%Y%m%d"))
+    if len(time_str) == 8 and time_str.isdigit() and all([
+            int(time_str[:4]) > 1900,
+            int(time_str[4:6]) < 13,
+            int(time_str[6:]) < 32]):
+        return to_timestamp(datetime.strptime(time_str, "%Y%m%d"))
+    return normalize_time(time_str)
+
+
+def set_cache_size(size):
+    graphite_time_parser.CACHE_SIZE = size
+    graphite_time_parser._interval_cache.clear()
+    graphite_time_parser._time_cache.clear()
+
+
+def bench(name, func, inputs, number=2000):
+    def run():
+        for value in inputs:
+            func(value)
+
+    best = min(timeit.repeat(run, number=number, repeat=3))
+    print "  %-24s %8.2f us/call" % (
+        name, best / number / len(inputs) * 1e6)
+
+
+def main():
+    set_cache_size(0)
+    print "uncached:"
+    bench("intervals", interval_to_seconds, INTERVALS)
+    bench("times (strptime)", strptime_normalize_time, TIMES)
+    bench("times", normalize_time, TIMES)
+
+    set_cache_size(1024)
+    print "cached:"
+    bench("intervals", interval_to_seconds, INTERVALS)
+    bench("times", normalize_time, TIMES)
+
+
+if __name__ == '__main__':
+    main()
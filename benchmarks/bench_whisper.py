@@ -0,0 +1,98 @@
+"""
+Compares answering a query by reading whisper files directly, as
+:class:`go_metrics.metrics.whisper.WhisperBackend` does, with the work the
+api does to answer the same query through graphite's web app: parsing the
+json render response graphite sends back.
+
+The whisper files are generated locally, with a day of per-minute
+datapoints each. Graphite's side of the render (reading the same files,
+summarizing them and serializing the result) and the http round trip are
+not included, so the graphite path's real cost is higher than shown.
+
+Usage: python benchmarks/bench_whisper.py
+"""
+
+import json
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+from go_metrics.metrics.render_parser import RenderResponseParser
+from go_metrics.metrics.series import Series
+from go_metrics.metrics.summarize import summarize
+from go_metrics.metrics.tests.helpers import write_whisper
+from go_metrics.metrics.whisper import WhisperFile
+
+
+# 2015-02-01 00:00:00
+NOW = 1422748800
+
+ARCHIVES = [(60, 1440), (3600, 24 * 30)]
+
+
+def mk_whisper(path, n):
+    rand = random.Random(n)
+    write_whisper(path, ARCHIVES, [
+        (NOW - i * 60, rand.random()) for i in xrange(1440)])
+    return WhisperFile.open(path)
+
+
+def read_whisper(files, window, interval):
+    data = {}
+    for name, wsp in files:
+        start, step, values = wsp.fetch(NOW - window, NOW, NOW)
+        data[name] = summarize(start, step, values, interval, 'avg', False)
+    return data
+
+
+def mk_render_response(data):
+    return json.dumps([{
+        'target': name,
+        'datapoints': [
+            [y, x] for x, y in zip(series.x, series.values())],
+    } for name, series in data.iteritems()])
+
+
+def parse_render_response(body):
+    data = {}
+
+    def series_received(target, datapoints):
+        data[target] = Series.from_datapoints(datapoints)
+
+    parser = RenderResponseParser(series_received)
+    parser.feed(body)
+    parser.finish()
+    return data
+
+
+def bench(name, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    print "  %-20s %10.1f us/call" % (name, best / number * 1e6)
+
+
+def main():
+    tmp = tempfile.mkdtemp()
+    try:
+        files = [
+            ('m%d' % i, mk_whisper(os.path.join(tmp, 'm%d.wsp' % i), i))
+            for i in xrange(10)]
+
+        for window, interval in ((3600, 60), (86400, 60), (86400, 3600)):
+            data = read_whisper(files, window, interval)
+            body = mk_render_response(data)
+            print "10 metrics, %ds window, %ds interval:" % (
+                window, interval)
+            bench(
+                "whisper read",
+                lambda: read_whisper(files, window, interval), 200)
+            bench(
+                "render parse",
+                lambda: parse_render_response(body), 200)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Negotiation and application of the content encodings the api compresses
+responses with.
+"""
+
+import zlib
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def gzip_compress(data, level):
+    # Adding 16 to the window size has zlib write a gzip header and trailer.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def brotli_compress(data, level):
+    # Brotli's quality ranges from 0 to 11, rather than zlib's 1 to 9.
+    return brotli.compress(data, quality=min(level, 11))
+
+
+# Encodings in order of preference, for when a client accepts several
+# equally.
+compressors = OrderedDict()
+if brotli is not None:
+    compressors['br'] = brotli_compress
+compressors['gzip'] = gzip_compress
+
+
+def parse_accept_encoding(header):
+    """
+    Parse an ``Accept-Encoding`` header into a dict mapping each encoding
+    given to its quality value.
+    """
+    qualities = {}
+    for item in header.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def negotiate_encoding(header):
+    """
+    Return the name of the encoding in :data:`compressors` the client
+    sending the ``Accept-Encoding`` header ``header`` most prefers, or
+    ``None`` if it accepts none of them.
+    """
+    if not header:
+        return None
+
+    qualities = parse_accept_encoding(header)
+    default = qualities.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for coding in compressors:
+        quality = qualities.get(coding, default)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(data, encoding, level):
+    """
+    Compress ``data`` with the encoding named ``encoding``.
+    """
+    return compressors[encoding](data, level)
@@ -7,12 +7,31 @@ class MetricsBackendError(Exception):
     """
 
 
+class MetricsBackendBusyError(MetricsBackendError):
+    """
+    Raised when a query is rejected because the metrics backend has too many
+    queries outstanding.
+    """
+
+
 class BadMetricsQueryError(Exception):
     """
     Raised when an error occurs because a bad query was given.
     """
 
 
+class MetricsThrottledError(Exception):
+    """
+    Raised when a query is rejected because its owner has too many queries
+    outstanding or has used up its allowance of data points. If known,
+    ``retry_after`` is the number of seconds until the query may be retried.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super(MetricsThrottledError, self).__init__(message)
+        self.retry_after = retry_after
+
+
 class Metrics(object):
     """
     A model encapsulating how metric values are queried for a particular
@@ -36,12 +55,26 @@ class Metrics(object):
         """
         raise NotImplementedError()
 
+    def get_batch(self, queries):
+        """
+        Override with backend-specific logic for retrieving the values for
+        a list of queries
+        """
+        raise NotImplementedError()
+
     def fire(self, **kw):
         """
         Override with backend-specific logic for firing metric values
         """
         raise NotImplementedError()
 
+    def fire_bulk(self, records):
+        """
+        Override with backend-specific logic for firing the metric values
+        given by a bulk firing request
+        """
+        raise NotImplementedError()
+
 
 class MetricsBackendConfig(Config):
     """"
@@ -79,3 +112,10 @@ class MetricsBackend(object):
         owner id.
         """
         return self.model_class(self, owner_id)
+
+    def stats(self):
+        """
+        Optionally override to return counters describing the backend's
+        internal state
+        """
+        return {}
@@ -0,0 +1,125 @@
+"""
+Batching of graphite render requests made by the metrics backends.
+"""
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+
+
+class PendingBatch(object):
+    """
+    The targets and waiting callers collected for a batch that has not yet
+    been sent.
+    """
+
+    def __init__(self, delayed_call):
+        self.delayed_call = delayed_call
+        self.waiters = []
+        self.aliases = {}
+
+    def add(self, targets, d):
+        for _alias, target in targets:
+            self.aliases.setdefault(target, str(len(self.aliases)))
+        self.waiters.append((targets, d))
+
+
+class RenderBatcher(object):
+    """
+    Collects render requests arriving within a short window of each other and
+    merges those for the same time range into a single render request.
+
+    Each merged target is given an alias unique to its batch, so that the
+    response can be split back out per caller (and renamed to the aliases
+    each caller asked for) regardless of which owner's metrics are included.
+    Callers asking for identical targets share them within a batch.
+
+    :param render:
+        A function taking a list of targets and the ``from`` and ``until``
+        times, returning a deferred that fires with a dict mapping each
+        returned target to its datapoints.
+    :param float window:
+        The number of seconds to wait for requests to batch together.
+    :param int max_targets:
+        A batch is sent as soon as it contains this many distinct targets.
+    :param clock:
+        An object providing ``callLater()``.
+    """
+
+    def __init__(self, render, window, max_targets, clock):
+        self.render = render
+        self.window = window
+        self.max_targets = max_targets
+        self.clock = clock
+        self.requests = 0
+        self.batches = 0
+        self.targets = 0
+        self.max_batch_targets = 0
+        self._pending = {}
+
+    def submit(self, from_time, until_time, targets):
+        """
+        Add a request for ``targets``, a list of ``(alias, target)`` pairs, to
+        the batch for the given time range. Returns a deferred that fires with
+        a dict mapping the aliases of those targets alone to their datapoints.
+        """
+        if not targets:
+            return succeed({})
+
+        self.requests += 1
+        key = (from_time, until_time)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = PendingBatch(
+                self.clock.callLater(self.window, self.flush, key))
+
+        d = Deferred()
+        batch.add(targets, d)
+        if len(batch.aliases) >= self.max_targets:
+            self.flush(key)
+        return d
+
+    def flush(self, key):
+        """
+        Send the pending batch for the time range ``key``.
+        """
+        batch = self._pending.pop(key)
+        if batch.delayed_call.active():
+            batch.delayed_call.cancel()
+
+        targets = sorted(
+            batch.aliases.iteritems(), key=lambda item: int(item[1]))
+        self.batches += 1
+        self.targets += len(targets)
+        self.max_batch_targets = max(self.max_batch_targets, len(targets))
+
+        from_time, until_time = key
+        d = maybeDeferred(
+            self.render,
+            ["alias(%s, '%s')" % target for target in targets],
+            from_time,
+            until_time)
+        d.addCallbacks(
+            self._split, self._fail,
+            callbackArgs=(batch,), errbackArgs=(batch,))
+
+    def _split(self, data, batch):
+        for targets, d in batch.waiters:
+            d.callback(dict(
+                (alias, data[batch.aliases[target]])
+                for alias, target in targets
+                if batch.aliases[target] in data))
+
+    def _fail(self, failure, batch):
+        for _targets, d in batch.waiters:
+            d.errback(failure)
+
+    def stats(self):
+        """
+        Return a dict of counters describing the batcher's usage.
+        """
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'targets': self.targets,
+            'max_batch_targets': self.max_batch_targets,
+            'pending': len(self._pending),
+        }
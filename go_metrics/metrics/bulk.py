@@ -0,0 +1,53 @@
+"""
+Parsing of bulk metric firing requests.
+"""
+
+import json
+
+from go_metrics.metrics.base import BadMetricsQueryError
+
+
+def iter_lines(body):
+    """
+    Yield ``(line_number, line)`` pairs for each non-blank line in
+    ``body``, without splitting the whole body up front.
+    """
+    pos = 0
+    line_number = 0
+    while pos < len(body):
+        end = body.find('\n', pos)
+        if end == -1:
+            end = len(body)
+        line_number += 1
+        line = body[pos:end].strip()
+        pos = end + 1
+        if line:
+            yield line_number, line
+
+
+def iter_records(body):
+    """
+    Yield ``(line_number, record, error)`` tuples for each record in a bulk
+    firing request body, given either as newline-delimited json objects or
+    as a json array of objects. ``error`` describes why the line could not
+    be decoded, in which case ``record`` is ``None``.
+
+    Records in a json array are numbered by their position in the array.
+    """
+    if body.lstrip().startswith('['):
+        try:
+            records = json.loads(body)
+        except ValueError:
+            raise BadMetricsQueryError("Invalid json array of records")
+
+        for i, record in enumerate(records):
+            yield i + 1, record, None
+        return
+
+    for line_number, line in iter_lines(body):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, None, "Invalid json"
+        else:
+            yield line_number, record, None
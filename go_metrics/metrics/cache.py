@@ -0,0 +1,114 @@
+"""
+Bounded in-memory caches used by the metrics backends.
+"""
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+
+class LRUCache(object):
+    """
+    A bounded least-recently-used cache with per-entry expiry.
+
+    Entries are evicted (least recently used first) whenever the number of
+    entries exceeds ``max_entries`` or the sum of the entries' costs exceeds
+    ``max_cost``.
+
+    :param int max_entries:
+        The maximum number of entries to hold. A value of ``0`` disables the
+        cache.
+    :param int max_cost:
+        The maximum total cost of the entries held, or ``None`` for no limit.
+        Backends use this to bound memory usage, for example by giving each
+        entry a cost equal to the number of data points it contains.
+    :param clock:
+        An object providing ``seconds()``, used for expiring entries.
+    """
+
+    def __init__(self, max_entries, max_cost=None, clock=None):
+        self.max_entries = max_entries
+        self.max_cost = max_cost
+        self.clock = clock if clock is not None else reactor
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _value, cost, _expires_at = self._entries.pop(key)
+        self.cost -= cost
+
+    def _is_full(self):
+        if len(self._entries) > self.max_entries:
+            return True
+        return self.max_cost is not None and self.cost > self.max_cost
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for ``key``, or ``default`` if there is no
+        unexpired value stored for it.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            value, cost, expires_at = entry
+            if expires_at is None or expires_at > self.clock.seconds():
+                # Re-inserting marks this entry as most recently used.
+                self._entries[key] = entry
+                self.hits += 1
+                return value
+            self.cost -= cost
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None, cost=1):
+        """
+        Store ``value`` for ``key``, expiring it after ``ttl`` seconds (or
+        never if ``ttl`` is ``None``). Values too costly to fit in the cache at
+        all are not stored.
+        """
+        if key in self._entries:
+            self._remove(key)
+
+        if self.max_entries <= 0:
+            return
+        if self.max_cost is not None and cost > self.max_cost:
+            return
+
+        expires_at = None if ttl is None else self.clock.seconds() + ttl
+        self._entries[key] = (value, cost, expires_at)
+        self.cost += cost
+
+        while self._is_full():
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def discard(self, key):
+        """
+        Remove the value stored for ``key``, if there is one.
+        """
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self.cost = 0
+
+    def stats(self):
+        """
+        Return a dict of counters describing the cache's usage.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'cost': self.cost,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,67 @@
+"""
+Coalescing of concurrent identical requests made by the metrics backends.
+"""
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+
+class RequestCoalescer(object):
+    """
+    Shares a single outstanding call between all concurrent callers asking for
+    the same key.
+
+    The first caller for a key starts the call. Callers arriving for the same
+    key while that call is outstanding wait on it instead of starting their
+    own, and each receives the call's result (or failure) once it completes.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+        self._waiters = {}
+
+    def waiters(self, key):
+        """
+        Return the number of callers currently waiting on the call for
+        ``key``.
+        """
+        return len(self._waiters.get(key, ()))
+
+    def run(self, key, func, *args, **kw):
+        """
+        Call ``func(*args, **kw)`` unless a call for ``key`` is already
+        outstanding, returning a :class:`Deferred` that fires with the
+        outstanding call's result.
+        """
+        self.requests += 1
+        d = Deferred()
+        waiters = self._waiters.get(key)
+
+        if waiters is not None:
+            self.coalesced += 1
+            waiters.append(d)
+        else:
+            waiters = self._waiters[key] = [d]
+            maybeDeferred(func, *args, **kw).addBoth(self._fire, key)
+
+        self.max_waiters = max(self.max_waiters, len(waiters))
+        return d
+
+    def _fire(self, result, key):
+        for d in self._waiters.pop(key):
+            d.callback(result)
+
+    def stats(self):
+        """
+        Return a dict of counters describing the coalescer's usage, including
+        the number of outstanding calls and of the callers waiting on them.
+        """
+        return {
+            'requests': self.requests,
+            'coalesced': self.coalesced,
+            'max_waiters': self.max_waiters,
+            'pending': len(self._waiters),
+            'waiters': sum(
+                len(waiters) for waiters in self._waiters.itervalues()),
+        }
@@ -0,0 +1,103 @@
+"""
+Downsampling of metric time series for display.
+"""
+
+from array import array
+
+from go_metrics.metrics.series import Series
+
+
+def bucket_bounds(start, end, buckets):
+    """
+    Return ``(first, last)`` index pairs (with ``last`` exclusive) splitting
+    the indices from ``start`` to ``end`` into ``buckets`` similarly sized
+    buckets.
+    """
+    size = (end - start) / float(buckets)
+    return [
+        (start + int(i * size), start + int((i + 1) * size))
+        for i in xrange(buckets)]
+
+
+def take(series, indices):
+    x, y = series.x, series.y
+    return Series(
+        array('l', [x[i] for i in indices]),
+        array('d', [y[i] for i in indices]))
+
+
+def lttb(series, max_points):
+    """
+    Downsample ``series`` to at most ``max_points`` points using the
+    Largest-Triangle-Three-Buckets algorithm, which keeps the points that
+    contribute most to the shape of the series when plotted.
+
+    The first and last points are always kept. Each bucket in between
+    contributes the point forming the largest triangle with the point chosen
+    from the previous bucket and the average of the next bucket. Null values
+    are only chosen for buckets containing nothing else.
+    """
+    n = len(series)
+    if n <= max_points:
+        return series
+    if max_points < 3:
+        return take(series, (0, n - 1))
+
+    x, y = series.x, series.y
+    buckets = bucket_bounds(1, n - 1, max_points - 2)
+    buckets.append((n - 1, n))
+    indices = [0]
+    a = 0
+
+    for (first, last), (next_first, next_last) in zip(buckets, buckets[1:]):
+        next_y = [v for v in y[next_first:next_last] if v == v]
+        avg_x = sum(x[next_first:next_last]) / float(next_last - next_first)
+        avg_y = sum(next_y) / len(next_y) if next_y else y[a]
+
+        ax, ay = x[a], y[a]
+        best, max_area = first, -1.0
+        for i in xrange(first, last):
+            area = abs((ax - avg_x) * (y[i] - ay) - (ax - x[i]) * (avg_y - ay))
+            # Areas involving nulls are NaN, which never compare greater.
+            if area > max_area:
+                best, max_area = i, area
+
+        indices.append(best)
+        a = best
+
+    indices.append(n - 1)
+    return take(series, indices)
+
+
+def minmax(series, max_points):
+    """
+    Downsample ``series`` to at most ``max_points`` points by splitting it
+    into ``max_points / 2`` buckets and keeping the minimum and maximum
+    values of each, in the order they occur. This preserves the peaks and
+    troughs of the series. Null values are only kept for buckets containing
+    nothing else.
+    """
+    n = len(series)
+    if n <= max_points:
+        return series
+
+    y = series.y
+    indices = []
+
+    for first, last in bucket_bounds(0, n, max(1, max_points // 2)):
+        values = [(v, i) for i, v in enumerate(y[first:last], first) if v == v]
+        if not values:
+            indices.append(first)
+            continue
+        # Ties are resolved in favour of the earliest point.
+        lo = min(values)[1]
+        hi = max(values, key=lambda (v, i): (v, -i))[1]
+        indices.extend(sorted(set([lo, hi])))
+
+    return take(series, indices)
+
+
+downsamplers = {
+    'lttb': lttb,
+    'minmax': minmax,
+}
@@ -36,9 +36,16 @@ class DummyMetrics(Metrics):
     def get(self, **kw):
         return self.backend.fixtures.match(method='get', **kw)
 
+    def get_batch(self, queries):
+        return self.backend.fixtures.match(method='get_batch', queries=queries)
+
     def fire(self, **kw):
         return self.backend.fixtures.match(method='fire', **kw)
 
+    def fire_bulk(self, records):
+        return self.backend.fixtures.match(
+            method='fire_bulk', records=list(records))
+
 
 class DummyBackend(MetricsBackend):
     model_class = DummyMetrics
@@ -0,0 +1,209 @@
+"""
+Buffering of fired metric values made by the metrics backends.
+"""
+
+from collections import OrderedDict
+
+from twisted.internet.defer import maybeDeferred, succeed
+from twisted.python import log
+
+
+class Fold(object):
+    """
+    The values fired for a metric at a particular timestamp, combined
+    according to the metric's aggregator.
+    """
+
+    __slots__ = ('count', 'total', 'min', 'max', 'last')
+
+    def __init__(self, value):
+        self.count = 1
+        self.total = self.min = self.max = self.last = value
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.last = value
+
+    def value(self, aggregator):
+        if aggregator == 'sum':
+            return self.total
+        if aggregator == 'avg':
+            return self.total / self.count
+        return getattr(self, aggregator)
+
+
+class FireBuffer(object):
+    """
+    Accumulates fired metric values across requests and publishes them
+    together, once ``max_size`` values have been buffered or ``max_delay``
+    seconds after the first value was buffered, whichever comes first.
+
+    Values for the same metric are grouped into a single datapoint list in
+    the published batch. Since a batch is published as soon as it reaches
+    ``max_size`` values, at most that many values are held in memory.
+
+    :param publish:
+        A function taking a list of ``(name, aggregators, [(timestamp,
+        value), ...])`` datapoints to publish, optionally returning a
+        deferred that fires once they have been published.
+    :param int max_size:
+        The number of buffered values at which a batch is published
+        immediately.
+    :param float max_delay:
+        The number of seconds after the first value is buffered that a batch
+        is published. Set to 0 to publish the values fired by each request
+        as soon as they are added.
+    :param clock:
+        An object providing ``callLater()`` and ``seconds()``.
+    :param bool aggregate:
+        Combine the values buffered for each metric and timestamp into a
+        single value according to the metric's aggregator (``sum``, ``max``,
+        ``min`` or ``last``) before publishing. ``max_size`` then limits the
+        number of combined values rather than the number of values added.
+        Values for ``avg`` metrics are published as they are, since the
+        aggregator downstream gives each datapoint the same weight: an
+        average of the values fired in a second would count for as much as a
+        single value fired in another.
+    """
+
+    def __init__(self, publish, max_size, max_delay, clock, aggregate=False):
+        self.publish = publish
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.clock = clock
+        self.aggregate = aggregate
+        self.values = 0
+        self.folded = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.max_batch_size = 0
+        self.last_flush_latency = None
+        self.max_flush_latency = 0
+        self._buffer = OrderedDict()
+        self._size = 0
+        self._started = None
+        self._delayed_call = None
+
+    def __len__(self):
+        return self._size
+
+    def add(self, values):
+        """
+        Buffer ``values``, a list of ``(name, aggregators, timestamp,
+        value)`` tuples, publishing the batch if it is full. Returns a
+        deferred that fires once any publishing triggered by the added values
+        is done.
+        """
+        if not values:
+            return succeed(None)
+
+        if self._size == 0:
+            self._started = self.clock.seconds()
+            if self.max_delay > 0:
+                self._delayed_call = self.clock.callLater(
+                    self.max_delay, self._delayed_flush)
+
+        self.values += len(values)
+        if self.aggregate:
+            self._fold(values)
+        else:
+            for name, aggs, timestamp, value in values:
+                self._buffer.setdefault((name, aggs), []).append(
+                    (timestamp, value))
+            self._size += len(values)
+
+        if self._size >= self.max_size or self.max_delay <= 0:
+            return self.flush()
+        return succeed(None)
+
+    def _fold(self, values):
+        for name, aggs, timestamp, value in values:
+            if aggs[0] == 'avg':
+                self._buffer.setdefault((name, aggs), []).append(
+                    (timestamp, value))
+                self._size += 1
+                continue
+
+            folds = self._buffer.get((name, aggs))
+            if folds is None:
+                folds = self._buffer[(name, aggs)] = OrderedDict()
+
+            fold = folds.get(timestamp)
+            if fold is None:
+                folds[timestamp] = Fold(value)
+                self._size += 1
+            else:
+                fold.add(value)
+                self.folded += 1
+
+    def _datapoints(self):
+        if not self.aggregate:
+            return [
+                (name, aggs, points)
+                for (name, aggs), points in self._buffer.iteritems()]
+
+        return [
+            (name, aggs, folds if isinstance(folds, list) else [
+                (timestamp, fold.value(aggs[0]))
+                for timestamp, fold in folds.iteritems()])
+            for (name, aggs), folds in self._buffer.iteritems()]
+
+    def flush(self):
+        """
+        Publish the buffered values, returning a deferred that fires once
+        they have been published.
+        """
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+
+        if self._size == 0:
+            return succeed(None)
+
+        datapoints = self._datapoints()
+        size, started = self._size, self._started
+        self._buffer = OrderedDict()
+        self._size = 0
+        self._started = None
+
+        self.flushes += 1
+        self.max_batch_size = max(self.max_batch_size, size)
+        d = maybeDeferred(self.publish, datapoints)
+        d.addCallback(self._published, started)
+        return d
+
+    def _delayed_flush(self):
+        # Nothing is waiting on a flush made once the delay is up, so its
+        # failures are reported here.
+        self._delayed_call = None
+        d = self.flush()
+        d.addErrback(self._flush_failed)
+
+    def _flush_failed(self, failure):
+        self.failed_flushes += 1
+        log.err(failure, "Failed to publish fired metric values")
+
+    def _published(self, _result, started):
+        latency = self.clock.seconds() - started
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    def stats(self):
+        """
+        Return a dict of counters describing the buffer's usage. Flush
+        latencies are the number of seconds from the first value of a batch
+        being buffered to the batch being published.
+        """
+        return {
+            'buffered': self._size,
+            'values': self.values,
+            'folded': self.folded,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'max_batch_size': self.max_batch_size,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
@@ -3,26 +3,46 @@ Graphite backend for the metrics api.
 """
 
 from datetime import datetime
+from itertools import izip
 from urllib import urlencode
 from urlparse import urljoin
 
+from twisted.internet import reactor
 from twisted.internet.defer import (
-    Deferred, inlineCallbacks, succeed, returnValue)
+    CancelledError, Deferred, DeferredSemaphore, FirstError, gatherResults,
+    inlineCallbacks, succeed, returnValue)
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, ResponseNeverReceived)
 
 import treq
 
 from confmodel.errors import ConfigError
-from confmodel.fields import ConfigText, ConfigBool, ConfigInt
+from confmodel.fields import (
+    ConfigText, ConfigBool, ConfigInt, ConfigFloat, ConfigDict)
 from confmodel.fallbacks import SingleFieldFallback
 
+from vumi.blinkenlights.message20110818 import MetricMessage
 from vumi.blinkenlights.metrics import (
-    Metric, MetricManager, SUM, AVG, MAX, MIN, LAST)
+    MetricManager, SUM, AVG, MAX, MIN, LAST)
 from vumi.service import Worker, WorkerCreator
 
 from go_metrics.metrics.base import (
-    Metrics, MetricsBackend, MetricsBackendError, BadMetricsQueryError)
+    Metrics, MetricsBackend, MetricsBackendError, BadMetricsQueryError,
+    MetricsThrottledError)
+from go_metrics.metrics.batch import RenderBatcher
+from go_metrics.metrics.cache import LRUCache
+from go_metrics.metrics.coalesce import RequestCoalescer
+from go_metrics.metrics.downsample import downsamplers
+from go_metrics.metrics.fire import FireBuffer
 from go_metrics.metrics.graphite_time_parser import (
-    interval_to_seconds, parse_time)
+    interval_to_seconds, normalize_time, parse_time, to_timestamp)
+from go_metrics.metrics.render_parser import RenderResponseParser
+from go_metrics.metrics.rollup import RollupMaterializer
+from go_metrics.metrics.schedule import QueryScheduler
+from go_metrics.metrics.throttle import TokenBuckets
+from go_metrics.metrics.series import Series, null_parsers
+from go_metrics.metrics.store import parse_retention
+from go_metrics.metrics.tiers import HistoricalTier, RecentTier, missing_spans
 
 
 def strip_aggregator(name, aggregator):
@@ -36,24 +56,57 @@ def is_error(resp):
     return 400 <= resp.code <= 599
 
 
-def omit_nulls(datapoints):
-    return [d for d in datapoints if d['y'] is not None]
+def is_timeout(err):
+    if isinstance(err, ResponseNeverReceived):
+        return any(f.check(CancelledError) for f in err.reasons)
+    return isinstance(err, CancelledError)
 
 
-def zeroize_nulls(datapoints):
-    return [{
-        'x': d['x'],
-        'y': 0.0 if d['y'] is None else d['y']
-    } for d in datapoints]
+def parse_datapoints(datapoints):
+    return Series.from_datapoints(datapoints)
 
 
-null_parsers = {
-    'keep': lambda x: x,
-    'omit': omit_nulls,
-    'zeroize': zeroize_nulls,
+def format_points(series):
+    # Series are converted to points when they are serialized.
+    return series
+
+
+def format_columns(series):
+    return series.to_columns()
+
+
+formatters = {
+    'points': format_points,
+    'columnar': format_columns,
 }
 
 
+class CompiledMetric(object):
+    """
+    The parts of a metric name's graphite targets and fired names that only
+    depend on the name and its owner, worked out once so that they can be
+    reused across queries.
+    """
+
+    __slots__ = (
+        'name', 'aggregator', 'full_name', 'fire_name', '_target_template')
+
+    def __init__(self, name, aggregator, full_name, fire_name):
+        self.name = name
+        self.aggregator = aggregator
+        self.full_name = full_name
+        self.fire_name = fire_name
+        self._target_template = "summarize(%s, '%%s', '%s', %%s)" % (
+            full_name.replace('%', '%%'), aggregator.name)
+
+    def target(self, interval, align_to_from):
+        return self._target_template % (interval, align_to_from)
+
+    def aliased_target(self, interval, align_to_from):
+        return "alias(%s, '%s')" % (
+            self.target(interval, align_to_from), self.name)
+
+
 class GraphiteMetrics(Metrics):
     aggregators = {
         'sum': SUM,
@@ -77,13 +130,35 @@ class GraphiteMetrics(Metrics):
         return '%s.%s.%s' % (
             self.backend.config.prefix, self.owner_id, name)
 
-    def _build_metric_name(self, name, interval, align_to_from):
-        agg = self._agg_from_name(name).name
-        full_name = self._get_full_metric_name(name)
+    def _compile_metric(self, name):
+        """
+        Return the :class:`CompiledMetric` for ``name``, using the backend's
+        cache of compiled metrics where possible.
+        """
+        cache = self.backend.metric_cache
+        key = (self.owner_id, name)
+        metric = cache.get(key)
+
+        if metric is None:
+            aggregator = self._agg_from_name(name)
+            metric = CompiledMetric(
+                name,
+                aggregator,
+                self._get_full_metric_name(name),
+                strip_aggregator(
+                    self._get_full_metric_name(
+                        name, self.backend.config.disable_auto_prefix),
+                    aggregator))
+            cache.set(key, metric)
+
+        return metric
+
+    def _build_metric_target(self, name, interval, align_to_from):
+        return self._compile_metric(name).target(interval, align_to_from)
 
-        return (
-            "alias(summarize(%s, '%s', '%s', %s), '%s')" %
-            (full_name, interval, agg, align_to_from, name))
+    def _build_metric_name(self, name, interval, align_to_from):
+        return self._compile_metric(name).aliased_target(
+            interval, align_to_from)
 
     def _build_render_url(self, params):
         metrics = params['m']
@@ -93,46 +168,141 @@ class GraphiteMetrics(Metrics):
                 name, params['interval'], params['align_to_from'])
             for name in metrics]
 
-        url = urljoin(self.backend.config.graphite_url, 'render/')
-        return "%s?%s" % (url, urlencode({
-            'format': 'json',
-            'target': targets,
-            'from': params['from'],
-            'until': params['until'],
-        }, True))
+        return self.backend.build_render_url(
+            targets, params['from'], params['until'])
 
-    def _parse_datapoints(self, datapoints):
-        return [{
-            'x': x * 1000,
-            'y': y,
-        } for (y, x) in datapoints]
-
-    def _parse_response(self, data, null_parser):
+    def _format_response(self, data, null_parser, downsample, formatter,
+                         since=None):
+        if since is not None:
+            data = dict(
+                (target, series.since(since))
+                for target, series in data.iteritems())
         return dict(
-            (d['target'], null_parser(self._parse_datapoints(d['datapoints'])))
-            for d in data)
+            (target, formatter(downsample(null_parser(series))))
+            for target, series in data.iteritems())
 
-    def _get_auth(self):
+    def _get_downsampler(self, params):
+        if params['downsample'] not in downsamplers:
+            raise BadMetricsQueryError(
+                "Unrecognised downsampler '%s'" % (params['downsample'],))
+
+        if params['max_points'] is None:
+            return lambda series: series
+
+        try:
+            max_points = int(params['max_points'])
+        except (ValueError, TypeError):
+            max_points = None
+
+        if max_points is None or max_points < 2:
+            raise BadMetricsQueryError(
+                "%r is not a valid maximum number of points, should be an "
+                "integer of at least 2" % (params['max_points'],))
+
+        downsampler = downsamplers[params['downsample']]
+        return lambda series: downsampler(series, max_points)
+
+    def _cache_key(self, params, now):
+        """
+        Build a key identifying the data a query resolves to, so that
+        equivalent queries (for example, with the metrics given in a different
+        order or with ``-1d`` instead of ``-24h``) share cache entries. Times
+        anchored to the current date (such as ``midnight``) are resolved
+        against ``now``.
+        """
+        return (
+            tuple(sorted(set(
+                self._compile_metric(name).full_name
+                for name in params['m']))),
+            interval_to_seconds(params['interval']),
+            str(params['align_to_from']).lower(),
+            normalize_time(params['from'], now),
+            normalize_time(params['until'], now))
+
+    def _cache_ttl(self, params, now):
+        """
+        Determine how long the results of a query may be cached for.
+
+        Windows that include the current (still open) bucket, and windows
+        with an end given as an offset from the current time, are cached
+        briefly: the datapoints in their edge buckets change every time the
+        window slides by graphite's storage step. So are windows whose last
+        bucket closed less than ``historical_settle_time`` seconds ago, as
+        values may still reach graphite late for it. Windows with fixed ends
+        (including those anchored to a day, which are cached under the
+        day's time) that only cover settled buckets are cached for up to
+        ``cache_historical_ttl``.
+        """
         config = self.backend.config
+        interval = interval_to_seconds(params['interval'])
+        specs = (params['from'], params['until'])
+        until = max(to_timestamp(parse_time(spec, now)) for spec in specs)
 
-        if config.username is not None and config.password is not None:
-            return (config.username, config.password)
-        else:
+        settled_at = until + interval + config.historical_settle_time
+        if to_timestamp(now) < settled_at:
+            return config.cache_ttl
+
+        if any(normalize_time(spec, now)[0] == 'relative' for spec in specs):
+            return config.cache_ttl
+
+        return config.cache_historical_ttl
+
+    def _rollup_shapes(self, params, now):
+        """
+        Return the shapes the backend's rollups track for the query, or
+        ``None`` if rollups are disabled or the query's time range isn't
+        relative to the current time with buckets aligned to multiples of
+        its interval.
+        """
+        if self.backend.rollups is None:
+            return None
+        if str(params['align_to_from']).lower() == 'true':
+            return None
+
+        from_kind, from_offset = normalize_time(params['from'], now)
+        until_kind, until_offset = normalize_time(params['until'], now)
+        if from_kind != 'relative' or until_kind != 'relative':
             return None
 
+        interval = interval_to_seconds(params['interval'])
+        return [
+            (self.owner_id, name, from_offset, until_offset, interval)
+            for name in sorted(set(params['m']))]
+
     def _predict_data_size(self, start, end, interval):
         """
         Use the start and end times and interval size to predict the number of
         data points being requested.
         """
-        now = datetime.utcnow()
+        now = datetime.utcfromtimestamp(self.backend.clock.seconds())
         # "end" can be earlier than "start".
         period = abs(parse_time(end, now) - parse_time(start, now))
         interval_secs = interval_to_seconds(interval)
         return (period.seconds + 86400 * period.days) / interval_secs
 
-    @inlineCallbacks
-    def get(self, **kw):
+    def _query_window(self, params):
+        """
+        Return the current time and the start and end of the query's time
+        range, as unix timestamps, for backends that read datapoints
+        themselves.
+        """
+        now = int(self.backend.clock.seconds())
+        utcnow = datetime.utcfromtimestamp(now)
+        return (
+            now,
+            to_timestamp(parse_time(params['from'], utcnow)),
+            to_timestamp(parse_time(params['until'], utcnow)))
+
+    def _query_buckets(self, params):
+        """
+        Return the query's interval in seconds and whether its buckets are
+        aligned to the start of its time range.
+        """
+        return (
+            interval_to_seconds(params['interval']),
+            str(params['align_to_from']).lower() == 'true')
+
+    def _get_params(self, kw):
         params = {
             'm': [],
             'from': '-24h',
@@ -140,69 +310,419 @@ class GraphiteMetrics(Metrics):
             'nulls': 'zeroize',
             'interval': '1hour',
             'align_to_from': 'false',
+            'format': 'points',
+            'max_points': None,
+            'downsample': 'lttb',
+            'since': None,
         }
         params.update(kw)
 
         if (isinstance(params['m'], basestring)):
             params['m'] = [params['m']]
 
+        return params
+
+    def _check_params(self, params):
+        """
+        Check that the query given by ``params`` is valid, returning the
+        number of data points it is predicted to return.
+        """
+        self._narrow_to_since(params)
         predicted_size = self._predict_data_size(
             params['from'], params['until'], params['interval'])
         predicted_size *= max(1, len(params['m']))
+
+        if params['nulls'] not in null_parsers:
+            raise BadMetricsQueryError(
+                "Unrecognised null parser '%s'" % (params['nulls'],))
+
+        if params['format'] not in formatters:
+            raise BadMetricsQueryError(
+                "Unrecognised format '%s'" % (params['format'],))
+
+        self._get_downsampler(params)
+        return predicted_size
+
+    def _narrow_to_since(self, params):
+        """
+        Narrow the time range of a query given a ``since`` cursor (a
+        timestamp in milliseconds, as returned for each datapoint) to start
+        at the first bucket at or after the cursor, keeping the buckets
+        aligned as they would be for the full time range.
+
+        The cursor is replaced with the corresponding timestamp in seconds,
+        for filtering out earlier buckets once the results are fetched.
+        """
+        if params['since'] is None:
+            return
+
+        try:
+            since = -(-int(params['since']) // 1000)
+        except (ValueError, TypeError):
+            raise BadMetricsQueryError(
+                "%r is not a valid since cursor, should be a timestamp in "
+                "milliseconds" % (params['since'],))
+
+        _now, from_time, _until_time = self._query_window(params)
+        interval, align_to_from = self._query_buckets(params)
+
+        if align_to_from:
+            # Buckets start shortly after the start of the time range, so
+            # the time range can only be moved forward by whole intervals
+            # that end before the cursor.
+            start = from_time + max(
+                0, (since - from_time - 1) // interval) * interval
+        else:
+            # Datapoints after the start of the time range are included, so
+            # the range starts a second before the first bucket wanted.
+            start = since + (-since) % interval - 1
+
+        if start > from_time:
+            params['from'] = str(start)
+        params['since'] = since
+
+    def _check_size(self, predicted_size):
         max_response_size = self.backend.config.max_response_size
         if predicted_size > max_response_size:
             raise BadMetricsQueryError(
                 "%s data points requested, maximum allowed is %s" % (
                     predicted_size, max_response_size))
 
-        if params['nulls'] not in null_parsers:
+    def _spend_budget(self, size):
+        """
+        Take ``size`` data points from the owner's allowance, raising
+        :class:`MetricsThrottledError` if it doesn't have enough left.
+        """
+        budgets = self.backend.budgets
+        if budgets is None:
+            return
+
+        retry_after = budgets.spend(self.owner_id, size)
+        if retry_after:
+            raise MetricsThrottledError(
+                "%s data points requested, allowance of data points for owner "
+                "%r exhausted" % (size, self.owner_id),
+                retry_after=retry_after)
+
+    @inlineCallbacks
+    def get(self, **kw):
+        params = self._get_params(kw)
+        size = self._check_params(params)
+        self._check_size(size)
+        data = yield self._get(params, size)
+        returnValue(data)
+
+    @inlineCallbacks
+    def get_batch(self, queries):
+        """
+        Retrieve the results of a list of queries, each a dict of the
+        parameters accepted by :meth:`get`, returning a list of their results
+        in the same order.
+
+        All of the queries are checked before any are run, with their
+        predicted sizes counted together against ``max_response_size``. Up to
+        ``batch_query_concurrency`` of the queries are then run at a time.
+        """
+        if not isinstance(queries, list):
             raise BadMetricsQueryError(
-                "Unrecognised null parser '%s'" % (params['nulls'],))
+                "Invalid batch query %r, should be a list of queries" % (
+                    queries,))
 
-        url = self._build_render_url(params)
-        resp = yield treq.get(
-            url,
-            auth=self._get_auth(),
-            persistent=self.backend.config.persistent)
+        params = []
+        for query in queries:
+            if not isinstance(query, dict):
+                raise BadMetricsQueryError(
+                    "Invalid query %r, should be dict, not %s" % (
+                        query, type(query)))
+            params.append(self._get_params(query))
 
-        if is_error(resp):
-            raise MetricsBackendError(
-                "Got error response interacting with metrics backend")
+        sizes = [self._check_params(p) for p in params]
+        self._check_size(sum(sizes))
+
+        semaphore = DeferredSemaphore(
+            self.backend.config.batch_query_concurrency)
+        try:
+            results = yield gatherResults([
+                semaphore.run(self._get, p, size)
+                for p, size in zip(params, sizes)],
+                consumeErrors=True)
+        except FirstError as e:
+            e.subFailure.raiseException()
+
+        returnValue(results)
 
+    @inlineCallbacks
+    def _get(self, params, size):
+        downsample = self._get_downsampler(params)
         null_parser = null_parsers[params['nulls']]
-        returnValue(self._parse_response((yield resp.json()), null_parser))
+        formatter = formatters[params['format']]
+        cache = self.backend.cache
+        now = datetime.utcfromtimestamp(int(self.backend.clock.seconds()))
+        cache_key = self._cache_key(params, now)
+        data = cache.get(cache_key)
+
+        shapes = self._rollup_shapes(params, now)
+        if shapes:
+            self.backend.rollups.record(shapes, params['interval'])
+            if data is None:
+                data = self.backend.rollups.lookup(shapes)
+
+        if data is None:
+            # Only queries that need to go to graphite count against the
+            # owner's allowance.
+            self._spend_budget(size)
+            data = yield self._fetch_data(params, size)
+            cache.set(
+                cache_key, data,
+                ttl=self._cache_ttl(params, now),
+                cost=max(1, sum(len(series) for series in data.itervalues())))
+
+        returnValue(
+            self._format_response(
+                data, null_parser, downsample, formatter, params['since']))
+
+    def _fetch_data(self, params, size):
+        if self._use_tiers(params):
+            return self._fetch_tiered(params)
+        return self._fetch_graphite(params, size)
+
+    def _fetch_graphite(self, params, size):
+        # Concurrent requests for the same url share a single request to
+        # graphite, which waits for its turn to run.
+        url = self._build_render_url(params)
+        return self.backend.coalescer.run(
+            url, self.backend.scheduler.run, self.owner_id, size,
+            self._fetch, url, params)
+
+    def _use_tiers(self, params):
+        """
+        Determine whether the query can be answered in part from the
+        backend's tiers, which only hold buckets aligned to multiples of
+        their interval, for metrics named without wildcards.
+        """
+        if not self.backend.tiers:
+            return False
+        if str(params['align_to_from']).lower() == 'true':
+            return False
+        return not any(
+            c in name for name in params['m'] for c in '*?[{')
+
+    @inlineCallbacks
+    def _fetch_tiered(self, params):
+        """
+        Fetch the data for a query, answering as many of its buckets as
+        possible from the backend's tiers and asking graphite for the rest.
+
+        Graphite is sent a request for each span of the time range left
+        unanswered, with the metrics missing the same span requested
+        together. The buckets from each source are then stitched back
+        together in time order.
+        """
+        now, from_time, until_time = self._query_window(params)
+        interval = interval_to_seconds(params['interval'])
+        tiers = self.backend.tiers
+
+        # The buckets lying entirely within the time range, which covers the
+        # datapoints after from_time up to and including until_time.
+        first = from_time + 1 + (-from_time - 1) % interval
+        end = until_time + 1 - (until_time + 1) % interval
+        buckets = range(first, end, interval)
+
+        found = {}
+        spans = {}
+        for name in params['m']:
+            metric = self._compile_metric(name)
+            found[name] = answered = {}
+            for tier in tiers:
+                missing = [t for t in buckets if t not in answered]
+                if not missing:
+                    break
+                answered.update(tier.fetch(metric, interval, missing, now))
+
+            for span in missing_spans(
+                    buckets, answered, from_time, until_time, interval):
+                spans.setdefault(span, []).append(name)
+
+        spans = sorted(spans.iteritems())
+        requests = []
+        for (span_from, span_until, _cut), names in spans:
+            span = dict(params, m=names)
+            if span_from != from_time:
+                span['from'] = str(span_from)
+            if span_until != until_time:
+                span['until'] = str(span_until)
+            size = len(names) * ((span_until - span_from) // interval + 1)
+            requests.append(self._fetch_graphite(span, size))
+
+        try:
+            results = yield gatherResults(requests, consumeErrors=True)
+        except FirstError as e:
+            e.subFailure.raiseException()
+
+        returned = set(name for name in params['m'] if found[name])
+        for ((span_from, span_until, cut), names), result in zip(
+                spans, results):
+            for name in names:
+                series = result.get(name)
+                if series is None:
+                    continue
+                for tier in tiers:
+                    tier.received(
+                        self._compile_metric(name), interval, series,
+                        span_from, span_until, now)
+
+                # Graphite's last bucket for a span can start at the cut,
+                # which belongs to the bucket that follows the span.
+                found[name].update(
+                    (x, y) for x, y in izip(series.x, series.y)
+                    if cut is None or x < cut)
+                returned.add(name)
+
+        data = {}
+        for name in returned:
+            points = found[name]
+            xs = sorted(points)
+            data[name] = Series(xs, [points[x] for x in xs])
+
+        returnValue(data)
+
+    def _fetch(self, url, params):
+        batcher = self.backend.batcher
+        if batcher is None:
+            return self.backend.request_render(url)
+
+        targets = [
+            (name, self._build_metric_target(
+                name, params['interval'], params['align_to_from']))
+            for name in params['m']]
+        return batcher.submit(params['from'], params['until'], targets)
+
+    def _fire_value(self, mname, mvalue, timestamp):
+        metric = self._compile_metric(mname)
+        aggregator = metric.aggregator
+
+        try:
+            mvalue = float(mvalue)
+        except (ValueError, TypeError):
+            raise BadMetricsQueryError(
+                '%r is not a valid metric value,'
+                'should be a floating point number' % mvalue)
+
+        value = (metric.fire_name, (aggregator.name,), timestamp, mvalue)
+        metric_value = {
+            'name': mname,
+            'value': mvalue,
+            'aggregator': aggregator.name,
+        }
+        return value, metric_value
+
+    def _publish(self, values):
+        """
+        Publish ``values``, a list of fired values as returned by
+        :meth:`_fire_value`, returning a deferred that fires once they have
+        been accepted.
+        """
+        if self.backend.recent is not None:
+            self.backend.recent.store(values)
+        return self.backend.fire_buffer.add(values)
 
     @inlineCallbacks
     def fire(self, **kw):
-        metrics = []
+        timestamp = int(self.backend.clock.seconds())
+        values = []
         metrics_values = []
         for mname, mvalue in kw.iteritems():
-            aggregator = self._agg_from_name(mname)
-            metric_name = strip_aggregator(
-                self._get_full_metric_name(
-                    mname,
-                    self.backend.config.disable_auto_prefix),
-                aggregator)
-
-            try:
-                mvalue = float(mvalue)
-            except (ValueError, TypeError):
-                raise BadMetricsQueryError(
-                    '%r is not a valid metric value,'
-                    'should be a floating point number' % mvalue)
+            value, metric_value = self._fire_value(mname, mvalue, timestamp)
+            values.append(value)
+            metrics_values.append(metric_value)
 
-            metrics.append((Metric(metric_name, [aggregator]), mvalue))
-            metrics_values.append({
-                'name': mname,
-                'value': mvalue,
-                'aggregator': aggregator.name,
-            })
-
-        mm = yield self.backend.worker.get_metric_manager()
-        [mm.oneshot(metric, value) for metric, value in metrics]
+        yield self._publish(values)
 
         returnValue(metrics_values)
 
+    def _parse_record(self, record, now):
+        if not (isinstance(record, dict) and 'name' in record and
+                'value' in record):
+            raise BadMetricsQueryError(
+                "Invalid record, should be an object with 'name' and "
+                "'value' fields")
+
+        name = record['name']
+        if not isinstance(name, basestring):
+            raise BadMetricsQueryError(
+                "%r is not a valid metric name" % (name,))
+
+        timestamp = record.get('timestamp', now)
+        if isinstance(timestamp, bool) or not isinstance(
+                timestamp, (int, long, float)):
+            raise BadMetricsQueryError(
+                "%r is not a valid timestamp, should be a number of seconds "
+                "since the epoch" % (timestamp,))
+
+        # NaN and infinities aren't integers either.
+        if isinstance(timestamp, float) and not timestamp.is_integer():
+            raise BadMetricsQueryError(
+                "%r is not a valid timestamp, should be a whole number of "
+                "seconds since the epoch" % (timestamp,))
+
+        config = self.backend.config
+        if not (now - config.fire_max_timestamp_age <= timestamp <=
+                now + config.fire_max_timestamp_lead):
+            raise BadMetricsQueryError(
+                "Timestamp %r is too far from the current time, should be "
+                "no more than %d seconds before it and %d seconds after it" % (
+                    timestamp, config.fire_max_timestamp_age,
+                    config.fire_max_timestamp_lead))
+
+        return self._fire_value(
+            name.encode('utf-8'), record['value'], int(timestamp))
+
+    @inlineCallbacks
+    def fire_bulk(self, records):
+        """
+        Fire the values given by ``records``, an iterable of
+        ``(line_number, record, error)`` tuples as produced by
+        :func:`go_metrics.metrics.bulk.iter_records`. Each record is an
+        object with ``name`` and ``value`` fields, and optionally a
+        ``timestamp`` field giving seconds since the epoch.
+
+        Valid records are fired in chunks of up to ``fire_buffer_size``
+        values as they are parsed. Invalid records are skipped and reported
+        by line number in the returned summary rather than failing the whole
+        request.
+        """
+        now = int(self.backend.clock.seconds())
+        chunk_size = self.backend.config.fire_buffer_size
+        values = []
+        errors = []
+        fired = 0
+
+        for line_number, record, error in records:
+            if error is None:
+                try:
+                    value, _ = self._parse_record(record, now)
+                except BadMetricsQueryError as e:
+                    error = str(e)
+
+            if error is not None:
+                errors.append({'line': line_number, 'reason': error})
+                continue
+
+            values.append(value)
+            if len(values) >= chunk_size:
+                fired += len(values)
+                yield self._publish(values)
+                values = []
+
+        fired += len(values)
+        yield self._publish(values)
+
+        returnValue({
+            'fired': fired,
+            'failed': len(errors),
+            'errors': errors,
+        })
+
 
 class MetricWorker(Worker):
     def __init__(self, *args, **kwargs):
@@ -227,10 +747,11 @@ class MetricWorker(Worker):
         return self._started_d
 
 
-class GraphiteBackendConfig(MetricsBackend.config_class):
-    graphite_url = ConfigText(
-        "Url for the graphite web server to query",
-        default='http://127.0.0.1:8080')
+class GraphiteMetricsConfig(MetricsBackend.config_class):
+    """
+    Config fields read by :class:`GraphiteMetrics`, shared by the configs of
+    every backend whose metrics model extends it.
+    """
 
     prefix = ConfigText(
         "Prefix for all metric names. Defaults to 'go.campaigns'",
@@ -241,11 +762,6 @@ class GraphiteBackendConfig(MetricsBackend.config_class):
         "on the configuration.",
         default=False)
 
-    persistent = ConfigBool(
-        ("Flag given to treq telling it whether to maintain a single "
-         "connection for the requests made to graphite's web app."),
-        default=True)
-
     basicauth_username = ConfigText(
         'Username for Basic Authentication for the Metrics API.',
         required=False)
@@ -254,6 +770,74 @@ class GraphiteBackendConfig(MetricsBackend.config_class):
         'Password for Basic Authentication for the Metrics API.',
         required=False)
 
+    max_response_size = ConfigInt(
+        ("Maximum number of data points to return. If a request specifies a "
+         "time range and interval that contains more data than this, it is "
+         "rejected."),
+        default=10000)
+
+    metric_cache_max_entries = ConfigInt(
+        ("Maximum number of compiled metric names (with their graphite "
+         "targets and fired names worked out) to cache for reuse across "
+         "queries. Set to 0 to disable caching."),
+        default=10000)
+
+    batch_query_concurrency = ConfigInt(
+        ("Maximum number of the queries in a batch query to run at the same "
+         "time."),
+        default=4)
+
+    fire_buffer_size = ConfigInt(
+        ("Maximum number of fired metric values to buffer before publishing "
+         "(or storing) them together, including the values parsed from a "
+         "bulk firing request at a time. This bounds the memory used by the "
+         "buffer."),
+        default=1000)
+
+    fire_max_timestamp_age = ConfigInt(
+        ("Maximum number of seconds before the current time that the "
+         "timestamp of a value fired by a bulk firing request may be. Values "
+         "with older timestamps are rejected."),
+        default=365 * 24 * 60 * 60)
+
+    fire_max_timestamp_lead = ConfigInt(
+        ("Maximum number of seconds after the current time that the "
+         "timestamp of a value fired by a bulk firing request may be. Values "
+         "with later timestamps are rejected."),
+        default=60 * 60)
+
+
+class GraphiteBackendConfig(GraphiteMetricsConfig):
+    graphite_url = ConfigText(
+        "Url for the graphite web server to query",
+        default='http://127.0.0.1:8080')
+
+    persistent = ConfigBool(
+        ("Flag telling the connection pool whether to keep connections to "
+         "graphite's web app open for reuse between requests."),
+        default=True)
+
+    max_persistent_per_host = ConfigInt(
+        ("Maximum number of idle connections to graphite's web app to keep "
+         "open for reuse. Requests made while all kept connections are busy "
+         "open new connections, which are closed afterwards if this many idle "
+         "connections are already being kept."),
+        default=10)
+
+    connection_idle_timeout = ConfigInt(
+        ("Number of seconds an idle connection to graphite's web app is kept "
+         "open for reuse before being closed."),
+        default=240)
+
+    connect_timeout = ConfigFloat(
+        "Number of seconds to wait for a connection to graphite's web app.",
+        default=30)
+
+    response_timeout = ConfigFloat(
+        ("Number of seconds to wait for graphite's web app to respond to a "
+         "request before giving up. Set to 0 to wait indefinitely."),
+        default=30)
+
     graphite_username = ConfigText(
         "Basic auth username for authenticating requests to graphite.",
         required=False, fallbacks=[SingleFieldFallback("username")])
@@ -272,12 +856,178 @@ class GraphiteBackendConfig(MetricsBackend.config_class):
          "DEPRECATED, use graphite_password instead."),
         required=False)
 
-    max_response_size = ConfigInt(
-        ("Maximum number of data points to return. If a request specifies a "
-         "time range and interval that contains more data than this, it is "
-         "rejected."),
+    cache_max_entries = ConfigInt(
+        ("Maximum number of query results to cache. Set to 0 to disable "
+         "caching."),
+        default=1000)
+
+    cache_max_datapoints = ConfigInt(
+        ("Maximum number of data points held across all cached query "
+         "results. This bounds the memory used by the cache."),
+        default=1000000)
+
+    cache_ttl = ConfigInt(
+        ("Number of seconds to cache the results of queries whose time range "
+         "includes the current, still changing, interval, or is relative to "
+         "the current time."),
+        default=10)
+
+    cache_historical_ttl = ConfigInt(
+        ("Maximum number of seconds to cache the results of queries whose "
+         "time range is fixed and only includes intervals that ended at "
+         "least historical_settle_time seconds ago."),
+        default=3600)
+
+    batch_window = ConfigFloat(
+        ("Number of seconds to collect render requests for before merging "
+         "those for the same time range into a single request to graphite. "
+         "Set to 0 to disable batching."),
+        default=0)
+
+    batch_max_targets = ConfigInt(
+        ("Maximum number of targets to merge into a single batched render "
+         "request to graphite."),
+        default=100)
+
+    max_concurrent_queries = ConfigInt(
+        ("Maximum number of requests to graphite's web app to have "
+         "outstanding at once. Further queries are queued until there is room "
+         "for them, with the queued queries of different owners taking turns "
+         "to run."),
+        default=20)
+
+    max_concurrent_queries_per_owner = ConfigInt(
+        ("Maximum number of requests to graphite's web app to have "
+         "outstanding at once for a single owner."),
+        default=10)
+
+    max_queued_queries = ConfigInt(
+        ("Maximum number of queries to queue across all owners. Further "
+         "queries are rejected with a 503 response."),
+        default=1000)
+
+    max_queued_queries_per_owner = ConfigInt(
+        ("Maximum number of queries to queue for a single owner. Further "
+         "queries for the owner are rejected with a 429 response."),
+        default=100)
+
+    query_quantum = ConfigInt(
+        ("Number of predicted data points an owner's queued queries may "
+         "request each time the owner's turn to run queries comes around. "
+         "Must be positive."),
+        default=1000)
+
+    query_budget_rate = ConfigFloat(
+        ("Number of data points added to each owner's allowance every second. "
+         "Queries that need to go to graphite use up the number of data "
+         "points they are predicted to return, and are rejected with a 429 "
+         "response if their owner's allowance doesn't have enough left. Set "
+         "to 0 to disable allowances."),
+        default=1000)
+
+    query_budget_burst = ConfigInt(
+        ("Maximum number of data points each owner's allowance can hold."),
+        default=100000)
+
+    owner_weights = ConfigDict(
+        ("Mapping of owner ids to the share of queries each owner is given "
+         "relative to other owners when queries are queued. Owners not given "
+         "here have a weight of 1."),
+        default={})
+
+    recent_retention = ConfigText(
+        ("Resolution and duration to keep the values fired through the api at "
+         "in memory, of the form '<resolution>:<duration>' (for example, "
+         "'1min:1h'), for answering the most recent buckets of queries "
+         "without going to graphite. This is only correct if metrics are "
+         "fired through this api process alone, and the resolution matches "
+         "the one carbon stores the metrics at. Disabled if not given."),
+        required=False)
+
+    recent_max_metrics = ConfigInt(
+        "Maximum number of metrics to keep fired values in memory for.",
         default=10000)
 
+    historical_cache_max_entries = ConfigInt(
+        ("Maximum number of metrics (at each interval queried) to keep "
+         "completed buckets returned by graphite for, for answering the "
+         "older buckets of queries without going to graphite. Set to 0 to "
+         "disable."),
+        default=0)
+
+    historical_cache_max_buckets = ConfigInt(
+        ("Maximum number of completed buckets to keep in memory across all "
+         "metrics."),
+        default=1000000)
+
+    historical_cache_dir = ConfigText(
+        ("Directory to store completed buckets in, so that they are kept "
+         "across restarts. Buckets are only kept in memory if not given."),
+        required=False)
+
+    historical_settle_time = ConfigInt(
+        ("Number of seconds after a bucket ends before it is considered "
+         "complete, allowing for values that reach graphite late."),
+        default=300)
+
+    rollup_max_shapes = ConfigInt(
+        ("Maximum number of query shapes (an owner's metric queried over a "
+         "time range relative to the current time at a particular interval) "
+         "to keep the results of materialized, refreshed in the background "
+         "as buckets close. The shapes requested most often are "
+         "materialized. Set to 0 to disable."),
+        default=0)
+
+    rollup_max_datapoints = ConfigInt(
+        ("Maximum number of data points to keep materialized across all "
+         "shapes."),
+        default=100000)
+
+    rollup_min_requests = ConfigInt(
+        ("Minimum number of times a shape needs to have been requested "
+         "(with counts halved every rollup_decay_interval seconds) before it "
+         "is materialized."),
+        default=3)
+
+    rollup_max_age = ConfigInt(
+        ("Maximum number of seconds to answer queries from a shape's "
+         "materialized results for before they are refreshed, bounding how "
+         "out of date the still open buckets can be."),
+        default=60)
+
+    rollup_check_interval = ConfigFloat(
+        ("Number of seconds between checks for newly popular shapes to "
+         "materialize, and between attempts to refresh shapes that failed "
+         "to refresh."),
+        default=10)
+
+    rollup_decay_interval = ConfigInt(
+        "Number of seconds between halvings of the shapes' request counts.",
+        default=3600)
+
+    rollup_max_tracked = ConfigInt(
+        "Maximum number of shapes to count requests for.",
+        default=10000)
+
+    rollup_storage_step = ConfigInt(
+        ("Resolution in seconds that carbon stores the materialized metrics "
+         "at, used to tell when the buckets a shape's query returns change."),
+        default=60)
+
+    fire_buffer_delay = ConfigFloat(
+        ("Maximum number of seconds to buffer fired metric values for before "
+         "publishing them together. Set to 0 to publish the values fired by "
+         "each request immediately."),
+        default=1)
+
+    fire_pre_aggregate = ConfigBool(
+        ("Flag telling the backend whether to combine the buffered values "
+         "fired for each metric in the same second into a single value "
+         "according to the metric's aggregator before publishing them. "
+         "Values for avg metrics aren't combined, so that the stored "
+         "averages are unchanged."),
+        default=False)
+
     amqp_hostname = ConfigText(
         "Hostname for where AMQP broker is located",
         default='127.0.0.1')
@@ -311,15 +1061,240 @@ class GraphiteBackendConfig(MetricsBackend.config_class):
                 "Either both a username and password need to be given or "
                 "neither for graphite backend config")
 
+        if self.query_quantum <= 0:
+            raise ConfigError(
+                "query_quantum should be positive, not %r" % (
+                    self.query_quantum,))
+
+        for owner_id, weight in self.owner_weights.iteritems():
+            if not isinstance(weight, (int, float)) or weight <= 0:
+                raise ConfigError(
+                    "Owner weight %r for %r should be a positive number" % (
+                        weight, owner_id))
+
+        if self.recent_retention is not None:
+            parse_retention(self.recent_retention)
+
 
 class GraphiteBackend(MetricsBackend):
     model_class = GraphiteMetrics
     config_class = GraphiteBackendConfig
 
     def initialize(self):
+        self.clock = self.get_clock()
+        self.reactor = self.get_reactor()
+        self.cache = LRUCache(
+            self.config.cache_max_entries,
+            self.config.cache_max_datapoints,
+            clock=self.clock)
+        self.metric_cache = LRUCache(self.config.metric_cache_max_entries)
+        self.pool, self.agent = self.create_agent()
+        self.coalescer = RequestCoalescer()
+        self.budgets = self.create_budgets()
+        self.scheduler = QueryScheduler(
+            self.config.max_concurrent_queries,
+            self.config.max_concurrent_queries_per_owner,
+            self.config.max_queued_queries,
+            self.config.max_queued_queries_per_owner,
+            self.config.query_quantum,
+            self.clock,
+            weights=self.config.owner_weights)
+        self.batcher = self.create_batcher()
+        self.recent = self.create_recent_tier()
+        self.historical = self.create_historical_tier()
+        self.tiers = [
+            tier for tier in (self.recent, self.historical)
+            if tier is not None]
+        self.rollups = self.create_rollups()
+        self.fire_buffer = FireBuffer(
+            self.publish_fired,
+            self.config.fire_buffer_size,
+            self.config.fire_buffer_delay,
+            self.clock,
+            aggregate=self.config.fire_pre_aggregate)
         self.worker = self.create_worker()
         self.worker.startService()
 
+    def get_clock(self):
+        return reactor
+
+    def get_reactor(self):
+        """
+        Return the reactor to make connections to graphite with. Timeouts
+        are scheduled on the backend's clock instead.
+        """
+        return reactor
+
+    def create_agent(self):
+        config = self.config
+        pool = HTTPConnectionPool(self.reactor, persistent=config.persistent)
+        pool.maxPersistentPerHost = config.max_persistent_per_host
+        pool.cachedConnectionTimeout = config.connection_idle_timeout
+        agent = Agent(
+            self.reactor, connectTimeout=config.connect_timeout, pool=pool)
+        return pool, agent
+
+    def create_budgets(self):
+        if self.config.query_budget_rate <= 0:
+            return None
+        return TokenBuckets(
+            self.config.query_budget_rate,
+            self.config.query_budget_burst,
+            self.clock)
+
+    def create_batcher(self):
+        if self.config.batch_window <= 0:
+            return None
+        return RenderBatcher(
+            self.render,
+            self.config.batch_window,
+            self.config.batch_max_targets,
+            self.clock)
+
+    def create_recent_tier(self):
+        if self.config.recent_retention is None:
+            return None
+        return RecentTier(
+            parse_retention(self.config.recent_retention),
+            self.config.recent_max_metrics,
+            int(self.clock.seconds()))
+
+    def create_historical_tier(self):
+        if self.config.historical_cache_max_entries <= 0:
+            return None
+        return HistoricalTier(
+            self.config.historical_cache_max_entries,
+            self.config.historical_cache_max_buckets,
+            self.config.historical_settle_time,
+            path=self.config.historical_cache_dir)
+
+    def create_rollups(self):
+        config = self.config
+        if config.rollup_max_shapes <= 0:
+            return None
+        return RollupMaterializer(
+            self.refresh_rollup,
+            self.clock,
+            config.rollup_max_shapes,
+            config.rollup_max_datapoints,
+            config.rollup_min_requests,
+            config.rollup_max_age,
+            config.rollup_check_interval,
+            config.rollup_decay_interval,
+            config.rollup_max_tracked,
+            config.rollup_storage_step)
+
+    def refresh_rollup(self, owner_id, params):
+        """
+        Fetch the data for a query made to refresh materialized shapes. These
+        don't count against the owner's allowance.
+        """
+        model = self.get_model(owner_id)
+        params = model._get_params(params)
+        size = model._check_params(params)
+        return model._fetch_data(params, size)
+
+    def _get_auth(self):
+        config = self.config
+
+        if config.username is not None and config.password is not None:
+            return (config.username, config.password)
+        else:
+            return None
+
+    def build_render_url(self, targets, from_time, until_time):
+        url = urljoin(self.config.graphite_url, 'render/')
+        return "%s?%s" % (url, urlencode({
+            'format': 'json',
+            'target': targets,
+            'from': from_time,
+            'until': until_time,
+        }, True))
+
+    @inlineCallbacks
+    def request_render(self, url):
+        """
+        Request the given render url from graphite, returning a dict mapping
+        each returned target to a :class:`Series` of its datapoints.
+
+        The response body is parsed as it arrives, with each series converted
+        as soon as it has been received, so neither the whole body nor
+        graphite's representation of all the series is held in memory at
+        once.
+        """
+        try:
+            resp = yield treq.get(
+                url,
+                auth=self._get_auth(),
+                agent=self.agent,
+                timeout=self.config.response_timeout,
+                reactor=self.clock,
+                unbuffered=True)
+        except Exception as e:
+            if not is_timeout(e):
+                raise
+            raise MetricsBackendError(
+                "Timed out waiting for a response from metrics backend")
+
+        if is_error(resp):
+            # Read the body so that the connection can be reused.
+            yield treq.content(resp)
+            raise MetricsBackendError(
+                "Got error response interacting with metrics backend")
+
+        data = {}
+
+        def series_received(target, datapoints):
+            data[target] = parse_datapoints(datapoints)
+
+        parser = RenderResponseParser(series_received)
+        yield treq.collect(resp, parser.feed)
+        parser.finish()
+        returnValue(data)
+
+    def render(self, targets, from_time, until_time):
+        """
+        Request the given targets for the given time range from graphite.
+        """
+        return self.request_render(
+            self.build_render_url(targets, from_time, until_time))
+
+    @inlineCallbacks
+    def publish_fired(self, datapoints):
+        """
+        Publish a batch of fired metric datapoints, as given by
+        :class:`FireBuffer`, in a single metric message.
+        """
+        mm = yield self.worker.get_metric_manager()
+        msg = MetricMessage()
+        msg.extend(
+            (mm.prefix + name, aggs, points)
+            for name, aggs, points in datapoints)
+        mm.publish_message(msg)
+
+    def stats(self):
+        """
+        Returns counters describing the backend's internal state.
+        """
+        stats = {
+            'cache': self.cache.stats(),
+            'metric_cache': self.metric_cache.stats(),
+            'coalescer': self.coalescer.stats(),
+            'scheduler': self.scheduler.stats(),
+            'fire_buffer': self.fire_buffer.stats(),
+        }
+        if self.budgets is not None:
+            stats['budgets'] = self.budgets.stats()
+        if self.batcher is not None:
+            stats['batcher'] = self.batcher.stats()
+        if self.recent is not None:
+            stats['recent'] = self.recent.stats()
+        if self.historical is not None:
+            stats['historical'] = self.historical.stats()
+        if self.rollups is not None:
+            stats['rollups'] = self.rollups.stats()
+        return stats
+
     def create_worker(self):
         config = self.config
         worker_creator = WorkerCreator({
@@ -335,4 +1310,8 @@ class GraphiteBackend(MetricsBackend):
 
     @inlineCallbacks
     def teardown(self):
+        if self.rollups is not None:
+            self.rollups.stop()
+        yield self.fire_buffer.flush()
         yield self.worker.stopService()
+        yield self.pool.closeCachedConnections()
@@ -2,6 +2,7 @@
 Time period and interval parameter parsers for Graphite backend.
 """
 
+from calendar import timegm
 from datetime import datetime, timedelta
 import re
 
@@ -12,8 +13,16 @@ class TimeParserValueError(ValueError):
     """
 
 
+EPOCH = datetime(1970, 1, 1)
+
 INTERVAL_RE = re.compile(r'(?P<count>\d+)(?P<unit>.+)')
 
+DATETIME_RE = re.compile(r'(\d{2}):(\d{2})(\d{4})(\d{2})(\d{2})$')
+
+CLOCK_TIME_RE = re.compile(r'(\d{1,2}):(\d{2})(am|pm)?')
+
+OFFSET_TERM_RE = re.compile(r'(\d+)([a-z]+)')
+
 UNIT_VALUES = {}
 
 
@@ -30,6 +39,45 @@ _set_unit_value(7 * 86400, "w", "week", "weeks")
 _set_unit_value(30 * 86400, "mon", "month", "months")
 _set_unit_value(365 * 86400, "y", "year", "years")
 
+# Named times of day, as ``(hour, minute)``.
+TIMES_OF_DAY = {
+    "noon": (12, 0),
+    "midnight": (0, 0),
+    "teatime": (16, 0),
+}
+
+# Named days, as a number of days from the current day.
+DAYS = {
+    "": 0,
+    "today": 0,
+    "yesterday": -1,
+    "tomorrow": 1,
+}
+
+MONTHS = [
+    "jan", "feb", "mar", "apr", "may", "jun",
+    "jul", "aug", "sep", "oct", "nov", "dec",
+]
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+# Parsed intervals and time specifiers are cached, since the same handful
+# of them are used by almost every request. Plain dicts are used rather than
+# an LRU cache, since a lookup needs to be cheap compared to parsing, and are
+# emptied when full.
+CACHE_SIZE = 1024
+
+_interval_cache = {}
+
+_time_cache = {}
+
+
+def _cache_set(cache, key, value):
+    if len(cache) >= CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+
 
 def interval_to_seconds(interval_str):
     """
@@ -39,6 +87,14 @@ def interval_to_seconds(interval_str):
     NOTE: This is stricter than Graphite's parser, which accepts any string
           starting with the shortest prefix for a unit.
     """
+    seconds = _interval_cache.get(interval_str)
+    if seconds is None:
+        seconds = _parse_interval(interval_str)
+        _cache_set(_interval_cache, interval_str, seconds)
+    return seconds
+
+
+def _parse_interval(interval_str):
     parts = INTERVAL_RE.match(interval_str)
     if parts is None:
         raise TimeParserValueError(
@@ -52,46 +108,191 @@ def interval_to_seconds(interval_str):
     return count * unit_multiplier
 
 
-def _call_or_raise(exc, func, *args, **kw):
+def _parse_offset(offset, exc):
+    """
+    Parse an offset of the form ``[+-]<count><unit>[<count><unit>...]`` into
+    a number of seconds.
     """
-    Call func(*args, **kw) and catch any exceptions, raising exc instead.
+    if not offset:
+        return 0
 
-    This exists to avoid a bunch of boilerplate try/except blocks in
-    parse_absolute_time()
+    sign = -1 if offset[0] == "-" else 1
+    pos = 1
+    seconds = 0
+    while pos < len(offset):
+        term = OFFSET_TERM_RE.match(offset, pos)
+        if term is None:
+            raise exc
+        count, unit = term.groups()
+        unit_multiplier = UNIT_VALUES.get(unit)
+        if unit_multiplier is None:
+            raise exc
+        seconds += int(count) * unit_multiplier
+        pos = term.end()
+    return sign * seconds
+
+
+def _parse_time_of_day(ref, exc):
     """
-    try:
-        return func(*args, **kw)
-    except:
+    Parse the time of day at the start of a reference, returning
+    ``(hour, minute, rest)``, where ``rest`` is the remainder of the
+    reference.
+    """
+    clock_time = CLOCK_TIME_RE.match(ref)
+    if clock_time is not None:
+        hour, minute, meridiem = clock_time.groups()
+        hour, minute = int(hour), int(minute)
+        if meridiem == "am" and hour == 12:
+            hour = 0
+        elif meridiem == "pm" and hour < 12:
+            hour += 12
+        ref = ref[clock_time.end():]
+    else:
+        hour, minute = 0, 0
+
+    for name, (named_hour, named_minute) in TIMES_OF_DAY.iteritems():
+        if ref.startswith(name):
+            hour, minute = named_hour, named_minute
+            ref = ref[len(name):]
+            break
+
+    if hour > 23 or minute > 59:
         raise exc
+    return hour, minute, ref
 
 
-def parse_absolute_time(time_str):
+def _parse_day(ref, exc):
     """
-    Parse a Graphite-compatible absolute time specifier into a datetime object.
-
-    This accepts `HH:MM_YYYYMMDD` and `YYYYMMDD` formats as well as unix
-    timestamps.
+    Parse the day part of a reference into either ``("date", (year, month,
+    day))`` or a day relative to the current date, as one of ``("days",
+    count)``, ``("month", (month, day))`` or ``("weekday", weekday)``.
     """
-    # Build an exception to pass to _call_or_raise()
+    if ref in DAYS:
+        return ("days", DAYS[ref])
+
+    if ref.count("/") == 2:
+        # MM/DD/YY[YY]
+        try:
+            month, day, year = map(int, ref.split("/"))
+        except ValueError:
+            raise exc
+        if year < 1900:
+            year += 1900
+        if year < 1970:
+            year += 100
+        return ("date", (year, month, day))
+
+    if len(ref) == 8 and ref.isdigit():
+        # YYYYMMDD
+        return ("date", (int(ref[:4]), int(ref[4:6]), int(ref[6:])))
+
+    if ref[:3] in MONTHS:
+        # <month name><day of month>
+        day = ref[-2:] if ref[-2:].isdigit() else ref[-1:]
+        if not day.isdigit():
+            raise exc
+        return ("month", (MONTHS.index(ref[:3]) + 1, int(day)))
+
+    if ref[:3] in WEEKDAYS:
+        return ("weekday", WEEKDAYS.index(ref[:3]))
+
+    raise exc
+
+
+def _to_timestamp(exc, *fields):
+    try:
+        return to_timestamp(datetime(*fields))
+    except ValueError:
+        raise exc
+
+
+def _compile_time(time_str):
     exc = TimeParserValueError("Invalid time string: %r" % (time_str,))
+    s = time_str.strip().lower()
+    for char in "_, ":
+        s = s.replace(char, "")
+    if not s:
+        raise exc
 
-    if ":" in time_str:
-        return _call_or_raise(exc, datetime.strptime, time_str, "%H:%M_%Y%m%d")
-    elif time_str.isdigit():
+    if s.isdigit():
         # This is the same test graphite uses to determine whether a string is
         # a unix timestamp or a `YYYYMMDD` string. It's important that we make
         # the same decisions as graphite because differences could let very
         # expensive requests slip through and potentially break either the API
         # or graphite.
-        if len(time_str) == 8 and all([int(time_str[:4]) > 1900,
-                                       int(time_str[4:6]) < 13,
-                                       int(time_str[6:]) < 32]):
-            return _call_or_raise(exc, datetime.strptime, time_str, "%Y%m%d")
-        else:
-            return _call_or_raise(
-                exc, datetime.utcfromtimestamp, int(time_str))
+        if not (len(s) == 8 and all([int(s[:4]) > 1900,
+                                     int(s[4:6]) < 13,
+                                     int(s[6:]) < 32])):
+            return ("absolute", int(s))
+    elif ":" in s and len(s) == 13:
+        # HH:MM_YYYYMMDD
+        parts = DATETIME_RE.match(s)
+        if parts is None:
+            raise exc
+        hour, minute, year, month, day = map(int, parts.groups())
+        return ("absolute", _to_timestamp(exc, year, month, day, hour, minute))
+
+    for sign in "+-":
+        if sign in s:
+            ref, offset = s.split(sign, 1)
+            offset = sign + offset
+            break
     else:
-        raise exc
+        ref, offset = s, ""
+
+    offset = _parse_offset(offset, exc)
+    if ref in ("", "now"):
+        return ("relative", offset)
+
+    hour, minute, ref = _parse_time_of_day(ref, exc)
+    kind, value = _parse_day(ref, exc)
+    if kind == "date":
+        year, month, day = value
+        return (
+            "absolute",
+            _to_timestamp(exc, year, month, day, hour, minute) + offset)
+    return ("anchored", (hour, minute), (kind, value), offset)
+
+
+def compile_time(time_str):
+    """
+    Parse a Graphite-compatible time specifier into a tuple describing how
+    to resolve it, which is one of:
+
+    - ``("absolute", timestamp)`` for a fixed point in time.
+    - ``("relative", offset)`` for the current time plus ``offset``
+      seconds.
+    - ``("anchored", (hour, minute), day, offset)`` for a time of day on a
+      day found relative to the current date, plus ``offset`` seconds.
+      ``day`` is one of ``("days", count)``, ``("month", (month,
+      day_of_month))`` or ``("weekday", weekday)``.
+
+    See :func:`parse_time` for the accepted grammar.
+    """
+    result = _time_cache.get(time_str)
+    if result is None:
+        result = _compile_time(time_str)
+        _cache_set(_time_cache, time_str, result)
+    return result
+
+
+def _resolve_anchored(time_of_day, day, now, exc):
+    hour, minute = time_of_day
+    kind, value = day
+    ref = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+    if kind == "days":
+        return ref + timedelta(days=value)
+
+    if kind == "month":
+        month, day_of_month = value
+        try:
+            return ref.replace(month=month, day=day_of_month)
+        except ValueError:
+            raise exc
+
+    # The most recent occurrence of the weekday, which may be today.
+    return ref - timedelta(days=(ref.weekday() - value) % 7)
 
 
 def parse_time(time_str, now):
@@ -99,17 +300,58 @@ def parse_time(time_str, now):
     Parse a Graphite-compatible absolute or relative time specifier into a
     datetime object.
 
-    NOTE: This is stricter than Graphite's parser and accepts a narrower
-          variety of formats. Currently, only relative time specifiers are
-          supported.
-    """
-    if time_str in ["now", "today"]:
-        return now
-    if time_str == "yesterday":
-        return now - timedelta(days=1)
-    if time_str == "tomorrow":
-        return now + timedelta(days=1)
-    if time_str.startswith("-"):
-        interval = interval_to_seconds(time_str[1:])
-        return now - timedelta(seconds=interval)
-    return parse_absolute_time(time_str)
+    This follows graphite's grammar for ``from`` and ``until`` times, with
+    all times in UTC. A specifier is either a unix timestamp,
+    ``HH:MM_YYYYMMDD``, ``YYYYMMDD``, or a reference followed by an
+    optional offset. A reference is ``now`` or an optional time of day
+    (``HH:MM[am|pm]``, ``noon``, ``midnight`` or ``teatime``) followed by an
+    optional day (``today``, ``yesterday``, ``tomorrow``, ``MM/DD/YY[YY]``,
+    ``YYYYMMDD``, a month name and day of month, or a weekday name). An
+    offset is a ``+`` or ``-`` followed by one or more ``<count><unit>``
+    terms. Spaces, underscores and commas are ignored.
+
+    NOTE: This is stricter than Graphite's parser in that offset units must
+          be one of the unit names accepted by :func:`interval_to_seconds`
+          rather than any string starting with a unit's shortest prefix.
+    """
+    exc = TimeParserValueError("Invalid time string: %r" % (time_str,))
+    result = compile_time(time_str)
+    try:
+        if result[0] == "absolute":
+            return EPOCH + timedelta(seconds=result[1])
+        if result[0] == "relative":
+            return now + timedelta(seconds=result[1])
+        _, time_of_day, day, offset = result
+        return (
+            _resolve_anchored(time_of_day, day, now, exc) +
+            timedelta(seconds=offset))
+    except OverflowError:
+        raise exc
+
+
+def to_timestamp(dt):
+    """
+    Convert a naive UTC datetime into a unix timestamp.
+    """
+    return timegm(dt.utctimetuple())
+
+
+def normalize_time(time_str, now=None):
+    """
+    Return a canonical, hashable representation of a time specifier.
+
+    Specifiers that are a fixed offset from the current time are represented
+    as ``("relative", offset)``, where ``offset`` is the number of seconds
+    from the current time. Other specifiers are represented as
+    ``("absolute", timestamp)``, with those anchored to a day relative to the
+    current date (such as ``midnight`` or ``noon yesterday``) resolved
+    against ``now``, which defaults to the current time. Equivalent
+    specifiers (for example ``-24h`` and ``-1d``) have equal
+    representations.
+    """
+    result = compile_time(time_str)
+    if result[0] != "anchored":
+        return result
+    if now is None:
+        now = datetime.utcnow()
+    return ("absolute", to_timestamp(parse_time(time_str, now)))
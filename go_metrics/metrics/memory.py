@@ -0,0 +1,116 @@
+"""
+In-process memory backend for the metrics api, storing recently fired metric
+values itself rather than publishing them to graphite.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+
+from confmodel.errors import ConfigError
+from confmodel.fields import ConfigInt, ConfigList
+
+from go_metrics.metrics.base import MetricsBackend
+from go_metrics.metrics.cache import LRUCache
+from go_metrics.metrics.graphite import (
+    GraphiteMetrics, GraphiteMetricsConfig, formatters)
+from go_metrics.metrics.series import null_parsers
+from go_metrics.metrics.store import StoredMetric, parse_retention
+from go_metrics.metrics.summarize import summarize
+
+
+class MemoryMetrics(GraphiteMetrics):
+    """
+    Metrics model for :class:`MemoryBackend`. Queries accept the same
+    parameters as :class:`GraphiteMetrics` and are answered with the same
+    summarizing, null handling and formatting, but from the values stored by
+    the backend instead of from graphite.
+    """
+
+    def _publish(self, values):
+        self.backend.store(values)
+        return succeed(None)
+
+    def _get(self, params, size):
+        downsample = self._get_downsampler(params)
+        null_parser = null_parsers[params['nulls']]
+        formatter = formatters[params['format']]
+        now, from_time, until_time = self._query_window(params)
+        interval, align_to_from = self._query_buckets(params)
+
+        data = {}
+        for name in params['m']:
+            metric = self._compile_metric(name)
+            stored = self.backend.metrics.get(
+                (metric.fire_name, metric.aggregator.name))
+            if stored is None:
+                # Graphite leaves out metrics it has no values for.
+                continue
+
+            start, step, values = stored.fetch(from_time, until_time, now)
+            data[name] = summarize(
+                start, step, values, interval, metric.aggregator.name,
+                align_to_from)
+
+        return succeed(
+            self._format_response(
+                data, null_parser, downsample, formatter, params['since']))
+
+
+class MemoryBackendConfig(GraphiteMetricsConfig):
+    retentions = ConfigList(
+        ("Resolutions to keep fired metric values at, each of the form "
+         "'<resolution>:<duration>' (for example, '1min:6h' keeps a datapoint "
+         "per minute for six hours). Queries are answered from the highest "
+         "resolution covering the requested time range."),
+        default=['1min:6h'])
+
+    max_metrics = ConfigInt(
+        ("Maximum number of metrics to keep values for. The values of the "
+         "least recently fired or queried metrics are discarded first."),
+        default=10000)
+
+    def post_validate(self):
+        if not self.retentions:
+            raise ConfigError("At least one retention needs to be given")
+        steps = [parse_retention(r)[0] for r in self.retentions]
+        if steps != sorted(steps):
+            raise ConfigError(
+                "Retentions should be ordered from highest to lowest "
+                "resolution")
+
+
+class MemoryBackend(MetricsBackend):
+    model_class = MemoryMetrics
+    config_class = MemoryBackendConfig
+
+    def initialize(self):
+        self.clock = self.get_clock()
+        self.retentions = [parse_retention(r) for r in self.config.retentions]
+        self.metrics = LRUCache(self.config.max_metrics)
+        self.metric_cache = LRUCache(self.config.metric_cache_max_entries)
+
+    def get_clock(self):
+        return reactor
+
+    def store(self, values):
+        """
+        Store fired values, a list of ``(name, aggregators, timestamp,
+        value)`` tuples.
+        """
+        metrics = self.metrics
+        for name, aggs, timestamp, value in values:
+            key = (name, aggs[0])
+            stored = metrics.get(key)
+            if stored is None:
+                stored = StoredMetric(aggs[0], self.retentions)
+                metrics.set(key, stored)
+            stored.add(timestamp, value)
+
+    def stats(self):
+        """
+        Returns counters describing the backend's internal state.
+        """
+        return {
+            'metrics': self.metrics.stats(),
+            'metric_cache': self.metric_cache.stats(),
+        }
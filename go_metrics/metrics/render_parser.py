@@ -0,0 +1,132 @@
+"""
+Incremental parser for graphite's json render responses.
+"""
+
+import json
+import re
+
+
+# The characters that can change the object nesting depth or start or end a
+# string. Datapoints contain none of these, so scanning a series only stops at
+# its target name and its enclosing braces.
+STRUCTURE_RE = re.compile(r'[{}"\\]')
+
+
+class RenderResponseParser(object):
+    """
+    Incrementally parses a graphite json render response of the form
+    ``[{"target": ..., "datapoints": [...]}, ...]``.
+
+    Data is given to :meth:`feed` as it arrives. As soon as a series has been
+    received in full, it is decoded and passed to
+    ``series_received(target, datapoints)``, and its text is discarded. Only
+    the text of the series currently being received is held in memory.
+
+    Errors encountered while parsing are raised by :meth:`finish`, which
+    should be called once the whole response has been fed to the parser.
+    """
+
+    def __init__(self, series_received):
+        self.series_received = series_received
+        self.container = None
+        self.error = None
+        self._closed = False
+        self._tail = ''
+        self._buffer = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+
+    def feed(self, data):
+        if self.error is not None:
+            return
+
+        try:
+            self._feed(data)
+        except Exception as e:
+            self.error = e
+            self._buffer = ''
+
+    def _feed(self, data):
+        if self.container is None:
+            data = data.lstrip()
+            if not data:
+                return
+            if data[0] not in '[{':
+                raise ValueError("Expected a json array or object")
+            self.container = data[0]
+            data = data[1:]
+
+        self._buffer += data
+
+        while True:
+            match = STRUCTURE_RE.search(self._buffer, self._pos)
+            if match is None:
+                break
+
+            char = match.group()
+            self._pos = match.end()
+
+            if char == '\\':
+                # Skip the escaped character, which may not have arrived yet.
+                self._pos += 1
+            elif char == '"':
+                self._in_string = not self._in_string
+            elif self._in_string:
+                continue
+            elif self._closed:
+                raise ValueError("Unexpected data after json response")
+            elif char == '{':
+                if self._depth == 0:
+                    # Discard the separators preceding this series.
+                    self._buffer = self._buffer[match.start():]
+                    self._pos = 1
+                self._depth += 1
+            elif self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._series_complete()
+            elif self.container == '{':
+                self._closed = True
+            else:
+                raise ValueError("Unbalanced braces in json response")
+
+        if self._depth == 0 and not self._in_string:
+            # Only separators remain, so keep just enough to check how the
+            # response ends.
+            self._tail = (self._tail + self._buffer[self._pos:].strip())[-1:]
+            self._buffer = ''
+            self._pos = 0
+
+    def _series_complete(self):
+        text = self._buffer[:self._pos]
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        self._tail = '}'
+
+        if self.container == '[':
+            series = json.loads(text)
+            try:
+                target, datapoints = series['target'], series['datapoints']
+            except (KeyError, TypeError):
+                raise ValueError("Invalid series in json response")
+            self.series_received(target, datapoints)
+
+    def finish(self):
+        """
+        Check that the response was received in full, raising any error
+        encountered while parsing it.
+        """
+        if self.error is not None:
+            raise self.error
+
+        if self.container is None:
+            raise ValueError("Empty json response")
+
+        if self.container == '[':
+            complete = self._tail == ']'
+        else:
+            complete = self._closed
+
+        if self._depth or self._in_string or not complete:
+            raise ValueError("Truncated json response")
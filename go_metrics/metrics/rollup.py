@@ -0,0 +1,249 @@
+"""
+Materialization of the results of the queries asked for most often, kept up
+to date in the background so that those queries are answered without
+waiting for graphite.
+"""
+
+import heapq
+
+from twisted.internet.defer import maybeDeferred
+
+from go_metrics.metrics.cache import LRUCache
+
+
+MISSING = object()
+
+
+class RollupMaterializer(object):
+    """
+    Tracks how often each query shape is asked for, and keeps the results of
+    the ``max_shapes`` shapes asked for most (at least ``min_requests``
+    times) materialized.
+
+    A shape is an ``(owner_id, name, from_offset, until_offset, interval)``
+    tuple: a metric queried over a time range given as offsets in seconds
+    from the current time, in buckets of ``interval`` seconds aligned to
+    multiples of the interval. Request counts are halved every
+    ``decay_interval`` seconds, so that shapes no longer asked for make way
+    for those that are. At most ``max_tracked`` shapes are counted at a time.
+
+    Each materialized shape is refreshed as soon as the set of buckets a
+    query for it would return changes, and otherwise at least every
+    ``max_age`` seconds, so that its partial buckets stay up to date. The
+    metrics are assumed to be stored at a resolution of ``step`` seconds,
+    which decides when the first bucket of the time range changes.
+
+    Shapes with the same owner, time range and interval are refreshed
+    together, in a single call to ``refresh(owner_id, params)`` with the
+    parameters for a query for their metrics over the absolute time range at
+    the time of the refresh. It should return a deferred firing with a dict
+    mapping metric names to :class:`Series`.
+
+    The materialized results are bounded to ``max_datapoints`` datapoints,
+    with the least recently used evicted first.
+    """
+
+    def __init__(self, refresh, clock, max_shapes, max_datapoints,
+                 min_requests, max_age, check_interval, decay_interval,
+                 max_tracked, step):
+        self.refresh = refresh
+        self.clock = clock
+        self.max_shapes = max_shapes
+        self.min_requests = min_requests
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.decay_interval = decay_interval
+        self.max_tracked = max_tracked
+        self.step = step
+        self.counts = {}
+        self.intervals = {}
+        self.admitted = set()
+        self.results = LRUCache(max_shapes, max_datapoints, clock=clock)
+        self.refresh_at = {}
+        self.refreshing = set()
+        self.next_decay = clock.seconds() + decay_interval
+        self.served = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.untracked = 0
+        self.running = True
+        self._delayed = None
+        self._schedule()
+
+    def record(self, shapes, interval):
+        """
+        Count a request for each of ``shapes``, queried with the interval
+        specifier ``interval``.
+        """
+        counts = self.counts
+        for shape in shapes:
+            count = counts.get(shape)
+            if count is None:
+                if len(counts) >= self.max_tracked:
+                    self.untracked += 1
+                    continue
+                self.intervals[shape] = interval
+                count = 0
+            counts[shape] = count + 1
+
+    def lookup(self, shapes):
+        """
+        Return a dict mapping the metric names of ``shapes`` to their
+        materialized :class:`Series`, or ``None`` unless all of them are
+        materialized and up to date. Metrics graphite returned nothing for
+        are left out, as they would be from graphite's response.
+        """
+        data = {}
+        for shape in shapes:
+            if shape not in self.admitted:
+                return None
+            series = self.results.get(shape, MISSING)
+            if series is MISSING:
+                return None
+            if series is not None:
+                data[shape[1]] = series
+
+        self.served += 1
+        return data
+
+    def _schedule(self):
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+        if not self.running:
+            return
+
+        now = self.clock.seconds()
+        times = [self.next_decay, now + self.check_interval]
+        times.extend(
+            self.refresh_at[shape] for shape in self.admitted
+            if shape in self.refresh_at and shape not in self.refreshing)
+        self._delayed = self.clock.callLater(
+            max(0, min(times) - now), self.tick)
+
+    def stop(self):
+        self.running = False
+        self._schedule()
+
+    def tick(self):
+        """
+        Decay the request counts if it is time to, admit the shapes asked
+        for most and refresh those that are due.
+        """
+        self._delayed = None
+        now = self.clock.seconds()
+        if now >= self.next_decay:
+            self._decay()
+            self.next_decay = now + self.decay_interval
+
+        self._admit()
+        self._refresh_due(now)
+        self._schedule()
+
+    def _decay(self):
+        for shape, count in self.counts.items():
+            if count > 1:
+                self.counts[shape] = count // 2
+            else:
+                del self.counts[shape]
+                del self.intervals[shape]
+
+    def _admit(self):
+        candidates = [
+            (count, shape) for shape, count in self.counts.iteritems()
+            if count >= self.min_requests]
+        admitted = set(
+            shape for _count, shape in heapq.nlargest(
+                self.max_shapes, candidates))
+
+        for shape in self.admitted - admitted:
+            self.results.discard(shape)
+            self.refresh_at.pop(shape, None)
+        self.admitted = admitted
+
+    def _refresh_due(self, now):
+        groups = {}
+        for shape in self.admitted:
+            if shape in self.refreshing:
+                continue
+            if self.refresh_at.get(shape, now) > now:
+                continue
+            owner_id, name, from_offset, until_offset, interval = shape
+            groups.setdefault(
+                (owner_id, from_offset, until_offset, interval), []).append(
+                    name)
+
+        for key, names in sorted(groups.iteritems()):
+            self._refresh(key, sorted(names), int(now))
+
+    def _refresh(self, key, names, now):
+        owner_id, from_offset, until_offset, interval = key
+        shapes = [
+            (owner_id, name, from_offset, until_offset, interval)
+            for name in names]
+        params = {
+            'm': names,
+            'from': str(now + from_offset),
+            'until': str(now + until_offset),
+            'interval': self.intervals[shapes[0]],
+        }
+
+        self.refreshes += 1
+        self.refreshing.update(shapes)
+        d = maybeDeferred(self.refresh, owner_id, params)
+        d.addCallback(self._refreshed, shapes, now)
+        d.addErrback(self._refresh_failed, shapes)
+
+    def _refreshed(self, data, shapes, now):
+        self.refreshing.difference_update(shapes)
+        _owner_id, _name, from_offset, until_offset, interval = shapes[0]
+
+        # The first datapoint of the time range is the first stored after
+        # its start, and the last is the last stored at or before its end.
+        # The results have the buckets a query would return until the
+        # bucket either of those falls in changes.
+        first = now + from_offset + self.step
+        last = now + until_offset
+        boundary = min(interval - t % interval for t in (first, last))
+        if boundary <= self.max_age:
+            expires_at = refresh_at = now + boundary
+        else:
+            expires_at = now + self.max_age
+            refresh_at = expires_at - min(
+                self.check_interval, self.max_age / 2.0)
+
+        ttl = expires_at - self.clock.seconds()
+        for shape in shapes:
+            if shape not in self.admitted:
+                continue
+            self.refresh_at[shape] = refresh_at
+            if ttl > 0:
+                series = data.get(shape[1])
+                cost = len(series) if series is not None else 0
+                self.results.set(shape, series, ttl=ttl, cost=max(1, cost))
+
+        self._schedule()
+
+    def _refresh_failed(self, failure, shapes):
+        self.refreshing.difference_update(shapes)
+        self.errors += 1
+        retry_at = self.clock.seconds() + self.check_interval
+        for shape in shapes:
+            if shape in self.admitted:
+                self.refresh_at[shape] = retry_at
+        self._schedule()
+
+    def stats(self):
+        """
+        Return a dict of counters describing the materialized shapes.
+        """
+        stats = self.results.stats()
+        stats.update({
+            'tracked': len(self.counts),
+            'untracked': self.untracked,
+            'admitted': len(self.admitted),
+            'served': self.served,
+            'refreshes': self.refreshes,
+            'errors': self.errors,
+        })
+        return stats
@@ -0,0 +1,199 @@
+"""
+Admission control and fair queuing of the queries made by the metrics
+backends.
+"""
+
+from collections import deque
+
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+
+from go_metrics.metrics.base import (
+    MetricsBackendBusyError, MetricsThrottledError)
+
+
+class QueuedQuery(object):
+    """
+    A query waiting for its turn to run.
+    """
+
+    __slots__ = ('cost', 'func', 'args', 'kw', 'd', 'queued_at')
+
+    def __init__(self, cost, func, args, kw, queued_at):
+        self.cost = cost
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.d = Deferred()
+        self.queued_at = queued_at
+
+
+class QueryScheduler(object):
+    """
+    Limits the number of queries running at once, both in total and for each
+    owner, queuing the rest and running them in a weighted fair order between
+    owners.
+
+    Queued queries are taken from each owner in turn using deficit round
+    robin: each time an owner's turn comes around, its allowance is increased
+    by ``quantum`` times its weight, and its queries are run for as long as
+    their costs fit within its allowance. An owner asking for many (or
+    expensive) queries therefore only delays the queries of other owners by
+    its fair share, regardless of how many it has queued.
+
+    :param int max_running:
+        The number of queries that may run at once across all owners.
+    :param int max_running_per_owner:
+        The number of queries that may run at once for a single owner.
+    :param int max_queued:
+        The number of queries that may be queued across all owners. Queries
+        made once this many are queued fail with
+        :class:`MetricsBackendBusyError`.
+    :param int max_queued_per_owner:
+        The number of queries that may be queued for a single owner. Queries
+        made once this many are queued for their owner fail with
+        :class:`MetricsThrottledError`.
+    :param int quantum:
+        The cost an owner with a weight of 1 may spend each turn. This and
+        the weights must be positive.
+    :param clock:
+        An object providing ``seconds()``.
+    :param dict weights:
+        A mapping of owner ids to their weights, for owners that should be
+        given a larger (or smaller) share than the default weight of 1.
+    """
+
+    def __init__(self, max_running, max_running_per_owner, max_queued,
+                 max_queued_per_owner, quantum, clock, weights=None):
+        # An owner whose allowance never grows would never get a turn, and
+        # the dispatch loop would spin forever waiting for it to.
+        assert quantum > 0, "quantum should be positive"
+        assert all(w > 0 for w in (weights or {}).itervalues()), (
+            "weights should be positive")
+        self.max_running = max_running
+        self.max_running_per_owner = max_running_per_owner
+        self.max_queued = max_queued
+        self.max_queued_per_owner = max_queued_per_owner
+        self.quantum = quantum
+        self.clock = clock
+        self.weights = weights or {}
+        self.running = 0
+        self.queued = 0
+        self.started = 0
+        self.rejected = 0
+        self.total_queue_time = 0
+        self.max_queue_time = 0
+        self._running = {}
+        self._queues = {}
+        self._deficits = {}
+        self._active = deque()
+        self._topped_up = False
+
+    def run(self, owner_id, cost, func, *args, **kw):
+        """
+        Call ``func(*args, **kw)`` for ``owner_id`` once there is room for it
+        to run, returning a :class:`Deferred` that fires with its result.
+        ``cost`` is the share of the owner's allowance the call uses up.
+        """
+        queue = self._queues.get(owner_id)
+
+        if queue is not None and len(queue) >= self.max_queued_per_owner:
+            self.rejected += 1
+            return fail(MetricsThrottledError(
+                "Too many queries queued for owner %r" % (owner_id,)))
+
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            return fail(MetricsBackendBusyError(
+                "Too many queries queued for metrics backend"))
+
+        if queue is None:
+            queue = self._queues[owner_id] = deque()
+            self._deficits[owner_id] = 0
+            self._active.append(owner_id)
+
+        query = QueuedQuery(cost, func, args, kw, self.clock.seconds())
+        queue.append(query)
+        self.queued += 1
+        self._dispatch()
+        return query.d
+
+    def _weight(self, owner_id):
+        return self.weights.get(owner_id, 1)
+
+    def _next_turn(self):
+        self._active.rotate(-1)
+        self._topped_up = False
+
+    def _dispatch(self):
+        # The number of owners passed over in a row because they already have
+        # as many queries running as they are allowed.
+        blocked = 0
+
+        while self.running < self.max_running and blocked < len(self._active):
+            owner_id = self._active[0]
+            if self._running.get(owner_id, 0) >= self.max_running_per_owner:
+                self._next_turn()
+                blocked += 1
+                continue
+
+            blocked = 0
+            queue = self._queues[owner_id]
+            if self._deficits[owner_id] < queue[0].cost:
+                if self._topped_up:
+                    self._next_turn()
+                else:
+                    self._deficits[owner_id] += (
+                        self.quantum * self._weight(owner_id))
+                    self._topped_up = True
+                continue
+
+            query = queue.popleft()
+            self._deficits[owner_id] -= query.cost
+            if not queue:
+                del self._queues[owner_id]
+                del self._deficits[owner_id]
+                self._active.popleft()
+                self._topped_up = False
+
+            self._start(owner_id, query)
+
+    def _start(self, owner_id, query):
+        queue_time = self.clock.seconds() - query.queued_at
+        self.queued -= 1
+        self.started += 1
+        self.total_queue_time += queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+        self.running += 1
+        self._running[owner_id] = self._running.get(owner_id, 0) + 1
+
+        d = maybeDeferred(query.func, *query.args, **query.kw)
+        d.addBoth(self._finished, owner_id)
+        d.chainDeferred(query.d)
+
+    def _finished(self, result, owner_id):
+        self.running -= 1
+        self._running[owner_id] -= 1
+        if not self._running[owner_id]:
+            del self._running[owner_id]
+        self._dispatch()
+        return result
+
+    def stats(self):
+        """
+        Return a dict of counters describing the scheduler's usage, including
+        the number of owners with queries running or queued. Queue times are
+        the number of seconds queries waited before starting.
+        """
+        owners = set(self._running)
+        owners.update(self._queues)
+
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'started': self.started,
+            'rejected': self.rejected,
+            'mean_queue_time': (
+                self.total_queue_time / self.started if self.started else 0),
+            'max_queue_time': self.max_queue_time,
+            'owners': len(owners),
+        }
@@ -0,0 +1,224 @@
+"""
+Compact columnar representation of metric time series.
+"""
+
+from array import array
+from bisect import bisect_left
+from itertools import compress, count, imap, izip
+from math import isnan
+
+
+NULL = float('nan')
+
+
+def is_null(value):
+    # NaN is the only value not equal to itself.
+    return value != value
+
+
+class Series(object):
+    """
+    A time series stored as parallel arrays of timestamps (in seconds) and
+    values, with null values stored as NaN.
+
+    Series are converted to the api's ``{"x": ..., "y": ...}`` form (with
+    timestamps in milliseconds) only when they are serialized.
+    """
+
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x=(), y=()):
+        self.x = x if isinstance(x, array) else array('l', x)
+        self.y = y if isinstance(y, array) else array('d', y)
+
+    @classmethod
+    def from_datapoints(cls, datapoints):
+        """
+        Create a series from graphite's ``[[value, timestamp], ...]`` form.
+        """
+        if not datapoints:
+            return cls()
+        ys, xs = zip(*datapoints)
+        return cls(xs, [NULL if y is None else y for y in ys])
+
+    def __len__(self):
+        return len(self.x)
+
+    def __eq__(self, other):
+        if not isinstance(other, Series):
+            return NotImplemented
+        return self.x == other.x and self.values() == other.values()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return '<Series x=%r y=%r>' % (self.x.tolist(), self.values())
+
+    def since(self, timestamp):
+        """
+        Return the part of the series at or after ``timestamp`` (in
+        seconds).
+        """
+        i = bisect_left(self.x, timestamp)
+        if i == 0:
+            return self
+        return Series(self.x[i:], self.y[i:])
+
+    def before(self, timestamp):
+        """
+        Return the part of the series before ``timestamp`` (in seconds).
+        """
+        i = bisect_left(self.x, timestamp)
+        if i == len(self.x):
+            return self
+        return Series(self.x[:i], self.y[:i])
+
+    def values(self):
+        """
+        Return a list of the series' values, with ``None`` for nulls.
+        """
+        return [None if y != y else y for y in self.y]
+
+    def to_points(self):
+        """
+        Return the series as a list of ``{"x": ..., "y": ...}`` dicts, with
+        timestamps in milliseconds.
+        """
+        return [{
+            'x': x * 1000,
+            'y': None if y != y else y,
+        } for x, y in izip(self.x, self.y)]
+
+    def to_columns(self):
+        """
+        Return the series as a dict of ``x`` and ``y`` lists, with timestamps
+        in milliseconds.
+        """
+        return {
+            'x': [x * 1000 for x in self.x],
+            'y': self.values(),
+        }
+
+
+def null_indices(values):
+    """
+    Return an iterator over the indices of the null values in an array of
+    values.
+
+    The checks are done by ``imap`` and the filtering by ``compress``, so the
+    only per-value work done in Python is for the nulls themselves.
+    """
+    return compress(count(), imap(isnan, values))
+
+
+def keep_nulls(series):
+    return series
+
+
+def omit_nulls(series):
+    # Copy the slices between the nulls rather than filtering value by value.
+    x, y = array('l'), array('d')
+    start = 0
+    for i in null_indices(series.y):
+        x.extend(series.x[start:i])
+        y.extend(series.y[start:i])
+        start = i + 1
+    if start == 0:
+        return series
+    x.extend(series.x[start:])
+    y.extend(series.y[start:])
+    return Series(x, y)
+
+
+def zeroize_nulls(series):
+    y = None
+    for i in null_indices(series.y):
+        if y is None:
+            y = series.y[:]
+        y[i] = 0.0
+    return series if y is None else Series(series.x, y)
+
+
+def ffill_nulls(series):
+    """
+    Replace each null with the closest preceding value. Nulls before the
+    first value are kept.
+    """
+    y = series.y[:]
+    for i in null_indices(series.y):
+        if i > 0:
+            y[i] = y[i - 1]
+    return Series(series.x, y)
+
+
+def bfill_nulls(series):
+    """
+    Replace each null with the closest following value. Nulls after the last
+    value are kept.
+    """
+    y = series.y[:]
+    last = len(y) - 1
+    for i in reversed(list(null_indices(series.y))):
+        if i < last:
+            y[i] = y[i + 1]
+    return Series(series.x, y)
+
+
+def null_runs(values):
+    """
+    Return an iterator over ``(first, last)`` index pairs for each run of
+    consecutive nulls in an array of values.
+    """
+    first = last = None
+    for i in null_indices(values):
+        if last is not None and i == last + 1:
+            last = i
+            continue
+        if first is not None:
+            yield first, last
+        first = last = i
+    if first is not None:
+        yield first, last
+
+
+def interpolate_nulls(series):
+    """
+    Replace each null between two values with a value linearly interpolated
+    between them according to the timestamps. Nulls before the first value or
+    after the last value are kept.
+    """
+    x, y = series.x, series.y[:]
+
+    for first, last in null_runs(series.y):
+        before, after = first - 1, last + 1
+        if before < 0 or after >= len(y):
+            continue
+        x0, y0 = x[before], y[before]
+        slope = (y[after] - y0) / float(x[after] - x0)
+        for i in xrange(first, after):
+            y[i] = y0 + slope * (x[i] - x0)
+
+    return Series(x, y)
+
+
+null_parsers = {
+    'keep': keep_nulls,
+    'omit': omit_nulls,
+    'zeroize': zeroize_nulls,
+    'ffill': ffill_nulls,
+    'bfill': bfill_nulls,
+    'linear': interpolate_nulls,
+}
+
+
+def json_default(obj):
+    """
+    Serializes :class:`Series` objects for :func:`json.dumps`.
+    """
+    if isinstance(obj, Series):
+        return obj.to_points()
+    raise TypeError("%r is not JSON serializable" % (obj,))
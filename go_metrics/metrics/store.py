@@ -0,0 +1,118 @@
+"""
+Fixed-size stores of fired metric values, kept in memory at one or more
+resolutions.
+"""
+
+from array import array
+
+from confmodel.errors import ConfigError
+
+from go_metrics.metrics.fire import Fold
+from go_metrics.metrics.graphite_time_parser import interval_to_seconds
+
+
+def parse_retention(retention):
+    """
+    Parse a retention of the form ``<resolution>:<duration>`` (for example,
+    ``1min:6h``) into a ``(step, size)`` tuple giving the number of seconds
+    per datapoint and the number of datapoints kept.
+    """
+    try:
+        step, duration = map(interval_to_seconds, retention.split(':'))
+    except (ValueError, TypeError):
+        raise ConfigError("Invalid retention %r" % (retention,))
+
+    if step <= 0 or duration < step:
+        raise ConfigError("Invalid retention %r" % (retention,))
+    return step, duration // step
+
+
+class RingBuffer(object):
+    """
+    The values fired for a metric at a single resolution, combined into one
+    datapoint per ``step`` seconds according to the metric's aggregator.
+    Only the most recent ``size`` datapoints are kept, with each new
+    datapoint taking the place of the datapoint ``size`` steps before it.
+    """
+
+    __slots__ = ('step', 'size', 'stamps', 'folds')
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.stamps = array('l', [-1]) * size
+        self.folds = [None] * size
+
+    @property
+    def retention(self):
+        return self.step * self.size
+
+    def add(self, timestamp, value):
+        timestamp -= timestamp % self.step
+        i = (timestamp // self.step) % self.size
+        stamp = self.stamps[i]
+
+        if stamp == timestamp:
+            self.folds[i].add(value)
+        elif stamp < timestamp:
+            self.stamps[i] = timestamp
+            self.folds[i] = Fold(value)
+        # Otherwise the value is too old to be kept at this resolution.
+
+    def fetch(self, from_time, until_time, aggregator):
+        """
+        Return the datapoints after ``from_time`` up to and including
+        ``until_time``, as a ``(start, values)`` tuple, where ``values`` holds
+        the values for each step from ``start`` onwards, or ``None`` for
+        steps without a value. As with whisper, the steps are aligned to
+        multiples of ``step``.
+        """
+        step = self.step
+        start = from_time - from_time % step + step
+        end = until_time - until_time % step + step
+
+        values = []
+        for timestamp in xrange(start, end, step):
+            i = (timestamp // step) % self.size
+            if self.stamps[i] == timestamp:
+                values.append(self.folds[i].value(aggregator))
+            else:
+                values.append(None)
+        return start, values
+
+
+class StoredMetric(object):
+    """
+    The values fired for a metric with a particular aggregator, kept at each
+    of the backend's configured resolutions.
+    """
+
+    __slots__ = ('aggregator', 'archives')
+
+    def __init__(self, aggregator, retentions):
+        self.aggregator = aggregator
+        self.archives = [
+            RingBuffer(step, size) for step, size in retentions]
+
+    def add(self, timestamp, value):
+        for archive in self.archives:
+            archive.add(timestamp, value)
+
+    def fetch(self, from_time, until_time, now):
+        """
+        Fetch the datapoints between ``from_time`` and ``until_time`` from
+        the highest resolution archive that covers the window (or the
+        longest archive, if none do), returning a ``(start, step, values)``
+        tuple.
+        """
+        for archive in self.archives:
+            if now - archive.retention <= from_time:
+                break
+
+        from_time = max(from_time, now - archive.retention)
+        until_time = min(until_time, now)
+        if until_time < from_time:
+            return from_time, archive.step, []
+
+        start, values = archive.fetch(from_time, until_time, self.aggregator)
+        return start, archive.step, values
@@ -0,0 +1,247 @@
+"""
+Streaming of newly closed metric buckets to subscribers, with a single
+refresh loop shared by every subscriber to the same metrics.
+"""
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python import log
+
+from go_metrics.metrics.base import (
+    BadMetricsQueryError, MetricsBackendBusyError)
+from go_metrics.metrics.graphite_time_parser import interval_to_seconds
+from go_metrics.metrics.series import null_parsers
+
+
+STREAM_PARAMS = ('m', 'interval', 'nulls')
+
+
+class Subscription(object):
+    """
+    A subscriber to a :class:`LiveQuery`. Events are passed to ``send`` as
+    ``(event_id, data)`` tuples. ``done`` fires once the subscription has
+    ended, whether it was closed by the hub or cancelled by the subscriber.
+    """
+
+    def __init__(self, live, send):
+        self.live = live
+        self.send = send
+        self.done = Deferred()
+        self.expiry = None
+
+
+class LiveQuery(object):
+    """
+    A refresh loop for a set of metrics owned by a single owner, queried at
+    a single interval.
+
+    The loop wakes up once each bucket has closed (and a further
+    ``settle_time`` seconds have passed, allowing for values that reach the
+    backend late), queries the backend for the buckets closed since it last
+    woke up, and sends them to each subscriber.
+    """
+
+    def __init__(self, hub, key, model, params, interval):
+        self.hub = hub
+        self.key = key
+        self.model = model
+        self.params = params
+        self.interval = interval
+        self.subscriptions = set()
+        now = int(hub.clock.seconds())
+        self.cursor = now - now % interval
+        self._delayed = None
+        self._schedule(self.cursor + interval + hub.settle_time - now)
+
+    def _schedule(self, delay):
+        self._delayed = self.hub.clock.callLater(max(0, delay), self.refresh)
+
+    def stop(self):
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+
+    def refresh(self):
+        self._delayed = None
+        hub = self.hub
+        now = int(hub.clock.seconds()) - hub.settle_time
+        end = now - now % self.interval
+        if end <= self.cursor:
+            self._schedule(self.cursor + self.interval - now)
+            return
+
+        hub.refreshes += 1
+        params = dict(self.params)
+        params['from'] = str(self.cursor - 1)
+        params['until'] = str(end - 1)
+        d = maybeDeferred(self.model.get, **params)
+        # Errors preparing the buckets are retried like errors fetching them.
+        d.addCallback(self._refreshed, end)
+        d.addErrback(self._refresh_failed)
+
+    def _refreshed(self, data, end):
+        # The backend's last bucket for the query can start at the end of
+        # the range queried, and isn't closed yet.
+        data = dict(
+            (name, series.before(end)) for name, series in data.iteritems())
+
+        self.cursor = end
+        for sub in list(self.subscriptions):
+            self.hub.events += 1
+            try:
+                sub.send(end * 1000, data)
+            except Exception:
+                # A subscriber that can't be written to (usually one whose
+                # connection has gone away) is dropped, so that it doesn't
+                # keep the buckets from the others.
+                log.err(None, "Failed to send metrics to stream subscriber")
+                self.hub.dropped += 1
+                self.hub.unsubscribe(sub)
+
+        if self.subscriptions:
+            self._schedule(
+                end + self.interval + self.hub.settle_time -
+                self.hub.clock.seconds())
+
+    def _refresh_failed(self, failure):
+        # The buckets are asked for again on the next attempt.
+        self.hub.errors += 1
+        if self.subscriptions:
+            self._schedule(self.hub.retry_interval)
+
+
+class StreamHub(object):
+    """
+    Tracks the :class:`LiveQuery` for each owner, set of metrics and
+    interval subscribed to, starting each when it gains its first subscriber
+    and stopping it when it loses its last.
+
+    Subscriptions are closed after ``max_age`` seconds, so that those left
+    open by subscribers that have gone away are cleaned up. Subscribers that
+    are still around are expected to reconnect.
+    """
+
+    def __init__(self, clock, settle_time, retry_interval, max_age,
+                 max_subscriptions):
+        self.clock = clock
+        self.settle_time = settle_time
+        self.retry_interval = retry_interval
+        self.max_age = max_age
+        self.max_subscriptions = max_subscriptions
+        self.live = {}
+        self.subscriptions = 0
+        self.refreshes = 0
+        self.events = 0
+        self.errors = 0
+        self.expired = 0
+        self.dropped = 0
+
+    def _parse_params(self, query):
+        unknown = set(query) - set(STREAM_PARAMS)
+        if unknown:
+            raise BadMetricsQueryError(
+                "Unsupported parameters for streamed metrics: %s" % (
+                    ', '.join(sorted(unknown)),))
+
+        metrics = query.get('m')
+        if not metrics:
+            raise BadMetricsQueryError("No metrics given to stream")
+        if isinstance(metrics, basestring):
+            metrics = [metrics]
+
+        interval = query.get('interval', '1hour')
+        try:
+            seconds = interval_to_seconds(interval)
+        except ValueError:
+            seconds = 0
+        if seconds <= 0:
+            raise BadMetricsQueryError(
+                "Invalid interval %r for streamed metrics" % (interval,))
+
+        nulls = query.get('nulls', 'zeroize')
+        if nulls not in null_parsers:
+            raise BadMetricsQueryError(
+                "Unrecognised null parser '%s'" % (nulls,))
+
+        params = {
+            'm': sorted(set(metrics)),
+            'interval': interval,
+            'nulls': nulls,
+            'format': 'points',
+        }
+        return params, seconds
+
+    def subscribe(self, model, query, send):
+        """
+        Subscribe to the metrics given by ``query`` (with the ``m``,
+        ``interval`` and ``nulls`` parameters accepted by the metrics
+        model's ``get``) for the owner of ``model``, returning a
+        :class:`Subscription`.
+        """
+        params, interval = self._parse_params(query)
+        if self.subscriptions >= self.max_subscriptions:
+            raise MetricsBackendBusyError(
+                "Too many metric streams are open, try again later")
+
+        key = (
+            model.owner_id, tuple(params['m']), interval, params['nulls'])
+        live = self.live.get(key)
+        if live is None:
+            live = self.live[key] = LiveQuery(
+                self, key, model, params, interval)
+
+        sub = Subscription(live, send)
+        live.subscriptions.add(sub)
+        self.subscriptions += 1
+        sub.expiry = self.clock.callLater(self.max_age, self._expire, sub)
+        return sub
+
+    def _expire(self, sub):
+        sub.expiry = None
+        self.expired += 1
+        self.unsubscribe(sub)
+
+    def unsubscribe(self, sub):
+        """
+        End the subscription ``sub``, stopping its :class:`LiveQuery` if it
+        has no subscribers left.
+        """
+        live = sub.live
+        if sub not in live.subscriptions:
+            return
+
+        live.subscriptions.remove(sub)
+        self.subscriptions -= 1
+        if sub.expiry is not None and sub.expiry.active():
+            sub.expiry.cancel()
+        sub.expiry = None
+
+        if not live.subscriptions:
+            live.stop()
+            del self.live[live.key]
+
+        sub.done.callback(None)
+
+    def close(self):
+        """
+        End every subscription.
+        """
+        for live in self.live.values():
+            for sub in list(live.subscriptions):
+                self.unsubscribe(sub)
+
+    def stats(self):
+        """
+        Return a dict of counters describing the streams, including the
+        number of subscribers to each refresh loop.
+        """
+        return {
+            'live': len(self.live),
+            'subscriptions': self.subscriptions,
+            'refreshes': self.refreshes,
+            'events': self.events,
+            'errors': self.errors,
+            'expired': self.expired,
+            'dropped': self.dropped,
+            'fanout': sorted(
+                len(live.subscriptions) for live in self.live.itervalues()),
+        }
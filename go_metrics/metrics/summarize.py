@@ -0,0 +1,64 @@
+"""
+Local equivalent of graphite's ``summarize()`` render function, for backends
+that read stored datapoints themselves rather than querying graphite.
+"""
+
+from go_metrics.metrics.series import NULL, Series
+
+
+def _avg(values):
+    return float(sum(values)) / len(values)
+
+
+def _last(values):
+    return values[-1]
+
+
+aggregators = {
+    'sum': sum,
+    'avg': _avg,
+    'max': max,
+    'min': min,
+    'last': _last,
+}
+
+
+def summarize(start, step, values, interval, aggregator, align_to_from):
+    """
+    Summarize ``values``, a list of values (with ``None`` for missing
+    values) at timestamps ``start``, ``start + step``, ..., into buckets of
+    ``interval`` seconds using the named ``aggregator``, returning a
+    :class:`Series` of the bucketed values.
+
+    This follows graphite's ``summarize()``: buckets are aligned to multiples
+    of ``interval`` unless ``align_to_from`` is set, in which case they start
+    at ``start``, and buckets without any values are null.
+    """
+    func = aggregators[aggregator]
+    n = len(values)
+    end = start + n * step
+
+    if align_to_from:
+        new_start = start
+        new_end = end
+    else:
+        new_start = start - start % interval
+        new_end = end - end % interval + interval
+
+    if interval == step and new_start == start:
+        # Each bucket holds exactly one of the values.
+        ys = [NULL if value is None else value for value in values]
+        ys.extend([NULL] * ((new_end - end) // step))
+        return Series(xrange(new_start, new_end, interval), ys)
+
+    # The values are in timestamp order, so each bucket's values are a
+    # contiguous slice of them.
+    xs = range(new_start, new_end, interval)
+    ys = []
+    for timestamp in xs:
+        lo = min(max(-((start - timestamp) // step), 0), n)
+        hi = min(max(-((start - timestamp - interval) // step), 0), n)
+        bucket = [value for value in values[lo:hi] if value is not None]
+        ys.append(func(bucket) if bucket else NULL)
+
+    return Series(xs, ys)
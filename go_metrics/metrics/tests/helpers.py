@@ -0,0 +1,85 @@
+"""
+Helpers for the metrics backend tests.
+"""
+
+import os
+
+from go_metrics.metrics.fire import Fold
+from go_metrics.metrics.series import Series
+from go_metrics.metrics.whisper import ARCHIVE_INFO, METADATA, POINT
+
+
+# Whisper's codes for its aggregation methods.
+WHISPER_AGGREGATIONS = {
+    'avg': 1,
+    'sum': 2,
+    'last': 3,
+    'max': 4,
+    'min': 5,
+}
+
+
+def points(data):
+    """
+    Convert the series in a query result to the api's points form.
+    """
+    return dict(
+        (target, series.to_points()) for target, series in data.iteritems())
+
+
+def mk_series(*values):
+    """
+    Return a :class:`Series` of ``values`` at 10 second intervals from 0.
+    """
+    return Series(range(0, 10 * len(values), 10), values)
+
+
+def write_whisper(path, archives, datapoints, aggregator='avg'):
+    """
+    Write a whisper file to ``path`` with the given ``archives``, a list of
+    ``(seconds_per_point, points)`` tuples, containing ``datapoints``, a
+    list of ``(timestamp, value)`` tuples. The datapoints are combined into
+    each archive's resolution using ``aggregator``, as carbon would.
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    header_size = METADATA.size + ARCHIVE_INFO.size * len(archives)
+    offsets = []
+    offset = header_size
+    for step, points in archives:
+        offsets.append(offset)
+        offset += points * POINT.size
+
+    data = bytearray(offset)
+    max_retention = max(step * points for step, points in archives)
+    METADATA.pack_into(
+        data, 0, WHISPER_AGGREGATIONS[aggregator], max_retention, 0.5,
+        len(archives))
+
+    for i, ((step, points), offset) in enumerate(zip(archives, offsets)):
+        ARCHIVE_INFO.pack_into(
+            data, METADATA.size + i * ARCHIVE_INFO.size, offset, step, points)
+
+        folds = {}
+        for timestamp, value in datapoints:
+            timestamp -= timestamp % step
+            if timestamp in folds:
+                folds[timestamp].add(value)
+            else:
+                folds[timestamp] = Fold(value)
+
+        # As with whisper, points are placed relative to the point at the
+        # start of the archive.
+        timestamps = sorted(folds)[-points:]
+        if timestamps:
+            base = timestamps[0]
+            for timestamp in timestamps:
+                position = ((timestamp - base) // step) % points
+                POINT.pack_into(
+                    data, offset + position * POINT.size, timestamp,
+                    folds[timestamp].value(aggregator))
+
+    with open(path, 'wb') as f:
+        f.write(data)
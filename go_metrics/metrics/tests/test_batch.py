@@ -0,0 +1,118 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.batch import RenderBatcher
+
+
+class TestRenderBatcher(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.renders = []
+
+    def render(self, targets, from_time, until_time):
+        d = Deferred()
+        self.renders.append((targets, from_time, until_time, d))
+        return d
+
+    def mk_batcher(self, window=0.1, max_targets=100):
+        return RenderBatcher(self.render, window, max_targets, self.clock)
+
+    def test_submit(self):
+        batcher = self.mk_batcher()
+        d1 = batcher.submit('-1d', 'now', [
+            ('a.last', "summarize(o1.a.last, '1h', 'last', false)"),
+            ('b.max', "summarize(o1.b.max, '1h', 'max', false)")])
+        d2 = batcher.submit('-1d', 'now', [
+            ('a.last', "summarize(o2.a.last, '1h', 'last', false)")])
+
+        self.assertEqual(self.renders, [])
+        self.clock.advance(0.1)
+
+        [(targets, from_time, until_time, render_d)] = self.renders
+        self.assertEqual(targets, [
+            "alias(summarize(o1.a.last, '1h', 'last', false), '0')",
+            "alias(summarize(o1.b.max, '1h', 'max', false), '1')",
+            "alias(summarize(o2.a.last, '1h', 'last', false), '2')",
+        ])
+        self.assertEqual((from_time, until_time), ('-1d', 'now'))
+
+        render_d.callback({
+            '0': [{'x': 5000, 'y': 1.0}],
+            '1': [{'x': 5000, 'y': 2.0}],
+            '2': [{'x': 5000, 'y': 3.0}],
+        })
+        self.assertEqual(self.successResultOf(d1), {
+            'a.last': [{'x': 5000, 'y': 1.0}],
+            'b.max': [{'x': 5000, 'y': 2.0}],
+        })
+        self.assertEqual(self.successResultOf(d2), {
+            'a.last': [{'x': 5000, 'y': 3.0}],
+        })
+
+    def test_submit_shared_targets(self):
+        batcher = self.mk_batcher()
+        target = "summarize(o1.a.last, '1h', 'last', false)"
+        d1 = batcher.submit('-1d', 'now', [('a.last', target)])
+        d2 = batcher.submit('-1d', 'now', [('a.last', target)])
+        self.clock.advance(0.1)
+
+        [(targets, _, _, render_d)] = self.renders
+        self.assertEqual(targets, ["alias(%s, '0')" % (target,)])
+
+        render_d.callback({'0': [{'x': 5000, 'y': 1.0}]})
+        expected = {'a.last': [{'x': 5000, 'y': 1.0}]}
+        self.assertEqual(self.successResultOf(d1), expected)
+        self.assertEqual(self.successResultOf(d2), expected)
+
+    def test_submit_different_time_ranges(self):
+        batcher = self.mk_batcher()
+        batcher.submit('-1d', 'now', [('a', 'foo')])
+        batcher.submit('-2d', 'now', [('a', 'foo')])
+        self.clock.advance(0.1)
+        self.assertEqual(
+            sorted((r[1], r[2]) for r in self.renders),
+            [('-1d', 'now'), ('-2d', 'now')])
+
+    def test_submit_max_targets(self):
+        batcher = self.mk_batcher(max_targets=2)
+        batcher.submit('-1d', 'now', [('a', 'foo')])
+        self.assertEqual(self.renders, [])
+        batcher.submit('-1d', 'now', [('b', 'bar')])
+        self.assertEqual(len(self.renders), 1)
+
+        # The flushed batch's delayed call was cancelled.
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.renders), 1)
+
+    def test_submit_no_targets(self):
+        batcher = self.mk_batcher()
+        d = batcher.submit('-1d', 'now', [])
+        self.assertEqual(self.successResultOf(d), {})
+        self.assertEqual(batcher.requests, 0)
+
+    def test_submit_failure(self):
+        batcher = self.mk_batcher()
+        d1 = batcher.submit('-1d', 'now', [('a', 'foo')])
+        d2 = batcher.submit('-1d', 'now', [('b', 'bar')])
+        self.clock.advance(0.1)
+
+        [(_, _, _, render_d)] = self.renders
+        render_d.errback(ValueError(':('))
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+    def test_stats(self):
+        batcher = self.mk_batcher()
+        batcher.submit('-1d', 'now', [('a', 'foo'), ('b', 'bar')])
+        batcher.submit('-1d', 'now', [('a', 'baz')])
+        self.assertEqual(batcher.stats()['pending'], 1)
+        self.clock.advance(0.1)
+
+        self.assertEqual(batcher.stats(), {
+            'requests': 2,
+            'batches': 1,
+            'targets': 3,
+            'max_batch_targets': 3,
+            'pending': 0,
+        })
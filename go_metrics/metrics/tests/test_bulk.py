@@ -0,0 +1,46 @@
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.base import BadMetricsQueryError
+from go_metrics.metrics.bulk import iter_lines, iter_records
+
+
+class TestIterLines(TestCase):
+    def test_iter_lines(self):
+        self.assertEqual(
+            list(iter_lines('a\n\n  b \r\nc')),
+            [(1, 'a'), (3, 'b'), (4, 'c')])
+
+    def test_iter_lines_trailing_newline(self):
+        self.assertEqual(list(iter_lines('a\nb\n')), [(1, 'a'), (2, 'b')])
+
+    def test_iter_lines_empty(self):
+        self.assertEqual(list(iter_lines('')), [])
+
+
+class TestIterRecords(TestCase):
+    def test_ndjson(self):
+        self.assertEqual(
+            list(iter_records(
+                '{"name": "foo.sum", "value": 1}\n'
+                'bar\n'
+                '\n'
+                '{"name": "bar.avg", "value": 2, "timestamp": 5}\n')),
+            [
+                (1, {'name': 'foo.sum', 'value': 1}, None),
+                (2, None, "Invalid json"),
+                (4, {'name': 'bar.avg', 'value': 2, 'timestamp': 5}, None),
+            ])
+
+    def test_json_array(self):
+        self.assertEqual(
+            list(iter_records(
+                ' [{"name": "foo.sum", "value": 1}, "bar"]')),
+            [
+                (1, {'name': 'foo.sum', 'value': 1}, None),
+                (2, 'bar', None),
+            ])
+
+    def test_json_array_invalid(self):
+        err = self.assertRaises(
+            BadMetricsQueryError, list, iter_records('[{"name": '))
+        self.assertEqual(str(err), "Invalid json array of records")
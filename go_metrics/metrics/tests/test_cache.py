@@ -0,0 +1,104 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def mk_cache(self, max_entries=10, max_cost=None):
+        self.clock = Clock()
+        return LRUCache(max_entries, max_cost, clock=self.clock)
+
+    def test_get_set(self):
+        cache = self.mk_cache()
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('foo', 'default'), 'default')
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), 'bar')
+        self.assertEqual(len(cache), 1)
+
+    def test_set_replace(self):
+        cache = self.mk_cache()
+        cache.set('foo', 'bar', cost=3)
+        cache.set('foo', 'baz', cost=2)
+        self.assertEqual(cache.get('foo'), 'baz')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.cost, 2)
+
+    def test_ttl(self):
+        cache = self.mk_cache()
+        cache.set('foo', 'bar', ttl=10)
+        cache.set('baz', 'quux')
+        self.clock.advance(9)
+        self.assertEqual(cache.get('foo'), 'bar')
+        self.clock.advance(1)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('baz'), 'quux')
+        self.assertEqual(len(cache), 1)
+
+    def test_lru_eviction(self):
+        cache = self.mk_cache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_cost_eviction(self):
+        cache = self.mk_cache(max_cost=10)
+        cache.set('a', 1, cost=4)
+        cache.set('b', 2, cost=4)
+        cache.set('c', 3, cost=4)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.cost, 8)
+
+    def test_too_costly(self):
+        cache = self.mk_cache(max_cost=10)
+        cache.set('a', 1, cost=4)
+        cache.set('b', 2, cost=11)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+
+    def test_disabled(self):
+        cache = self.mk_cache(max_entries=0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        cache = self.mk_cache()
+        cache.set('a', 1, cost=3)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.cost, 0)
+
+    def test_discard(self):
+        cache = self.mk_cache()
+        cache.set('a', 1, cost=3)
+        cache.set('b', 2)
+        cache.discard('a')
+        cache.discard('c')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.cost, 1)
+
+    def test_stats(self):
+        cache = self.mk_cache(max_entries=1)
+        cache.set('a', 1, cost=3)
+        cache.get('a')
+        cache.get('b')
+        cache.get('a')
+        cache.set('b', 2)
+        self.assertEqual(cache.stats(), {
+            'size': 1,
+            'cost': 1,
+            'hits': 2,
+            'misses': 1,
+            'evictions': 1,
+            'hit_ratio': 2 / 3.0,
+        })
@@ -0,0 +1,69 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.coalesce import RequestCoalescer
+
+
+class TestRequestCoalescer(TestCase):
+    def test_run(self):
+        coalescer = RequestCoalescer()
+        d = coalescer.run('foo', lambda x: x * 2, 21)
+        self.assertEqual(self.successResultOf(d), 42)
+        self.assertEqual(coalescer.waiters('foo'), 0)
+
+    def test_run_concurrent(self):
+        coalescer = RequestCoalescer()
+        calls = []
+
+        def call(x):
+            calls.append(x)
+            return calls_d
+
+        calls_d = Deferred()
+        d1 = coalescer.run('foo', call, 1)
+        d2 = coalescer.run('foo', call, 2)
+        d3 = coalescer.run('bar', lambda: succeed('baz'))
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(coalescer.waiters('foo'), 2)
+        self.assertEqual(self.successResultOf(d3), 'baz')
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+
+        calls_d.callback('quux')
+        self.assertEqual(self.successResultOf(d1), 'quux')
+        self.assertEqual(self.successResultOf(d2), 'quux')
+        self.assertEqual(coalescer.waiters('foo'), 0)
+
+        # Once the outstanding call completes, new calls start afresh.
+        coalescer.run('foo', call, 4)
+        self.assertEqual(calls, [1, 4])
+
+    def test_run_failure(self):
+        coalescer = RequestCoalescer()
+        calls_d = Deferred()
+        d1 = coalescer.run('foo', lambda: calls_d)
+        d2 = coalescer.run('foo', lambda: calls_d)
+        calls_d.errback(ValueError(':('))
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+    def test_stats(self):
+        coalescer = RequestCoalescer()
+        calls_d = Deferred()
+        coalescer.run('foo', lambda: calls_d)
+        coalescer.run('foo', lambda: calls_d)
+        coalescer.run('foo', lambda: calls_d)
+        coalescer.run('bar', lambda: 'baz')
+
+        self.assertEqual(coalescer.stats(), {
+            'requests': 4,
+            'coalesced': 2,
+            'max_waiters': 3,
+            'pending': 1,
+            'waiters': 3,
+        })
+
+        calls_d.callback(None)
+        self.assertEqual(coalescer.stats()['pending'], 0)
+        self.assertEqual(coalescer.stats()['waiters'], 0)
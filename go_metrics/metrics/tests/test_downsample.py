@@ -0,0 +1,80 @@
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.downsample import bucket_bounds, lttb, minmax
+from go_metrics.metrics.series import Series, NULL
+from go_metrics.metrics.tests.helpers import mk_series
+
+
+class TestBucketBounds(TestCase):
+    def test_bucket_bounds(self):
+        self.assertEqual(
+            bucket_bounds(1, 9, 3), [(1, 3), (3, 6), (6, 9)])
+
+    def test_bucket_bounds_even(self):
+        self.assertEqual(
+            bucket_bounds(0, 6, 3), [(0, 2), (2, 4), (4, 6)])
+
+
+class TestLttb(TestCase):
+    def test_small_series(self):
+        series = mk_series(1.0, 2.0, 3.0)
+        self.assertTrue(lttb(series, 3) is series)
+
+    def test_keeps_ends(self):
+        self.assertEqual(
+            lttb(mk_series(1.0, 5.0, 2.0, 3.0), 2),
+            Series([0, 30], [1.0, 3.0]))
+
+    def test_keeps_peaks(self):
+        series = mk_series(0.0, 0.0, 9.0, 0.0, 0.0, 0.0, -9.0, 0.0, 0.0)
+        self.assertEqual(
+            lttb(series, 4),
+            Series([0, 20, 60, 80], [0.0, 9.0, -9.0, 0.0]))
+
+    def test_max_points(self):
+        series = mk_series(*[float(i % 7) for i in range(1000)])
+        result = lttb(series, 100)
+        self.assertEqual(len(result), 100)
+        self.assertEqual(result.x[0], 0)
+        self.assertEqual(result.x[-1], 9990)
+        self.assertEqual(list(result.x), sorted(result.x))
+
+    def test_nulls(self):
+        series = mk_series(0.0, NULL, 5.0, NULL, NULL, 1.0, NULL)
+        self.assertEqual(
+            lttb(series, 4),
+            Series([0, 20, 50, 60], [0.0, 5.0, 1.0, NULL]))
+
+
+class TestMinMax(TestCase):
+    def test_small_series(self):
+        series = mk_series(1.0, 2.0, 3.0)
+        self.assertTrue(minmax(series, 3) is series)
+
+    def test_keeps_min_and_max_in_order(self):
+        series = mk_series(1.0, 5.0, 0.0, 2.0, 3.0, 9.0, 4.0, 1.0)
+        self.assertEqual(
+            minmax(series, 4),
+            Series([10, 20, 50, 70], [5.0, 0.0, 9.0, 1.0]))
+
+    def test_max_points(self):
+        series = mk_series(*[float(i % 7) for i in range(1000)])
+        result = minmax(series, 100)
+        self.assertEqual(len(result), 100)
+        self.assertEqual(list(result.x), sorted(result.x))
+
+    def test_constant_bucket(self):
+        series = mk_series(2.0, 2.0, 2.0, 2.0)
+        self.assertEqual(
+            minmax(series, 2), Series([0], [2.0]))
+
+    def test_nulls(self):
+        series = mk_series(NULL, NULL, 3.0, NULL, 1.0, 2.0)
+        self.assertEqual(
+            minmax(series, 4),
+            Series([20, 40, 50], [3.0, 1.0, 2.0]))
+
+    def test_null_bucket(self):
+        series = mk_series(NULL, NULL, 3.0, 1.0, 2.0)
+        self.assertEqual(
+            minmax(series, 4), Series([0, 20, 30], [NULL, 3.0, 1.0]))
@@ -0,0 +1,187 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.fire import Fold, FireBuffer
+
+
+class TestFold(TestCase):
+    def test_value(self):
+        fold = Fold(2.0)
+        fold.add(7.0)
+        fold.add(3.0)
+        self.assertEqual(fold.value('sum'), 12.0)
+        self.assertEqual(fold.value('avg'), 4.0)
+        self.assertEqual(fold.value('max'), 7.0)
+        self.assertEqual(fold.value('min'), 2.0)
+        self.assertEqual(fold.value('last'), 3.0)
+
+    def test_single_value(self):
+        fold = Fold(2.0)
+        for agg in ('sum', 'avg', 'max', 'min', 'last'):
+            self.assertEqual(fold.value(agg), 2.0)
+
+
+class TestFireBuffer(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.published = []
+
+    def publish(self, datapoints):
+        self.published.append(datapoints)
+
+    def mk_buffer(self, max_size=100, max_delay=1):
+        return FireBuffer(self.publish, max_size, max_delay, self.clock)
+
+    def test_add(self):
+        buf = self.mk_buffer()
+        buf.add([('a', ('sum',), 0, 1.0), ('b', ('avg',), 0, 2.0)])
+        self.clock.advance(0.5)
+        buf.add([('a', ('sum',), 0, 3.0)])
+        self.assertEqual(len(buf), 3)
+        self.assertEqual(self.published, [])
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.published, [[
+            ('a', ('sum',), [(0, 1.0), (0, 3.0)]),
+            ('b', ('avg',), [(0, 2.0)]),
+        ]])
+        self.assertEqual(len(buf), 0)
+
+    def test_add_empty(self):
+        buf = self.mk_buffer()
+        self.successResultOf(buf.add([]))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_add_full(self):
+        buf = self.mk_buffer(max_size=2)
+        buf.add([('a', ('sum',), 0, 1.0)])
+        self.assertEqual(self.published, [])
+
+        buf.add([('a', ('sum',), 0, 2.0)])
+        self.assertEqual(self.published, [[
+            ('a', ('sum',), [(0, 1.0), (0, 2.0)]),
+        ]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_add_no_delay(self):
+        buf = self.mk_buffer(max_delay=0)
+        buf.add([('a', ('sum',), 0, 1.0)])
+        self.assertEqual(self.published, [[('a', ('sum',), [(0, 1.0)])]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_add_waits_for_publish(self):
+        d = Deferred()
+        buf = FireBuffer(lambda datapoints: d, 1, 1, self.clock)
+        add_d = buf.add([('a', ('sum',), 0, 1.0)])
+        self.assertNoResult(add_d)
+        d.callback(None)
+        self.successResultOf(add_d)
+
+    def test_flush(self):
+        buf = self.mk_buffer()
+        buf.add([('a', ('sum',), 0, 1.0)])
+        self.successResultOf(buf.flush())
+        self.assertEqual(self.published, [[('a', ('sum',), [(0, 1.0)])]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_flush_empty(self):
+        buf = self.mk_buffer()
+        self.successResultOf(buf.flush())
+        self.assertEqual(self.published, [])
+
+    def test_stats(self):
+        buf = self.mk_buffer(max_size=3)
+        self.assertEqual(buf.stats(), {
+            'buffered': 0,
+            'values': 0,
+            'folded': 0,
+            'flushes': 0,
+            'failed_flushes': 0,
+            'max_batch_size': 0,
+            'last_flush_latency': None,
+            'max_flush_latency': 0,
+        })
+
+        buf.add([('a', ('sum',), 0, 1.0), ('b', ('sum',), 0, 1.0)])
+        self.clock.advance(0.25)
+        buf.add([('a', ('sum',), 0, 1.0)])
+        buf.add([('a', ('sum',), 0, 1.0)])
+        self.clock.advance(1)
+
+        self.assertEqual(buf.stats(), {
+            'buffered': 0,
+            'values': 4,
+            'folded': 0,
+            'flushes': 2,
+            'failed_flushes': 0,
+            'max_batch_size': 3,
+            'last_flush_latency': 1,
+            'max_flush_latency': 1,
+        })
+
+    def test_delayed_flush_failed(self):
+        def publish(datapoints):
+            raise ValueError("Oops")
+
+        buf = FireBuffer(publish, 100, 1, self.clock)
+        buf.add([('a', ('sum',), 0, 1.0)])
+        self.clock.advance(1)
+
+        self.assertEqual(buf.stats()['flushes'], 1)
+        self.assertEqual(buf.stats()['failed_flushes'], 1)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_aggregate(self):
+        buf = FireBuffer(self.publish, 100, 1, self.clock, aggregate=True)
+        buf.add([
+            ('a', ('sum',), 0, 1.0),
+            ('b', ('avg',), 0, 2.0),
+            ('a', ('sum',), 0, 3.0),
+        ])
+        buf.add([
+            ('b', ('avg',), 0, 5.0),
+            ('b', ('avg',), 0, 8.0),
+            ('b', ('avg',), 1, 4.0),
+            ('c', ('last',), 1, 4.0),
+            ('c', ('last',), 1, 3.0),
+        ])
+        self.assertEqual(len(buf), 6)
+
+        self.clock.advance(1)
+        self.assertEqual(self.published, [[
+            ('a', ('sum',), [(0, 4.0)]),
+            ('b', ('avg',), [(0, 2.0), (0, 5.0), (0, 8.0), (1, 4.0)]),
+            ('c', ('last',), [(1, 3.0)]),
+        ]])
+        self.assertEqual(buf.stats()['values'], 8)
+        self.assertEqual(buf.stats()['folded'], 2)
+
+    def test_aggregate_keeps_averages(self):
+        values = [('a', ('avg',), 0, float(i)) for i in range(9)]
+        values.append(('a', ('avg',), 1, 100.0))
+
+        def stored_average(aggregate):
+            self.published = []
+            buf = FireBuffer(
+                self.publish, 100, 1, self.clock, aggregate=aggregate)
+            buf.add(values)
+            self.clock.advance(1)
+            # The aggregator downstream averages the datapoints in a bucket
+            # with equal weight.
+            [[(_name, _aggs, points)]] = self.published
+            return sum(v for _t, v in points) / len(points)
+
+        self.assertEqual(stored_average(True), stored_average(False))
+        self.assertEqual(stored_average(True), 13.6)
+
+    def test_aggregate_full(self):
+        buf = FireBuffer(self.publish, 2, 1, self.clock, aggregate=True)
+        buf.add([('a', ('sum',), 0, 1.0)] * 10)
+        self.assertEqual(self.published, [])
+
+        buf.add([('b', ('sum',), 0, 1.0)])
+        self.assertEqual(self.published, [[
+            ('a', ('sum',), [(0, 10.0)]),
+            ('b', ('sum',), [(0, 1.0)]),
+        ]])
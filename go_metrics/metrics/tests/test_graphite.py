@@ -1,17 +1,28 @@
 import json
 from base64 import b64encode
+from datetime import datetime
 
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import MemoryReactorClock
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    Deferred, DeferredList, DeferredQueue, inlineCallbacks, returnValue)
+from twisted.web.server import NOT_DONE_YET
 
 from confmodel.errors import ConfigError
 
 from go_api.cyclone.helpers import MockHttpServer
 
 import go_metrics.metrics.graphite
-from go_metrics.metrics.base import MetricsBackendError, BadMetricsQueryError
+from go_metrics.metrics.base import (
+    MetricsBackendError, BadMetricsQueryError, MetricsThrottledError)
+from go_metrics.metrics.bulk import iter_records
 from go_metrics.metrics.graphite import (
-    GraphiteMetrics, GraphiteBackend, GraphiteBackendConfig, MetricWorker)
+    CompiledMetric, GraphiteMetrics, GraphiteBackend, GraphiteBackendConfig,
+    MetricWorker)
+from go_metrics.metrics.tests.helpers import points
+
+from vumi.blinkenlights.metrics import LAST, SUM
 
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
 
@@ -39,6 +50,26 @@ class DummyWorkerCreator(object):
         return self._worker
 
 
+class TestCompiledMetric(TestCase):
+    def test_target(self):
+        metric = CompiledMetric('a.last', LAST, 'go.o1.a.last', 'go.o1.a')
+        self.assertEqual(
+            metric.target('1h', 'false'),
+            "summarize(go.o1.a.last, '1h', 'last', false)")
+
+    def test_aliased_target(self):
+        metric = CompiledMetric('a.last', LAST, 'go.o1.a.last', 'go.o1.a')
+        self.assertEqual(
+            metric.aliased_target('1h', 'false'),
+            "alias(summarize(go.o1.a.last, '1h', 'last', false), 'a.last')")
+
+    def test_target_percent(self):
+        metric = CompiledMetric('a%s.sum', SUM, 'go.o1.a%s.sum', 'go.o1.a%s')
+        self.assertEqual(
+            metric.target('1h', 'true'),
+            "summarize(go.o1.a%s.sum, '1h', 'sum', true)")
+
+
 class TestGraphiteMetrics(VumiTestCase):
 
     def setUp(self):
@@ -56,7 +87,7 @@ class TestGraphiteMetrics(VumiTestCase):
         returnValue(graphite)
 
     @inlineCallbacks
-    def mk_backend(self, **kw):
+    def mk_backend(self, clock=None, **kw):
         kw.setdefault('persistent', False)
         prefix = kw.setdefault('prefix', 'go.campaigns')
         worker = yield self.get_worker({'prefix': prefix}, MetricWorker)
@@ -66,6 +97,9 @@ class TestGraphiteMetrics(VumiTestCase):
         self.patch(
             go_metrics.metrics.graphite, 'WorkerCreator', worker_creator_cls)
 
+        if clock is not None:
+            self.patch(GraphiteBackend, 'get_clock', lambda self: clock)
+
         backend = GraphiteBackend(kw)
         self.addCleanup(backend.teardown)
         returnValue(backend)
@@ -188,7 +222,8 @@ class TestGraphiteMetrics(VumiTestCase):
         backend = yield self.mk_backend(graphite_url=graphite.url)
         metrics = GraphiteMetrics(backend, 'owner-1')
 
-        data = yield metrics.get(m=['stores.a.b.last', 'stores.b.a.max'])
+        data = points((yield metrics.get(
+            m=['stores.a.b.last', 'stores.b.a.max'])))
 
         self.assertEqual(data, {
             'stores.a.b.last': [{
@@ -207,6 +242,138 @@ class TestGraphiteMetrics(VumiTestCase):
             }]
         })
 
+    @inlineCallbacks
+    def test_get_streamed_response(self):
+        def handler(req):
+            req.write('[{"target": "stores.a.b.last", "datapoints": [')
+            req.write('[5.0, 5695], [10.0, 5700]]}, {"target": "stores.b.')
+            req.write('a.max", "datapoints": [[12.0, 3724]]}]')
+            req.finish()
+            return NOT_DONE_YET
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        data = points((yield metrics.get(
+            m=['stores.a.b.last', 'stores.b.a.max'])))
+
+        self.assertEqual(data, {
+            'stores.a.b.last': [
+                {'x': 5695000, 'y': 5.0},
+                {'x': 5700000, 'y': 10.0}],
+            'stores.b.a.max': [
+                {'x': 3724000, 'y': 12.0}],
+        })
+
+    @inlineCallbacks
+    def test_get_invalid_response(self):
+        def handler(req):
+            return '[{"target": "stores.a.b.last", "datapoints": ['
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        err = yield self.assertFailure(
+            metrics.get(m=['stores.a.b.last']), ValueError)
+        self.assertEqual(str(err), "Truncated json response")
+
+    @inlineCallbacks
+    def test_get_columnar(self):
+        def handler(req):
+            return json.dumps([{
+                'target': 'stores.a.b.last',
+                'datapoints': [[5.0, 5695], [None, 5700]]
+            }])
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        data = yield metrics.get(
+            m=['stores.a.b.last'], nulls='keep', format='columnar')
+        self.assertEqual(data, {
+            'stores.a.b.last': {
+                'x': [5695000, 5700000],
+                'y': [5.0, None],
+            },
+        })
+
+    @inlineCallbacks
+    def test_get_format_unrecognised(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        err = yield self.assertFailure(
+            metrics.get(m=['stores.a.b.last'], format='bad'),
+            BadMetricsQueryError)
+        self.assertEqual(str(err), "Unrecognised format 'bad'")
+
+    @inlineCallbacks
+    def test_get_max_points(self):
+        def handler(req):
+            return json.dumps([{
+                'target': 'stores.a.b.last',
+                'datapoints': [
+                    [None, 1000],
+                    [1.0, 2000],
+                    [9.0, 3000],
+                    [2.0, 4000],
+                    [3.0, 5000],
+                    [4.0, 6000]]
+            }])
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        data = yield metrics.get(
+            m='stores.a.b.last', nulls='omit', max_points='3')
+        self.assertEqual(points(data), {
+            'stores.a.b.last': [
+                {'x': 2000000, 'y': 1.0},
+                {'x': 3000000, 'y': 9.0},
+                {'x': 6000000, 'y': 4.0},
+            ]
+        })
+
+        data = yield metrics.get(
+            m='stores.a.b.last', nulls='omit', max_points='4',
+            downsample='minmax')
+        self.assertEqual(points(data), {
+            'stores.a.b.last': [
+                {'x': 2000000, 'y': 1.0},
+                {'x': 3000000, 'y': 9.0},
+                {'x': 4000000, 'y': 2.0},
+                {'x': 6000000, 'y': 4.0},
+            ]
+        })
+
+    @inlineCallbacks
+    def test_get_max_points_invalid(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        for max_points in ('foo', '1'):
+            err = yield self.assertFailure(
+                metrics.get(m=['stores.a.b.last'], max_points=max_points),
+                BadMetricsQueryError)
+            self.assertEqual(
+                str(err),
+                "'%s' is not a valid maximum number of points, should be an "
+                "integer of at least 2" % (max_points,))
+
+    @inlineCallbacks
+    def test_get_downsample_unrecognised(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        err = yield self.assertFailure(
+            metrics.get(m=['stores.a.b.last'], downsample='bad'),
+            BadMetricsQueryError)
+        self.assertEqual(str(err), "Unrecognised downsampler 'bad'")
+
     @inlineCallbacks
     def test_get_default_metrics(self):
         reqs = []
@@ -311,6 +478,112 @@ class TestGraphiteMetrics(VumiTestCase):
         resp = yield metrics.get(**{'from': '-1d', 'interval': '1s'})
         self.assertEqual(resp, {})
 
+    @inlineCallbacks
+    def test_get_batch(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            [target] = req.args['target']
+            name = target.split("'")[-2]
+            return json.dumps([{
+                'target': name,
+                'datapoints': [[float(len(reqs)), 5695]],
+            }])
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        data = yield metrics.get_batch([
+            {'m': 'stores.a.b.last', 'from': '-1d'},
+            {'m': ['stores.b.c.max'], 'from': '-2d', 'nulls': 'keep'},
+        ])
+        self.assertEqual(len(reqs), 2)
+        self.assertEqual(
+            sorted(req.args['from'] for req in reqs), [['-1d'], ['-2d']])
+        self.assertEqual(
+            [sorted(result.keys()) for result in data],
+            [['stores.a.b.last'], ['stores.b.c.max']])
+
+    @inlineCallbacks
+    def test_get_batch_concurrency(self):
+        backend = yield self.mk_backend(batch_query_concurrency=2)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+        renders = []
+
+        def request_render(url):
+            d = Deferred()
+            renders.append(d)
+            return d
+
+        self.patch(backend, 'request_render', request_render)
+
+        d = metrics.get_batch([
+            {'m': 'stores.a.b.last', 'from': '-%dd' % (i + 1,)}
+            for i in range(3)])
+        self.assertEqual(len(renders), 2)
+
+        renders[0].callback({})
+        self.assertEqual(len(renders), 3)
+
+        for render in renders[1:]:
+            render.callback({})
+
+        self.assertEqual((yield d), [{}, {}, {}])
+
+    @inlineCallbacks
+    def test_get_batch_size_budget(self):
+        backend = yield self.mk_backend(max_response_size=100)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        err = yield self.assertFailure(
+            metrics.get_batch([
+                {'m': 'stores.a.b.last', 'from': '-2d', 'interval': '1h'},
+                {'m': 'stores.a.b.last', 'from': '-3d', 'interval': '1h'},
+            ]),
+            BadMetricsQueryError)
+        self.assertEqual(
+            str(err), "120 data points requested, maximum allowed is 100")
+
+    @inlineCallbacks
+    def test_get_batch_invalid(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        err = yield self.assertFailure(
+            metrics.get_batch({'m': 'stores.a.b.last'}),
+            BadMetricsQueryError)
+        self.assertEqual(
+            str(err),
+            "Invalid batch query {'m': 'stores.a.b.last'}, should be a list "
+            "of queries")
+
+        err = yield self.assertFailure(
+            metrics.get_batch([{'m': 'stores.a.b.last'}, 'foo']),
+            BadMetricsQueryError)
+        self.assertEqual(
+            str(err), "Invalid query 'foo', should be dict, not <type 'str'>")
+
+        err = yield self.assertFailure(
+            metrics.get_batch([{'m': 'stores.a.b.last', 'nulls': 'bad'}]),
+            BadMetricsQueryError)
+        self.assertEqual(str(err), "Unrecognised null parser 'bad'")
+
+    @inlineCallbacks
+    def test_get_batch_backend_error(self):
+        def handler(req):
+            req.setResponseCode(500)
+            return ':('
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        yield self.assertFailure(
+            metrics.get_batch([{'m': 'stores.a.b.last'}]),
+            MetricsBackendError)
+
     @inlineCallbacks
     def test_get_defaults(self):
         reqs = []
@@ -349,6 +622,30 @@ class TestGraphiteMetrics(VumiTestCase):
         self.assertEqual(
             str(err), "Got error response interacting with metrics backend")
 
+    @inlineCallbacks
+    def test_get_response_timeout(self):
+        reqs = DeferredQueue()
+
+        def handler(req):
+            reqs.put(req)
+            return NOT_DONE_YET
+
+        clock = Clock()
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url, response_timeout=30, clock=clock)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        d = metrics.get()
+        yield reqs.get()
+        clock.advance(29)
+        self.assertNoResult(d)
+
+        clock.advance(1)
+        err = yield self.assertFailure(d, MetricsBackendError)
+        self.assertEqual(
+            str(err), "Timed out waiting for a response from metrics backend")
+
     @inlineCallbacks
     def test_get_null_handling_default(self):
         def handler(req):
@@ -406,9 +703,9 @@ class TestGraphiteMetrics(VumiTestCase):
         backend = yield self.mk_backend(graphite_url=graphite.url)
         metrics = GraphiteMetrics(backend, 'owner-1')
 
-        data = yield metrics.get(
+        data = points((yield metrics.get(
             m=['stores.a.b.last', 'stores.b.a.max'],
-            nulls='zeroize')
+            nulls='zeroize')))
 
         self.assertEqual(data, {
             'stores.a.b.last': [{
@@ -470,9 +767,9 @@ class TestGraphiteMetrics(VumiTestCase):
         backend = yield self.mk_backend(graphite_url=graphite.url)
         metrics = GraphiteMetrics(backend, 'owner-1')
 
-        data = yield metrics.get(
+        data = points((yield metrics.get(
             m=['stores.a.b.last', 'stores.b.a.max'],
-            nulls='omit')
+            nulls='omit')))
 
         self.assertEqual(data, {
             'stores.a.b.last': [{
@@ -516,9 +813,9 @@ class TestGraphiteMetrics(VumiTestCase):
         backend = yield self.mk_backend(graphite_url=graphite.url)
         metrics = GraphiteMetrics(backend, 'owner-1')
 
-        data = yield metrics.get(
+        data = points((yield metrics.get(
             m=['stores.a.b.last', 'stores.b.a.max'],
-            nulls='keep')
+            nulls='keep')))
 
         self.assertEqual(data, {
             'stores.a.b.last': [{
@@ -555,6 +852,37 @@ class TestGraphiteMetrics(VumiTestCase):
             }]
         })
 
+    @inlineCallbacks
+    def test_get_null_handling_fill(self):
+        def handler(req):
+            return json.dumps([{
+                'target': 'stores.a.b.last',
+                'datapoints': [
+                    [None, 2695],
+                    [5.0, 3695],
+                    [None, 4695],
+                    [None, 5695],
+                    [11.0, 6695],
+                    [None, 7695]]
+            }])
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        def values(data):
+            return [d['y'] for d in points(data)['stores.a.b.last']]
+
+        self.assertEqual(
+            values((yield metrics.get(m='stores.a.b.last', nulls='ffill'))),
+            [None, 5.0, 5.0, 5.0, 11.0, 11.0])
+        self.assertEqual(
+            values((yield metrics.get(m='stores.a.b.last', nulls='bfill'))),
+            [5.0, 5.0, 11.0, 11.0, 11.0, None])
+        self.assertEqual(
+            values((yield metrics.get(m='stores.a.b.last', nulls='linear'))),
+            [None, 5.0, 7.0, 9.0, 11.0, None])
+
     @inlineCallbacks
     def test_get_null_handling_unrecognised(self):
         graphite = yield self.mk_graphite()
@@ -618,74 +946,1027 @@ class TestGraphiteMetrics(VumiTestCase):
         self.assertEqual(req.getHeader('Authorization'), None)
 
     @inlineCallbacks
-    def test_post_request_single(self):
-        backend = yield self.mk_backend()
+    def test_get_cached(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            return json.dumps([{
+                'target': 'stores.a.b.last',
+                'datapoints': [[5.0, 5695], [None, 5700]]
+            }])
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
         metrics = GraphiteMetrics(backend, 'owner-1')
 
-        res = yield metrics.fire(**{'foo.avg': 1.7})
-        [metric] = res
+        data1 = yield metrics.get(m=['stores.a.b.last'])
+        data2 = yield metrics.get(m=['stores.a.b.last'])
 
-        self.assertEqual(metric, {
-            'name': 'foo.avg',
-            'value': 1.7,
-            'aggregator': 'avg',
-        })
+        self.assertEqual(len(reqs), 1)
+        self.assertEqual(data1, data2)
+        self.assertEqual(backend.cache.hits, 1)
+        self.assertEqual(backend.cache.misses, 1)
+        self.assertEqual(backend.stats()['cache']['size'], 1)
 
     @inlineCallbacks
-    def test_post_request_multiple(self):
-        backend = yield self.mk_backend()
+    def test_get_cached_equivalent_queries(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            return '[]'
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
         metrics = GraphiteMetrics(backend, 'owner-1')
 
-        res = yield metrics.fire(**{'foo.avg': 1.2, 'oof.avg': 2.7})
+        yield metrics.get(**{
+            'm': ['stores.a.b.last', 'stores.b.a.max'],
+            'from': '-48h',
+            'until': '-24h',
+            'interval': '1day',
+        })
+        yield metrics.get(**{
+            'm': ['stores.b.a.max', 'stores.a.b.last'],
+            'from': '-2d',
+            'until': 'now-1d',
+            'interval': '24h',
+        })
 
-        self.assertEqual(sorted(res), sorted([{
-            'name': 'foo.avg',
-            'value': 1.2,
-            'aggregator': 'avg',
-        }, {
-            'name': 'oof.avg',
-            'value': 2.7,
-            'aggregator': 'avg',
-        }]))
+        self.assertEqual(len(reqs), 1)
 
     @inlineCallbacks
-    def test_post_request_bad_value(self):
-        backend = yield self.mk_backend()
-        metrics = GraphiteMetrics(backend, 'owner-1')
+    def test_get_cached_null_handling(self):
+        reqs = []
 
-        try:
-            yield metrics.fire(**{'foo.avg': 'bar'})
-        except BadMetricsQueryError as e:
-            self.assertEqual(
-                str(e), "'bar' is not a valid metric value,should be a "
-                "floating point number")
-        else:
-            self.fail("BadMetricQueryError not raised")
+        def handler(req):
+            reqs.append(req)
+            return json.dumps([{
+                'target': 'stores.a.b.last',
+                'datapoints': [[5.0, 5695], [None, 5700]]
+            }])
 
-    @inlineCallbacks
-    def test_post_request_bad_aggregator(self):
-        backend = yield self.mk_backend()
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
         metrics = GraphiteMetrics(backend, 'owner-1')
 
-        try:
-            yield metrics.fire(**{'foo': 1.2})
-        except BadMetricsQueryError as e:
-            self.assertEqual(
-                str(e), "Aggregator 'foo' is not a valid aggregator")
-        else:
-            self.fail("BadMetricQueryError not raised")
+        kept = points((yield metrics.get(m=['stores.a.b.last'], nulls='keep')))
+        omitted = points(
+            (yield metrics.get(m=['stores.a.b.last'], nulls='omit')))
+
+        self.assertEqual(len(reqs), 1)
+        self.assertEqual(kept, {
+            'stores.a.b.last': [
+                {'x': 5695000, 'y': 5.0},
+                {'x': 5700000, 'y': None}],
+        })
+        self.assertEqual(omitted, {
+            'stores.a.b.last': [{'x': 5695000, 'y': 5.0}],
+        })
 
     @inlineCallbacks
-    def test_post_aggregators(self):
-        backend = yield self.mk_backend()
-        metrics = GraphiteMetrics(backend, 'owner-1')
+    def test_get_cached_per_owner(self):
+        reqs = []
 
-        for agg in GraphiteMetrics.aggregators:
-            res = yield metrics.fire(**{'foo.%s' % agg: 1.3})
+        def handler(req):
+            reqs.append(req)
+            return '[]'
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+
+        yield GraphiteMetrics(backend, 'owner-1').get(m=['stores.a.b.last'])
+        yield GraphiteMetrics(backend, 'owner-2').get(m=['stores.a.b.last'])
+
+        self.assertEqual(len(reqs), 2)
+
+    @inlineCallbacks
+    def test_get_cache_expiry(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            return '[]'
+
+        clock = Clock()
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url, cache_ttl=5, clock=clock)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        yield metrics.get(m=['stores.a.b.last'])
+        clock.advance(4)
+        yield metrics.get(m=['stores.a.b.last'])
+        self.assertEqual(len(reqs), 1)
+
+        clock.advance(1)
+        yield metrics.get(m=['stores.a.b.last'])
+        self.assertEqual(len(reqs), 2)
+
+    @inlineCallbacks
+    def test_get_cache_ttl_backend_clock(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            return '[]'
+
+        clock = Clock()
+        # 2015-02-01 00:20:00
+        clock.advance(1422750000)
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url, cache_ttl=5,
+            cache_historical_ttl=3600, clock=clock)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+        params = {
+            'm': ['stores.a.b.last'],
+            'from': '20150201',
+            'until': '20150202',
+            'interval': '1hour',
+        }
+
+        # The window includes the backend clock's current bucket, so it is
+        # only cached briefly.
+        yield metrics.get(**params)
+        clock.advance(5)
+        yield metrics.get(**params)
+        self.assertEqual(len(reqs), 2)
+
+    @inlineCallbacks
+    def test_get_cache_disabled(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            return '[]'
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url, cache_max_entries=0)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        yield metrics.get(m=['stores.a.b.last'])
+        yield metrics.get(m=['stores.a.b.last'])
+        self.assertEqual(len(reqs), 2)
+
+    @inlineCallbacks
+    def test_get_errors_not_cached(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            req.setResponseCode(500)
+            return ':('
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        yield self.assertFailure(metrics.get(), MetricsBackendError)
+        yield self.assertFailure(metrics.get(), MetricsBackendError)
+        self.assertEqual(len(reqs), 2)
+
+    @inlineCallbacks
+    def test_get_coalesced(self):
+        reqs = []
+        req_d = Deferred()
+
+        def handler(req):
+            reqs.append(req)
+            req_d.callback(req)
+            return NOT_DONE_YET
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        d1 = metrics.get(m=['stores.a.b.last'], nulls='keep')
+        d2 = metrics.get(m=['stores.a.b.last'], nulls='omit')
+        req = yield req_d
+
+        self.assertEqual(backend.stats()['coalescer']['pending'], 1)
+        self.assertEqual(backend.stats()['coalescer']['waiters'], 2)
+        # The stats are published, and don't give away what is queried.
+        self.assertFalse('stores.a.b' in json.dumps(backend.stats()))
+
+        req.write(json.dumps([{
+            'target': 'stores.a.b.last',
+            'datapoints': [[5.0, 5695], [None, 5700]]
+        }]))
+        req.finish()
+
+        [(_, kept), (_, omitted)] = yield DeferredList([d1, d2])
+        self.assertEqual(len(reqs), 1)
+        self.assertEqual(points(kept), {
+            'stores.a.b.last': [
+                {'x': 5695000, 'y': 5.0},
+                {'x': 5700000, 'y': None}],
+        })
+        self.assertEqual(points(omitted), {
+            'stores.a.b.last': [{'x': 5695000, 'y': 5.0}],
+        })
+        self.assertEqual(backend.coalescer.coalesced, 1)
+
+    @inlineCallbacks
+    def test_get_coalesced_error(self):
+        reqs = []
+        req_d = Deferred()
+
+        def handler(req):
+            reqs.append(req)
+            req_d.callback(req)
+            return NOT_DONE_YET
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        d1 = metrics.get(m=['stores.a.b.last'])
+        d2 = metrics.get(m=['stores.a.b.last'])
+        req = yield req_d
+        req.setResponseCode(500)
+        req.finish()
+
+        yield self.assertFailure(d1, MetricsBackendError)
+        yield self.assertFailure(d2, MetricsBackendError)
+        self.assertEqual(len(reqs), 1)
+
+    @inlineCallbacks
+    def test_get_scheduled(self):
+        reqs = DeferredQueue()
+
+        def handler(req):
+            reqs.put(req)
+            return NOT_DONE_YET
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url,
+            max_concurrent_queries_per_owner=1,
+            max_queued_queries_per_owner=1)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        d1 = metrics.get(m=['stores.a.b.last'])
+        d2 = metrics.get(m=['stores.a.c.last'])
+        d3 = metrics.get(m=['stores.a.d.last'])
+        req = yield reqs.get()
+
+        # The second query waits for the first, and there is no room to
+        # queue the third.
+        yield self.assertFailure(d3, MetricsThrottledError)
+        self.assertEqual(backend.stats()['scheduler']['owners'], 1)
+        self.assertEqual(backend.stats()['scheduler']['running'], 1)
+        self.assertEqual(backend.stats()['scheduler']['queued'], 1)
+        # The stats are published, and don't give away who is querying.
+        self.assertFalse('owner-1' in json.dumps(backend.stats()))
+
+        req.write('[]')
+        req.finish()
+        yield d1
+
+        req = yield reqs.get()
+        req.write('[]')
+        req.finish()
+        yield d2
+
+        self.assertEqual(backend.stats()['scheduler']['started'], 2)
+        self.assertEqual(backend.stats()['scheduler']['rejected'], 1)
+
+    @inlineCallbacks
+    def test_get_budget_exhausted(self):
+        def handler(req):
+            return '[]'
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url,
+            query_budget_rate=2,
+            query_budget_burst=30,
+            clock=Clock())
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        # Each query is predicted to return 24 data points.
+        yield metrics.get(m=['stores.a.b.last'])
+        # Cached results don't count against the allowance.
+        yield metrics.get(m=['stores.a.b.last'])
+
+        err = yield self.assertFailure(
+            metrics.get(m=['stores.a.c.last']), MetricsThrottledError)
+        self.assertEqual(err.retry_after, 9)
+
+        # Other owners have their own allowance.
+        yield GraphiteMetrics(backend, 'owner-2').get(m=['stores.a.c.last'])
+
+        backend.clock.advance(9)
+        yield metrics.get(m=['stores.a.c.last'])
+        self.assertEqual(backend.stats()['budgets'], {
+            'buckets': 2,
+            'spent': 72,
+            'rejected': 1,
+        })
+
+    @inlineCallbacks
+    def test_get_rollups(self):
+        reqs = []
+        now = 1422748800
+
+        def handler(req):
+            reqs.append(req)
+            return json.dumps([{
+                'target': 'stores.a.b.last',
+                'datapoints': [[1.0, now - 600], [2.0, now]],
+            }])
+
+        clock = Clock()
+        clock.advance(now + 30)
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url,
+            clock=clock,
+            cache_max_entries=0,
+            rollup_max_shapes=1,
+            rollup_min_requests=1)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+        query = {
+            'm': 'stores.a.b.last',
+            'from': '-1h',
+            'until': '-0s',
+            'interval': '10min',
+        }
+
+        refreshes = []
+        refresh = backend.rollups.refresh
+        backend.rollups.refresh = lambda *args: refreshes.append(
+            refresh(*args)) or refreshes[-1]
+
+        yield metrics.get(**query)
+        self.assertEqual(len(reqs), 1)
+
+        # The shape is materialized in the background for the time range at
+        # the time of the refresh.
+        clock.advance(10)
+        yield refreshes[0]
+        self.assertEqual(len(reqs), 2)
+        self.assertEqual(reqs[1].args['from'], [str(now + 40 - 3600)])
+        self.assertEqual(reqs[1].args['until'], [str(now + 40)])
+
+        data = yield metrics.get(**query)
+        self.assertEqual(len(reqs), 2)
+        self.assertEqual(points(data), {
+            'stores.a.b.last': [
+                {'x': (now - 600) * 1000, 'y': 1.0},
+                {'x': now * 1000, 'y': 2.0},
+            ],
+        })
+        self.assertEqual(backend.stats()['rollups']['served'], 1)
+
+    @inlineCallbacks
+    def test_get_since(self):
+        reqs = []
+        now = 1422748800
+
+        def handler(req):
+            reqs.append(req)
+            return json.dumps([{
+                'target': 'stores.a.b.last',
+                'datapoints': [[1, now - 7200], [2, now - 3600], [3, now]],
+            }])
+
+        clock = Clock()
+        clock.advance(now + 1800)
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url, clock=clock)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        data = yield metrics.get(
+            m='stores.a.b.last', since=str((now - 3600) * 1000))
+
+        # Only the buckets from the cursor onwards are requested and
+        # returned.
+        [req] = reqs
+        self.assertEqual(req.args['from'], [str(now - 3601)])
+        self.assertEqual(req.args['until'], ['-0s'])
+        self.assertEqual(points(data), {
+            'stores.a.b.last': [
+                {'x': (now - 3600) * 1000, 'y': 2.0},
+                {'x': now * 1000, 'y': 3.0},
+            ],
+        })
+
+    @inlineCallbacks
+    def test_get_since_align_to_from(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            return '[]'
+
+        now = 1422748800
+        clock = Clock()
+        clock.advance(now)
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(graphite_url=graphite.url, clock=clock)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        yield metrics.get(
+            m='stores.a.b.last', align_to_from='true',
+            since=str((now - 3600 * 5 + 600) * 1000))
+
+        [req] = reqs
+        self.assertEqual(req.args['from'], [str(now - 3600 * 5)])
+
+    @inlineCallbacks
+    def test_get_since_invalid(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+        yield self.assertFailure(
+            metrics.get(m='stores.a.b.last', since='yesterday'),
+            BadMetricsQueryError)
+
+    @inlineCallbacks
+    def test_get_tiered_historical(self):
+        reqs = []
+        now = 1422748800
+        h = 3600
+        responses = {
+            ('-6h', '-0s'): [[i, now + (i - 7) * h] for i in range(1, 8)],
+            ('-6h', str(now - 5 * h - 1)): [
+                [10, now - 6 * h], [None, now - 5 * h]],
+            (str(now - 1), '-0s'): [[20, now]],
+        }
+
+        def handler(req):
+            reqs.append(req)
+            return json.dumps([{
+                'target': 'stores.a.b.sum',
+                'datapoints': responses[
+                    req.args['from'][0], req.args['until'][0]],
+            }])
+
+        clock = Clock()
+        clock.advance(now + h / 2)
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url,
+            clock=clock,
+            cache_max_entries=0,
+            historical_cache_max_entries=10)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+        query = {
+            'm': 'stores.a.b.sum',
+            'from': '-6h',
+            'until': '-0s',
+            'interval': '1h',
+        }
+
+        yield metrics.get(**query)
+        [req] = reqs
+        self.assertEqual(req.args['from'], ['-6h'])
+        self.assertEqual(backend.stats()['historical']['stored'], 5)
+
+        # The completed buckets are reused, with graphite only asked for the
+        # partial buckets at either end.
+        del reqs[:]
+        data = yield metrics.get(**query)
+        self.assertEqual(sorted(
+            (req.args['from'], req.args['until']) for req in reqs), [
+            (['-6h'], [str(now - 5 * h - 1)]),
+            ([str(now - 1)], ['-0s']),
+        ])
+        self.assertEqual(
+            data['stores.a.b.sum'].values(), [10, 2, 3, 4, 5, 6, 20])
+        self.assertEqual(
+            list(data['stores.a.b.sum'].x),
+            range(now - 6 * h, now + 1, h))
+
+    @inlineCallbacks
+    def test_get_tiered_recent(self):
+        reqs = []
+        now = 1422748800
+        responses = {
+            ('-30min', str(now - 1)): [[5, now - 600], [None, now]],
+            (str(now + 1199), '-0s'): [[7, now + 1200]],
+        }
+
+        def handler(req):
+            reqs.append(req)
+            return json.dumps([{
+                'target': 'stores.a.b.sum',
+                'datapoints': responses[
+                    req.args['from'][0], req.args['until'][0]],
+            }])
+
+        clock = Clock()
+        clock.advance(now)
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url,
+            clock=clock,
+            fire_buffer_delay=0,
+            recent_retention='1min:2h')
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        clock.advance(60)
+        yield metrics.fire(**{'stores.a.b.sum': 1})
+        clock.advance(660)
+        yield metrics.fire(**{'stores.a.b.sum': 2})
+        clock.advance(780)
+
+        data = yield metrics.get(**{
+            'm': 'stores.a.b.sum',
+            'from': '-30min',
+            'until': '-0s',
+            'interval': '10min',
+        })
+
+        # The buckets after the api started come from the fired values.
+        self.assertEqual(len(reqs), 2)
+        self.assertEqual(points(data), {
+            'stores.a.b.sum': [
+                {'x': (now - 600) * 1000, 'y': 5.0},
+                {'x': now * 1000, 'y': 1.0},
+                {'x': (now + 600) * 1000, 'y': 2.0},
+                {'x': (now + 1200) * 1000, 'y': 7.0},
+            ],
+        })
+        self.assertEqual(backend.stats()['recent']['size'], 1)
+
+    @inlineCallbacks
+    def test_get_tiered_align_to_from(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            return '[]'
+
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url,
+            historical_cache_max_entries=10)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        # Buckets aligned to the start of the time range can't be answered
+        # from the tiers.
+        yield metrics.get(m='stores.a.b.sum', align_to_from='true')
+        [req] = reqs
+        self.assertEqual(req.args['from'], ['-24h'])
+        self.assertEqual(req.args['until'], ['-0s'])
+
+    @inlineCallbacks
+    def test_get_batched(self):
+        reqs = []
+
+        def handler(req):
+            reqs.append(req)
+            return json.dumps([{
+                'target': '0',
+                'datapoints': [[5.0, 5695]]
+            }, {
+                'target': '1',
+                'datapoints': [[10.0, 5695]]
+            }])
+
+        clock = Clock()
+        graphite = yield self.mk_graphite(handler)
+        backend = yield self.mk_backend(
+            graphite_url=graphite.url, batch_window=0.5, clock=clock)
+
+        d1 = GraphiteMetrics(backend, 'owner-1').get(m=['stores.a.b.last'])
+        d2 = GraphiteMetrics(backend, 'owner-2').get(m=['stores.a.b.last'])
+        clock.advance(0.5)
+        [(_, data1), (_, data2)] = yield DeferredList([d1, d2])
+
+        [req] = reqs
+        self.assertEqual(req.args, {
+            'format': ['json'],
+            'from': ['-24h'],
+            'until': ['-0s'],
+            'target': [
+                "alias(summarize(go.campaigns.owner-1.stores.a.b.last,"
+                " '1hour', 'last', false), '0')",
+                "alias(summarize(go.campaigns.owner-2.stores.a.b.last,"
+                " '1hour', 'last', false), '1')"],
+        })
+        self.assertEqual(points(data1), {
+            'stores.a.b.last': [{'x': 5695000, 'y': 5.0}],
+        })
+        self.assertEqual(points(data2), {
+            'stores.a.b.last': [{'x': 5695000, 'y': 10.0}],
+        })
+        self.assertEqual(backend.stats()['batcher']['batches'], 1)
+
+    @inlineCallbacks
+    def test_cache_ttl(self):
+        backend = yield self.mk_backend(
+            cache_ttl=10, cache_historical_ttl=3600,
+            historical_settle_time=300)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+        now = datetime(2015, 2, 1, 0, 20, 0)
+
+        def ttl(**kw):
+            params = {'align_to_from': 'false', 'interval': '1hour'}
+            params.update(kw)
+            return metrics._cache_ttl(params, now)
+
+        # The current bucket is still open.
+        self.assertEqual(ttl(**{'from': '-24h', 'until': '-0s'}), 10)
+        self.assertEqual(ttl(**{'from': '20150101', 'until': 'now'}), 10)
+
+        # Absolute windows in the past don't change.
+        self.assertEqual(
+            ttl(**{'from': '20150101', 'until': '20150131'}), 3600)
+
+        # Values may still arrive late for a bucket that has only just
+        # closed.
+        self.assertEqual(
+            ttl(**{
+                'from': '00:00_20150201',
+                'until': '00:19_20150201',
+                'interval': '1min',
+            }), 10)
+        self.assertEqual(
+            ttl(**{
+                'from': '00:00_20150201',
+                'until': '00:14_20150201',
+                'interval': '1min',
+            }), 3600)
+
+        # Windows anchored to a day are cached under the day's time.
+        self.assertEqual(
+            ttl(**{
+                'from': 'midnight yesterday',
+                'until': 'midnight',
+                'interval': '10min',
+            }), 3600)
+
+        # The edge buckets of relative windows change as they slide.
+        self.assertEqual(ttl(**{'from': '-48h', 'until': '-24h'}), 10)
+        self.assertEqual(
+            ttl(**{'from': '-48h', 'until': '-24h', 'interval': '1day'}),
+            10)
+        self.assertEqual(
+            ttl(**{'from': '20150101', 'until': '-24h'}), 10)
+        self.assertEqual(
+            ttl(**{
+                'from': '-48h',
+                'until': '-24h',
+                'align_to_from': 'true',
+            }), 10)
+
+    @inlineCallbacks
+    def test_post_request_single(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        res = yield metrics.fire(**{'foo.avg': 1.7})
+        [metric] = res
+
+        self.assertEqual(metric, {
+            'name': 'foo.avg',
+            'value': 1.7,
+            'aggregator': 'avg',
+        })
+
+    @inlineCallbacks
+    def test_post_request_multiple(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        res = yield metrics.fire(**{'foo.avg': 1.2, 'oof.avg': 2.7})
+
+        self.assertEqual(sorted(res), sorted([{
+            'name': 'foo.avg',
+            'value': 1.2,
+            'aggregator': 'avg',
+        }, {
+            'name': 'oof.avg',
+            'value': 2.7,
+            'aggregator': 'avg',
+        }]))
+
+    @inlineCallbacks
+    def test_post_request_buffered(self):
+        clock = Clock()
+        clock.advance(1000)
+        backend = yield self.mk_backend(clock=clock, fire_buffer_delay=2)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        yield metrics.fire(**{'foo.avg': 1.2, 'bar.sum': 2.0})
+        clock.advance(1)
+        yield metrics.fire(**{'foo.avg': 1.7})
+        self.assertEqual(self.worker_helper.get_dispatched_metrics(), [])
+
+        clock.advance(1)
+        [datapoints] = self.worker_helper.get_dispatched_metrics()
+        self.assertEqual(sorted(datapoints), [
+            ['go.campaigns.go.campaigns.owner-1.bar', ['sum'], [[1000, 2.0]]],
+            ['go.campaigns.go.campaigns.owner-1.foo', ['avg'],
+             [[1000, 1.2], [1001, 1.7]]],
+        ])
+
+    @inlineCallbacks
+    def test_post_request_buffer_full(self):
+        backend = yield self.mk_backend(fire_buffer_size=2)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        yield metrics.fire(**{'foo.avg': 1.2})
+        self.assertEqual(self.worker_helper.get_dispatched_metrics(), [])
+
+        yield metrics.fire(**{'foo.avg': 1.7})
+        [datapoints] = self.worker_helper.get_dispatched_metrics()
+        self.assertEqual(
+            [(name, aggs, [v for _, v in points])
+             for name, aggs, points in datapoints],
+            [('go.campaigns.go.campaigns.owner-1.foo', ['avg'], [1.2, 1.7])])
+
+    @inlineCallbacks
+    def test_post_request_flushed_on_teardown(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        yield metrics.fire(**{'foo.avg': 1.2})
+        self.assertEqual(self.worker_helper.get_dispatched_metrics(), [])
+
+        yield backend.teardown()
+        [[(name, aggs, [[_, value]])]] = (
+            self.worker_helper.get_dispatched_metrics())
+        self.assertEqual(
+            (name, aggs, value),
+            ('go.campaigns.go.campaigns.owner-1.foo', ['avg'], 1.2))
+
+    @inlineCallbacks
+    def test_post_request_pre_aggregated(self):
+        clock = Clock()
+        clock.advance(1000)
+        backend = yield self.mk_backend(clock=clock, fire_pre_aggregate=True)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        for value in (1.0, 2.0, 6.0):
+            yield metrics.fire(**{'foo.avg': value, 'bar.sum': value})
+
+        clock.advance(1)
+        [datapoints] = self.worker_helper.get_dispatched_metrics()
+        self.assertEqual(sorted(datapoints), [
+            ['go.campaigns.go.campaigns.owner-1.bar', ['sum'], [[1000, 9.0]]],
+            ['go.campaigns.go.campaigns.owner-1.foo', ['avg'],
+             [[1000, 1.0], [1000, 2.0], [1000, 6.0]]],
+        ])
+
+    @inlineCallbacks
+    def test_fire_bulk(self):
+        clock = Clock()
+        clock.advance(1000)
+        backend = yield self.mk_backend(clock=clock, fire_buffer_delay=0)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        res = yield metrics.fire_bulk(iter_records(
+            '{"name": "foo.sum", "value": 1.5}\n'
+            '{"name": "foo.sum", "value": 2, "timestamp": 900}\n'
+            '{"name": "bar.avg", "value": "3.5"}\n'))
+
+        self.assertEqual(res, {'fired': 3, 'failed': 0, 'errors': []})
+        [datapoints] = self.worker_helper.get_dispatched_metrics()
+        self.assertEqual(sorted(datapoints), [
+            ['go.campaigns.go.campaigns.owner-1.bar', ['avg'], [[1000, 3.5]]],
+            ['go.campaigns.go.campaigns.owner-1.foo', ['sum'],
+             [[1000, 1.5], [900, 2.0]]],
+        ])
+
+    @inlineCallbacks
+    def test_fire_bulk_errors(self):
+        backend = yield self.mk_backend(fire_buffer_delay=0)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        res = yield metrics.fire_bulk(iter_records('\n'.join([
+            '{"name": "foo.sum", "value": 1}',
+            'not json',
+            '{"name": "foo.sum"}',
+            '[1, 2]',
+            '{"name": 3, "value": 1}',
+            '{"name": "foo", "value": 1}',
+            '{"name": "foo.sum", "value": "bar"}',
+            '{"name": "foo.sum", "value": 1, "timestamp": "now"}',
+            '{"name": "foo.max", "value": 2}',
+        ])))
+
+        self.assertEqual(res, {
+            'fired': 2,
+            'failed': 7,
+            'errors': [
+                {'line': 2, 'reason': "Invalid json"},
+                {'line': 3, 'reason': (
+                    "Invalid record, should be an object with 'name' and "
+                    "'value' fields")},
+                {'line': 4, 'reason': (
+                    "Invalid record, should be an object with 'name' and "
+                    "'value' fields")},
+                {'line': 5, 'reason': "3 is not a valid metric name"},
+                {'line': 6, 'reason': (
+                    "Aggregator 'foo' is not a valid aggregator")},
+                {'line': 7, 'reason': (
+                    "u'bar' is not a valid metric value,should be a floating "
+                    "point number")},
+                {'line': 8, 'reason': (
+                    "u'now' is not a valid timestamp, should be a number of "
+                    "seconds since the epoch")},
+            ],
+        })
+        [datapoints] = self.worker_helper.get_dispatched_metrics()
+        self.assertEqual(len(datapoints), 2)
+
+    @inlineCallbacks
+    def test_fire_bulk_bad_timestamps(self):
+        clock = Clock()
+        clock.advance(1422748800)
+        backend = yield self.mk_backend(
+            clock=clock, fire_buffer_delay=0,
+            fire_max_timestamp_age=3600, fire_max_timestamp_lead=60)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        res = yield metrics.fire_bulk(iter_records('\n'.join([
+            '{"name": "foo.sum", "value": 1, "timestamp": NaN}',
+            '{"name": "foo.sum", "value": 1, "timestamp": 1e400}',
+            '{"name": "foo.sum", "value": 1, "timestamp": -Infinity}',
+            '{"name": "foo.sum", "value": 1, "timestamp": 1422748740.5}',
+            '{"name": "foo.sum", "value": 1, "timestamp": 1e30}',
+            '{"name": "foo.sum", "value": 1, "timestamp": 1422748800000}',
+            '{"name": "foo.sum", "value": 1, "timestamp": 1422748861}',
+            '{"name": "foo.sum", "value": 1, "timestamp": 1422745199}',
+            '{"name": "foo.sum", "value": 1, "timestamp": 1422748860.0}',
+            '{"name": "foo.sum", "value": 2, "timestamp": 1422745200}',
+        ])))
+
+        not_whole = (
+            "%s is not a valid timestamp, should be a whole number of "
+            "seconds since the epoch")
+        too_far = (
+            "Timestamp %s is too far from the current time, should be no "
+            "more than 3600 seconds before it and 60 seconds after it")
+        self.assertEqual(res, {
+            'fired': 2,
+            'failed': 8,
+            'errors': [
+                {'line': 1, 'reason': not_whole % ('nan',)},
+                {'line': 2, 'reason': not_whole % ('inf',)},
+                {'line': 3, 'reason': not_whole % ('-inf',)},
+                {'line': 4, 'reason': not_whole % ('1422748740.5',)},
+                {'line': 5, 'reason': too_far % ('1e+30',)},
+                {'line': 6, 'reason': too_far % ('1422748800000',)},
+                {'line': 7, 'reason': too_far % ('1422748861',)},
+                {'line': 8, 'reason': too_far % ('1422745199',)},
+            ],
+        })
+        [datapoints] = self.worker_helper.get_dispatched_metrics()
+        self.assertEqual(datapoints, [
+            ['go.campaigns.go.campaigns.owner-1.foo', ['sum'],
+             [[1422748860, 1.0], [1422745200, 2.0]]],
+        ])
+
+    @inlineCallbacks
+    def test_fire_bulk_chunks(self):
+        backend = yield self.mk_backend(fire_buffer_size=2)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        res = yield metrics.fire_bulk(iter_records('\n'.join(
+            '{"name": "foo.sum", "value": %d}' % i for i in range(5))))
+
+        self.assertEqual(res, {'fired': 5, 'failed': 0, 'errors': []})
+        self.assertEqual(
+            [len(points) for [(_, _, points)]
+             in self.worker_helper.get_dispatched_metrics()],
+            [2, 2])
+        self.assertEqual(len(backend.fire_buffer), 1)
+
+    @inlineCallbacks
+    def test_compile_metric(self):
+        backend = yield self.mk_backend(disable_auto_prefix=True)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        metric = metrics._compile_metric('foo.sum')
+        self.assertEqual(metric.name, 'foo.sum')
+        self.assertEqual(metric.aggregator, SUM)
+        self.assertEqual(metric.full_name, 'go.campaigns.owner-1.foo.sum')
+        self.assertEqual(metric.fire_name, 'owner-1.foo')
+
+        self.assertTrue(metrics._compile_metric('foo.sum') is metric)
+        other = GraphiteMetrics(backend, 'owner-2')._compile_metric('foo.sum')
+        self.assertEqual(other.full_name, 'go.campaigns.owner-2.foo.sum')
+
+        stats = backend.stats()['metric_cache']
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    @inlineCallbacks
+    def test_compile_metric_bad_aggregator(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        self.assertRaises(
+            BadMetricsQueryError, metrics._compile_metric, 'foo.bar')
+        self.assertEqual(len(backend.metric_cache), 0)
+
+    @inlineCallbacks
+    def test_compile_metric_cache_disabled(self):
+        backend = yield self.mk_backend(metric_cache_max_entries=0)
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        metric = metrics._compile_metric('foo.sum')
+        self.assertFalse(metrics._compile_metric('foo.sum') is metric)
+        self.assertEqual(len(backend.metric_cache), 0)
+
+    @inlineCallbacks
+    def test_post_request_bad_value(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        try:
+            yield metrics.fire(**{'foo.avg': 'bar'})
+        except BadMetricsQueryError as e:
+            self.assertEqual(
+                str(e), "'bar' is not a valid metric value,should be a "
+                "floating point number")
+        else:
+            self.fail("BadMetricQueryError not raised")
+
+    @inlineCallbacks
+    def test_post_request_bad_aggregator(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        try:
+            yield metrics.fire(**{'foo': 1.2})
+        except BadMetricsQueryError as e:
+            self.assertEqual(
+                str(e), "Aggregator 'foo' is not a valid aggregator")
+        else:
+            self.fail("BadMetricQueryError not raised")
+
+    @inlineCallbacks
+    def test_post_aggregators(self):
+        backend = yield self.mk_backend()
+        metrics = GraphiteMetrics(backend, 'owner-1')
+
+        for agg in GraphiteMetrics.aggregators:
+            res = yield metrics.fire(**{'foo.%s' % agg: 1.3})
             [metric] = res
             self.assertEqual(metric['aggregator'], agg)
 
 
+class TestGraphiteBackend(VumiTestCase):
+    def setUp(self):
+        self.worker_helper = self.add_helper(WorkerHelper())
+
+    @inlineCallbacks
+    def mk_backend(self, **kw):
+        worker = yield self.worker_helper.get_worker(
+            MetricWorker, {'prefix': 'go.campaigns'})
+        self.patch(
+            go_metrics.metrics.graphite, 'WorkerCreator',
+            DummyWorkerCreatorClass(self, {'prefix': 'go.campaigns'}, worker))
+        backend = GraphiteBackend(kw)
+        self.addCleanup(backend.teardown)
+        returnValue(backend)
+
+    @inlineCallbacks
+    def test_connection_pool(self):
+        backend = yield self.mk_backend(
+            persistent=False,
+            max_persistent_per_host=5,
+            connection_idle_timeout=60)
+        self.assertFalse(backend.pool.persistent)
+        self.assertEqual(backend.pool.maxPersistentPerHost, 5)
+        self.assertEqual(backend.pool.cachedConnectionTimeout, 60)
+        self.assertEqual(backend.agent._pool, backend.pool)
+
+    @inlineCallbacks
+    def test_connection_reactor(self):
+        fake_reactor = MemoryReactorClock()
+        self.patch(GraphiteBackend, 'get_reactor', lambda self: fake_reactor)
+        backend = yield self.mk_backend()
+        self.assertEqual(backend.pool._reactor, fake_reactor)
+        self.assertEqual(backend.agent._reactor, fake_reactor)
+
+    @inlineCallbacks
+    def test_connection_pool_defaults(self):
+        backend = yield self.mk_backend()
+        self.assertTrue(backend.pool.persistent)
+        self.assertEqual(backend.pool.maxPersistentPerHost, 10)
+        self.assertEqual(backend.pool.cachedConnectionTimeout, 240)
+
+    @inlineCallbacks
+    def test_teardown_closes_connections(self):
+        backend = yield self.mk_backend()
+        closed = []
+        self.patch(
+            backend.pool, 'closeCachedConnections',
+            lambda: closed.append(True))
+        yield backend.teardown()
+        self.assertEqual(closed, [True])
+
+
 class TestGraphiteBackendConfig(TestCase):
     def test_auth_fields(self):
         GraphiteBackendConfig({})
@@ -697,3 +1978,23 @@ class TestGraphiteBackendConfig(TestCase):
             ConfigError, GraphiteBackendConfig, {'username': 'foo'})
         self.assertRaises(
             ConfigError, GraphiteBackendConfig, {'password': 'bar'})
+
+    def test_recent_retention(self):
+        GraphiteBackendConfig({'recent_retention': '1min:1h'})
+        self.assertRaises(
+            ConfigError, GraphiteBackendConfig, {'recent_retention': '1min'})
+
+    def test_query_quantum(self):
+        GraphiteBackendConfig({'query_quantum': 1})
+        self.assertRaises(
+            ConfigError, GraphiteBackendConfig, {'query_quantum': 0})
+        self.assertRaises(
+            ConfigError, GraphiteBackendConfig, {'query_quantum': -10})
+
+    def test_owner_weights(self):
+        GraphiteBackendConfig({'owner_weights': {'foo': 2, 'bar': 0.5}})
+        self.assertRaises(
+            ConfigError, GraphiteBackendConfig, {'owner_weights': {'foo': 0}})
+        self.assertRaises(
+            ConfigError, GraphiteBackendConfig,
+            {'owner_weights': {'foo': 'bar'}})
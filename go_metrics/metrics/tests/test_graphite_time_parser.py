@@ -2,8 +2,10 @@ from datetime import datetime
 
 from twisted.trial.unittest import TestCase
 
+from go_metrics.metrics import graphite_time_parser
 from go_metrics.metrics.graphite_time_parser import (
-    TimeParserValueError, interval_to_seconds, parse_time)
+    TimeParserValueError, interval_to_seconds, normalize_time, parse_time,
+    to_timestamp)
 
 
 class TestGraphiteTimeParser(TestCase):
@@ -154,8 +156,8 @@ class TestGraphiteTimeParser(TestCase):
 
     def test_parse_time_special_values(self):
         """
-        The strings "now", "yesterday", "today", and "tomorrow" return what one
-        might expect.
+        The string "now" is the current time, and the strings "yesterday",
+        "today", and "tomorrow" are midnight on the corresponding day.
         """
         now1 = datetime(2015, 2, 1, 0, 0, 0)
         now2 = datetime(2015, 1, 24, 10, 15, 25)
@@ -164,13 +166,79 @@ class TestGraphiteTimeParser(TestCase):
         self.assertEqual(
             parse_time("yesterday", now1), datetime(2015, 1, 31, 0, 0, 0))
         self.assertEqual(
-            parse_time("yesterday", now2), datetime(2015, 1, 23, 10, 15, 25))
+            parse_time("yesterday", now2), datetime(2015, 1, 23, 0, 0, 0))
         self.assertEqual(parse_time("today", now1), now1)
-        self.assertEqual(parse_time("today", now2), now2)
+        self.assertEqual(
+            parse_time("today", now2), datetime(2015, 1, 24, 0, 0, 0))
         self.assertEqual(
             parse_time("tomorrow", now1), datetime(2015, 2, 2, 0, 0, 0))
         self.assertEqual(
-            parse_time("tomorrow", now2), datetime(2015, 1, 25, 10, 15, 25))
+            parse_time("tomorrow", now2), datetime(2015, 1, 25, 0, 0, 0))
+
+    def test_parse_time_with_reference_and_offset(self):
+        """
+        A reference may be followed by an offset made up of one or more
+        ``<count><unit>`` terms.
+        """
+        now = datetime(2015, 1, 24, 10, 15, 25)
+        self.assertEqual(
+            parse_time("now-2h", now), datetime(2015, 1, 24, 8, 15, 25))
+        self.assertEqual(
+            parse_time("now+1d", now), datetime(2015, 1, 25, 10, 15, 25))
+        self.assertEqual(
+            parse_time("-1d2h", now), datetime(2015, 1, 23, 8, 15, 25))
+        self.assertEqual(
+            parse_time("yesterday+6h", now), datetime(2015, 1, 23, 6, 0, 0))
+        self.assertEqual(
+            parse_time("20150201-1d", now), datetime(2015, 1, 31, 0, 0, 0))
+
+    def test_parse_time_times_of_day(self):
+        """
+        A reference may start with a time of day, given either as ``HH:MM``
+        (optionally followed by "am" or "pm") or as "noon", "midnight" or
+        "teatime".
+        """
+        now = datetime(2015, 1, 24, 10, 15, 25)
+        self.assertEqual(
+            parse_time("midnight", now), datetime(2015, 1, 24, 0, 0, 0))
+        self.assertEqual(
+            parse_time("noon", now), datetime(2015, 1, 24, 12, 0, 0))
+        self.assertEqual(
+            parse_time("teatime", now), datetime(2015, 1, 24, 16, 0, 0))
+        self.assertEqual(
+            parse_time("noon yesterday", now), datetime(2015, 1, 23, 12, 0))
+        self.assertEqual(
+            parse_time("4:00pm yesterday", now), datetime(2015, 1, 23, 16, 0))
+        self.assertEqual(
+            parse_time("12:30am tomorrow", now), datetime(2015, 1, 25, 0, 30))
+        self.assertEqual(
+            parse_time("12:30pm", now), datetime(2015, 1, 24, 12, 30))
+        self.assertEqual(
+            parse_time("noon 20150201", now), datetime(2015, 2, 1, 12, 0))
+
+    def test_parse_time_days(self):
+        """
+        A reference may include a day, given as ``MM/DD/YY[YY]``, a month name
+        and day of month in the current year, or the most recent occurrence of
+        a weekday.
+        """
+        # 2015-01-24 is a Saturday.
+        now = datetime(2015, 1, 24, 10, 15, 25)
+        self.assertEqual(
+            parse_time("12/31/99", now), datetime(1999, 12, 31, 0, 0, 0))
+        self.assertEqual(
+            parse_time("02/01/15", now), datetime(2015, 2, 1, 0, 0, 0))
+        self.assertEqual(
+            parse_time("02/01/2015", now), datetime(2015, 2, 1, 0, 0, 0))
+        self.assertEqual(
+            parse_time("january 1", now), datetime(2015, 1, 1, 0, 0, 0))
+        self.assertEqual(
+            parse_time("noon feb 14", now), datetime(2015, 2, 14, 12, 0, 0))
+        self.assertEqual(
+            parse_time("monday", now), datetime(2015, 1, 19, 0, 0, 0))
+        self.assertEqual(
+            parse_time("saturday", now), datetime(2015, 1, 24, 0, 0, 0))
+        self.assert_TPVE(parse_time, "feb 30", now)
 
     def test_parse_time_absolute_datetime(self):
         """
@@ -181,6 +249,26 @@ class TestGraphiteTimeParser(TestCase):
             parse_time("00:00_20150201", None), datetime(2015, 2, 1, 0, 0, 0))
         self.assertEqual(
             parse_time("00:00_19700101", None), datetime(1970, 1, 1, 0, 0, 0))
+        self.assertEqual(
+            parse_time("12:35 20150201", None), datetime(2015, 2, 1, 12, 35))
+        self.assertEqual(
+            parse_time("12:3520150201", None), datetime(2015, 2, 1, 12, 35))
+        self.assertEqual(
+            parse_time("2015_02_01", None), datetime(2015, 2, 1, 0, 0, 0))
+
+    def test_parse_time_invalid_absolute_datetime(self):
+        """
+        If given an invalid ``HH:MM_YYYYMMDD`` time_str, a
+        TimeParserValueError is raised.
+        """
+        self.assert_TPVE(parse_time, "24:00_20150201", None)
+        self.assert_TPVE(parse_time, "00:60_20150201", None)
+        self.assert_TPVE(parse_time, "00:00_20150229", None)
+        self.assert_TPVE(parse_time, "00:00_2015021", None)
+        self.assert_TPVE(parse_time, "00:00_201502011", None)
+        self.assert_TPVE(parse_time, "000:00_20150201", None)
+        self.assert_TPVE(parse_time, "a0:00_20150201", None)
+        self.assert_TPVE(parse_time, "1:5_20150201", None)
 
     def test_parse_time_absolute_date(self):
         """
@@ -220,13 +308,125 @@ class TestGraphiteTimeParser(TestCase):
         self.assert_TPVE(parse_time, "blahblah", None)
         # This is detected as a YYYYMMDD string, but it's invalid.
         self.assert_TPVE(parse_time, "20150231", None)
+        self.assert_TPVE(parse_time, "25:00 today", None)
+        self.assert_TPVE(parse_time, "13/01/15", None)
 
         # Graphite accepts the following, we don't.
-        self.assert_TPVE(parse_time, "2015_02_01", None)
-        self.assert_TPVE(parse_time, "12:35 20150201", None)
-        self.assert_TPVE(parse_time, "12:3520150201", None)
-        self.assert_TPVE(parse_time, "12/31/99", None)
         self.assert_TPVE(parse_time, "6pm today", None)
-        self.assert_TPVE(parse_time, "noon tomorrow", None)
-        self.assert_TPVE(parse_time, "january 1", None)
-        self.assert_TPVE(parse_time, "monday", None)
+        self.assert_TPVE(parse_time, "now-2fortnights", None)
+        self.assert_TPVE(parse_time, "now-3hrs", None)
+
+    def test_parse_time_overflow(self):
+        """
+        If given a time_str that resolves to a time outside the range of
+        datetimes, a TimeParserValueError is raised.
+        """
+        now = datetime(2015, 2, 1, 0, 0, 0)
+        self.assert_TPVE(parse_time, "-99999999y", now)
+        self.assert_TPVE(parse_time, "99999999999999", now)
+
+    def test_to_timestamp(self):
+        """
+        Datetimes are converted to unix timestamps.
+        """
+        self.assertEqual(to_timestamp(datetime(1970, 1, 1)), 0)
+        self.assertEqual(
+            to_timestamp(datetime(2015, 2, 1, 0, 0, 0)), 1422748800)
+
+    def test_normalize_time(self):
+        """
+        Equivalent time specifiers are normalized to the same value.
+        """
+        self.assertEqual(normalize_time("-0s"), ("relative", 0))
+        self.assertEqual(normalize_time("now"), ("relative", 0))
+        self.assertEqual(normalize_time("-24h"), ("relative", -86400))
+        self.assertEqual(normalize_time("-1d"), ("relative", -86400))
+        self.assertEqual(normalize_time("now-1d"), ("relative", -86400))
+        self.assertEqual(
+            normalize_time("20150201"), ("absolute", 1422748800))
+        self.assertEqual(
+            normalize_time("00:00_20150201"), ("absolute", 1422748800))
+        self.assertEqual(
+            normalize_time("1422748800"), ("absolute", 1422748800))
+        self.assert_TPVE(normalize_time, "blahblah")
+
+    def test_normalize_time_anchored(self):
+        """
+        Time specifiers anchored to the current date are normalized to
+        absolute times resolved against ``now``.
+        """
+        now = datetime(2015, 2, 1, 10, 15, 25)
+        self.assertEqual(
+            normalize_time("today", now), ("absolute", 1422748800))
+        self.assertEqual(
+            normalize_time("midnight", now), ("absolute", 1422748800))
+        self.assertEqual(
+            normalize_time("yesterday+1d", now), ("absolute", 1422748800))
+        self.assertEqual(
+            normalize_time("tomorrow", now), ("absolute", 1422835200))
+
+
+class TestGraphiteTimeParserCaching(TestCase):
+    """
+    Tests for the caching of parsed intervals and time specifiers.
+    """
+
+    def setUp(self):
+        self.patch(graphite_time_parser, '_interval_cache', {})
+        self.patch(graphite_time_parser, '_time_cache', {})
+
+    def test_interval_to_seconds_cached(self):
+        """
+        Parsed intervals are cached.
+        """
+        self.assertEqual(interval_to_seconds("2h"), 7200)
+        self.assertEqual(graphite_time_parser._interval_cache, {"2h": 7200})
+        self.assertEqual(interval_to_seconds("2h"), 7200)
+
+    def test_normalize_time_cached(self):
+        """
+        Normalized time specifiers are cached, for both relative and absolute
+        specifiers.
+        """
+        for _ in range(2):
+            self.assertEqual(normalize_time("-1d"), ("relative", -86400))
+            self.assertEqual(
+                normalize_time("20150201"), ("absolute", 1422748800))
+        self.assertEqual(graphite_time_parser._time_cache, {
+            "-1d": ("relative", -86400),
+            "20150201": ("absolute", 1422748800),
+        })
+
+    def test_cached_values_used(self):
+        """
+        Cached values are returned without parsing the specifiers again.
+        """
+        graphite_time_parser._interval_cache["2h"] = 5
+        graphite_time_parser._time_cache["-1d"] = ("relative", -10)
+        self.assertEqual(interval_to_seconds("2h"), 5)
+        self.assertEqual(
+            parse_time("-1d", datetime(2015, 2, 2, 0, 0, 10)),
+            datetime(2015, 2, 2))
+
+    def test_cache_bounded(self):
+        """
+        The caches are emptied once they are full.
+        """
+        self.patch(graphite_time_parser, 'CACHE_SIZE', 2)
+        interval_to_seconds("1h")
+        interval_to_seconds("2h")
+        self.assertEqual(len(graphite_time_parser._interval_cache), 2)
+        interval_to_seconds("3h")
+        self.assertEqual(graphite_time_parser._interval_cache, {"3h": 10800})
+
+    def test_errors_not_cached(self):
+        """
+        Invalid specifiers are not cached, and raise each time they are
+        parsed.
+        """
+        for _ in range(2):
+            self.assertRaises(
+                TimeParserValueError, interval_to_seconds, "2fortnights")
+            self.assertRaises(TimeParserValueError, normalize_time, "blah")
+        self.assertEqual(graphite_time_parser._interval_cache, {})
+        self.assertEqual(graphite_time_parser._time_cache, {})
@@ -0,0 +1,239 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from confmodel.errors import ConfigError
+
+from go_metrics.metrics.base import BadMetricsQueryError
+from go_metrics.metrics.bulk import iter_records
+from go_metrics.metrics.graphite import GraphiteMetricsConfig
+from go_metrics.metrics.memory import (
+    MemoryBackend, MemoryBackendConfig, MemoryMetrics)
+from go_metrics.metrics.tests.helpers import points
+
+
+class TestMemoryMetrics(TestCase):
+    def mk_backend(self, **kw):
+        clock = Clock()
+        # 2015-02-01 00:00:00
+        clock.advance(1422748800)
+        self.patch(MemoryBackend, 'get_clock', lambda self: clock)
+        return MemoryBackend(kw)
+
+    @inlineCallbacks
+    def test_get(self):
+        backend = self.mk_backend()
+        metrics = MemoryMetrics(backend, 'owner-1')
+
+        yield metrics.fire(**{'stores.a.b.last': 1})
+        backend.clock.advance(30)
+        yield metrics.fire(**{'stores.a.b.last': 2})
+        backend.clock.advance(60)
+        yield metrics.fire(**{'stores.a.b.last': 3})
+
+        data = yield metrics.get(**{
+            'm': 'stores.a.b.last',
+            'from': '-5min',
+            'until': '-0s',
+            'interval': '1min',
+            'nulls': 'keep',
+        })
+
+        self.assertEqual(points(data), {
+            'stores.a.b.last': [
+                {'x': 1422748620000, 'y': None},
+                {'x': 1422748680000, 'y': None},
+                {'x': 1422748740000, 'y': None},
+                {'x': 1422748800000, 'y': 2.0},
+                {'x': 1422748860000, 'y': 3.0},
+                {'x': 1422748920000, 'y': None},
+            ]
+        })
+
+    @inlineCallbacks
+    def test_get_aggregators(self):
+        backend = self.mk_backend()
+        metrics = MemoryMetrics(backend, 'owner-1')
+
+        for value in (1, 2):
+            yield metrics.fire(**{
+                'stores.a.b.sum': value,
+                'stores.a.b.avg': value,
+                'stores.a.b.max': value,
+                'stores.a.b.min': value,
+            })
+            backend.clock.advance(60)
+
+        data = yield metrics.get(**{
+            'm': [
+                'stores.a.b.sum', 'stores.a.b.avg', 'stores.a.b.max',
+                'stores.a.b.min'],
+            'from': '-3min',
+            'until': '-1min',
+            'interval': '2min',
+        })
+
+        self.assertEqual(
+            dict((k, v.values()) for k, v in data.iteritems()), {
+                'stores.a.b.sum': [3.0, 0.0],
+                'stores.a.b.avg': [1.5, 0.0],
+                'stores.a.b.max': [2.0, 0.0],
+                'stores.a.b.min': [1.0, 0.0],
+            })
+
+    @inlineCallbacks
+    def test_get_formats(self):
+        backend = self.mk_backend()
+        metrics = MemoryMetrics(backend, 'owner-1')
+        yield metrics.fire(**{'stores.a.b.sum': 1})
+        backend.clock.advance(60)
+        yield metrics.fire(**{'stores.a.b.sum': 2})
+
+        data = yield metrics.get(**{
+            'm': 'stores.a.b.sum',
+            'from': '-2min',
+            'until': '-0s',
+            'interval': '1min',
+            'nulls': 'omit',
+            'format': 'columnar',
+        })
+
+        self.assertEqual(data, {
+            'stores.a.b.sum': {
+                'x': [1422748800000, 1422748860000],
+                'y': [1.0, 2.0],
+            },
+        })
+
+    @inlineCallbacks
+    def test_get_unknown_metric(self):
+        backend = self.mk_backend()
+        metrics = MemoryMetrics(backend, 'owner-1')
+        yield metrics.fire(**{'stores.a.b.last': 1})
+
+        # Metrics are only visible to their owner.
+        data = yield MemoryMetrics(backend, 'owner-2').get(
+            m='stores.a.b.last')
+        self.assertEqual(data, {})
+
+    @inlineCallbacks
+    def test_get_lower_resolution(self):
+        backend = self.mk_backend(retentions=['1min:1h', '1h:1d'])
+        metrics = MemoryMetrics(backend, 'owner-1')
+        yield metrics.fire(**{'stores.a.b.sum': 1})
+        backend.clock.advance(60)
+        yield metrics.fire(**{'stores.a.b.sum': 2})
+
+        data = yield metrics.get(
+            m='stores.a.b.sum', interval='1h', nulls='keep', **{
+                'from': '-30min', 'until': '-0s'})
+        self.assertEqual(points(data)['stores.a.b.sum'], [
+            {'x': 1422745200000, 'y': None},
+            {'x': 1422748800000, 'y': 3.0},
+        ])
+
+        # Windows older than an hour are read from the hourly archive.
+        data = yield metrics.get(
+            m='stores.a.b.sum', interval='1h', nulls='keep', **{
+                'from': '-2h', 'until': '-0s'})
+        self.assertEqual(points(data)['stores.a.b.sum'], [
+            {'x': 1422745200000, 'y': None},
+            {'x': 1422748800000, 'y': 3.0},
+            {'x': 1422752400000, 'y': None},
+        ])
+
+    @inlineCallbacks
+    def test_get_too_many_datapoints(self):
+        backend = self.mk_backend(max_response_size=10)
+        metrics = MemoryMetrics(backend, 'owner-1')
+        yield self.assertFailure(
+            metrics.get(m='stores.a.b.last', interval='1min'),
+            BadMetricsQueryError)
+
+    @inlineCallbacks
+    def test_get_batch(self):
+        backend = self.mk_backend()
+        metrics = MemoryMetrics(backend, 'owner-1')
+        yield metrics.fire(**{'stores.a.b.sum': 1, 'stores.a.c.sum': 2})
+
+        [a, c] = yield metrics.get_batch([
+            {'m': 'stores.a.b.sum', 'from': '-1min', 'interval': '1min'},
+            {'m': 'stores.a.c.sum', 'from': '-1min', 'interval': '1min'},
+        ])
+        self.assertEqual(a['stores.a.b.sum'].values(), [1.0, 0.0])
+        self.assertEqual(c['stores.a.c.sum'].values(), [2.0, 0.0])
+
+    @inlineCallbacks
+    def test_fire_bulk(self):
+        backend = self.mk_backend()
+        metrics = MemoryMetrics(backend, 'owner-1')
+
+        result = yield metrics.fire_bulk(iter_records(
+            '{"name": "stores.a.b.sum", "value": 1}\n'
+            '{"name": "stores.a.b.sum", "value": 2, '
+            '"timestamp": 1422748740}\n'
+            'foo\n'))
+        self.assertEqual(result['fired'], 2)
+        self.assertEqual(result['failed'], 1)
+
+        data = yield metrics.get(**{
+            'm': 'stores.a.b.sum',
+            'from': '-2min',
+            'until': '-0s',
+            'interval': '1min',
+            'nulls': 'omit',
+        })
+        self.assertEqual(data['stores.a.b.sum'].values(), [2.0, 1.0])
+
+    @inlineCallbacks
+    def test_fire_bulk_bad_timestamps(self):
+        backend = self.mk_backend(fire_max_timestamp_lead=60)
+        metrics = MemoryMetrics(backend, 'owner-1')
+
+        result = yield metrics.fire_bulk(iter_records(
+            '{"name": "stores.a.b.sum", "value": 1, "timestamp": NaN}\n'
+            '{"name": "stores.a.b.sum", "value": 1, "timestamp": 1e30}\n'
+            '{"name": "stores.a.b.sum", "value": 1, '
+            '"timestamp": 1422748800000}\n'))
+        self.assertEqual(result['fired'], 0)
+        self.assertEqual(result['failed'], 3)
+        self.assertEqual(len(backend.metrics), 0)
+
+    @inlineCallbacks
+    def test_max_metrics(self):
+        backend = self.mk_backend(max_metrics=1)
+        metrics = MemoryMetrics(backend, 'owner-1')
+        yield metrics.fire(**{'stores.a.b.sum': 1})
+        yield metrics.fire(**{'stores.a.c.sum': 1})
+
+        self.assertEqual(len(backend.metrics), 1)
+        self.assertEqual(
+            (yield metrics.get(m='stores.a.b.sum')), {})
+
+    @inlineCallbacks
+    def test_stats(self):
+        backend = self.mk_backend()
+        metrics = MemoryMetrics(backend, 'owner-1')
+        yield metrics.fire(**{'stores.a.b.sum': 1})
+        stats = backend.stats()
+        self.assertEqual(stats['metrics']['size'], 1)
+        self.assertEqual(stats['metric_cache']['size'], 1)
+
+
+class TestMemoryBackendConfig(TestCase):
+    def test_retentions(self):
+        MemoryBackendConfig({'retentions': ['1min:1h', '1h:1d']})
+        self.assertRaises(
+            ConfigError, MemoryBackendConfig, {'retentions': []})
+        self.assertRaises(
+            ConfigError, MemoryBackendConfig, {'retentions': ['foo']})
+        self.assertRaises(
+            ConfigError, MemoryBackendConfig,
+            {'retentions': ['1h:1d', '1min:1h']})
+
+    def test_model_fields(self):
+        # The fields read by the model it shares with the graphite backend
+        # come from their common config.
+        config = MemoryBackendConfig({})
+        for field in GraphiteMetricsConfig._get_fields():
+            getattr(config, field.name)
@@ -0,0 +1,88 @@
+import json
+
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.render_parser import RenderResponseParser
+
+
+class TestRenderResponseParser(TestCase):
+    def parse(self, data, chunk_size=None):
+        received = []
+        parser = RenderResponseParser(
+            lambda target, datapoints: received.append((target, datapoints)))
+
+        if chunk_size is None:
+            chunk_size = len(data) or 1
+        for i in range(0, len(data), chunk_size):
+            parser.feed(data[i:i + chunk_size])
+
+        parser.finish()
+        return received
+
+    def test_parse(self):
+        data = json.dumps([{
+            'target': 'stores.a.b.last',
+            'datapoints': [[5.0, 5695], [None, 5700]]
+        }, {
+            'target': 'stores.b.a.max',
+            'datapoints': [[12.0, 3724]]
+        }])
+
+        expected = [
+            ('stores.a.b.last', [[5.0, 5695], [None, 5700]]),
+            ('stores.b.a.max', [[12.0, 3724]]),
+        ]
+
+        for chunk_size in (None, 1, 2, 7, 64):
+            self.assertEqual(self.parse(data, chunk_size), expected)
+
+    def test_parse_incremental(self):
+        received = []
+        parser = RenderResponseParser(
+            lambda target, datapoints: received.append(target))
+
+        parser.feed('[{"target": "a", "datapoints": [[1.0, 5]]}, {"tar')
+        self.assertEqual(received, ['a'])
+        parser.feed('get": "b", "datapoints": []}')
+        self.assertEqual(received, ['a', 'b'])
+        parser.feed(' ]')
+        parser.finish()
+
+    def test_parse_discards_received_series(self):
+        parser = RenderResponseParser(lambda target, datapoints: None)
+        parser.feed('[{"target": "a", "datapoints": [[1.0, 5]]}, {"tar')
+        self.assertEqual(parser._buffer, '{"tar')
+
+    def test_parse_strings(self):
+        data = json.dumps([{
+            'target': 'alias(sumSeries(a.{b,c}), "}\\"[")',
+            'datapoints': [[1.0, 5]]
+        }])
+
+        expected = [('alias(sumSeries(a.{b,c}), "}\\"[")', [[1.0, 5]])]
+        for chunk_size in (None, 1, 3):
+            self.assertEqual(self.parse(data, chunk_size), expected)
+
+    def test_parse_empty(self):
+        self.assertEqual(self.parse('[]'), [])
+        self.assertEqual(self.parse(' [ ] '), [])
+        self.assertEqual(self.parse('{}'), [])
+        self.assertEqual(self.parse('{"foo": {"bar": "}"}}', 1), [])
+
+    def test_parse_invalid(self):
+        self.assertRaises(ValueError, self.parse, '')
+        self.assertRaises(ValueError, self.parse, ':(')
+        self.assertRaises(ValueError, self.parse, '[{"target": "a"')
+        self.assertRaises(ValueError, self.parse, '[{"target": "a"}')
+        self.assertRaises(ValueError, self.parse, '[{"target": "a}]')
+        self.assertRaises(ValueError, self.parse, '[}]')
+        self.assertRaises(ValueError, self.parse, '[{"target" "a"}]')
+
+    def test_parse_error_ignores_later_data(self):
+        received = []
+        parser = RenderResponseParser(
+            lambda target, datapoints: received.append(target))
+        parser.feed('[{"target" "a"}, ')
+        parser.feed('{"target": "b", "datapoints": []}]')
+        self.assertEqual(received, [])
+        self.assertRaises(ValueError, parser.finish)
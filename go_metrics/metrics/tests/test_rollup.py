@@ -0,0 +1,212 @@
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.base import MetricsBackendError
+from go_metrics.metrics.rollup import RollupMaterializer
+from go_metrics.metrics.series import Series
+
+
+# 2015-02-01 00:00:00
+NOW = 1422748800
+
+
+def shape(name='a.last', owner_id='owner-1', from_offset=-86400,
+          until_offset=0, interval=3600):
+    return (owner_id, name, from_offset, until_offset, interval)
+
+
+def render(from_time, until_time, interval, step=60):
+    """
+    Return the buckets graphite would return for a metric stored every
+    ``step`` seconds, summarized into ``interval`` second buckets.
+    """
+    first = from_time - from_time % step + step
+    xs = sorted(set(
+        t - t % interval for t in range(first, until_time + 1, step)))
+    return Series(xs, [1.0] * len(xs))
+
+
+class ToyRefresh(object):
+    def __init__(self):
+        self.calls = []
+        self.error = None
+
+    def __call__(self, owner_id, params):
+        self.calls.append((owner_id, params))
+        if self.error is not None:
+            return fail(self.error)
+        start = int(params['from']) + 1
+        return succeed(dict(
+            (name, Series([start, start + 3600], [1.0, 2.0]))
+            for name in params['m'] if name != 'missing.last'))
+
+
+class TestRollupMaterializer(TestCase):
+    def mk_rollups(self, max_shapes=2, max_datapoints=100, min_requests=2,
+                   max_age=60, check_interval=10, decay_interval=3600,
+                   max_tracked=10, step=60, refresh=None):
+        clock = Clock()
+        clock.advance(NOW + 30)
+        if refresh is None:
+            refresh = ToyRefresh()
+        rollups = RollupMaterializer(
+            refresh, clock, max_shapes, max_datapoints, min_requests,
+            max_age, check_interval, decay_interval, max_tracked, step)
+        self.addCleanup(rollups.stop)
+        return rollups
+
+    def record(self, rollups, shapes, times=1):
+        for _ in range(times):
+            rollups.record(shapes, '1hour')
+
+    def test_admission(self):
+        rollups = self.mk_rollups(max_shapes=2, min_requests=2)
+        self.record(rollups, [shape('a.last'), shape('b.last')], times=3)
+        self.record(rollups, [shape('c.last')], times=4)
+        self.record(rollups, [shape('d.last')])
+
+        rollups.clock.advance(10)
+        # The two shapes requested most are materialized, and only once
+        # requested often enough.
+        self.assertEqual(
+            rollups.admitted, set([shape('c.last'), shape('b.last')]))
+        self.assertEqual(rollups.lookup([shape('a.last')]), None)
+        self.assertEqual(rollups.stats()['admitted'], 2)
+        self.assertEqual(rollups.stats()['tracked'], 4)
+
+    def test_refresh(self):
+        rollups = self.mk_rollups()
+        self.record(rollups, [shape('a.last'), shape('b.last')], times=2)
+        self.assertEqual(rollups.lookup([shape('a.last')]), None)
+
+        rollups.clock.advance(10)
+        # Shapes with the same owner, time range and interval are refreshed
+        # together, for the time range at the time of the refresh.
+        self.assertEqual(rollups.refresh.calls, [('owner-1', {
+            'm': ['a.last', 'b.last'],
+            'from': str(NOW + 40 - 86400),
+            'until': str(NOW + 40),
+            'interval': '1hour',
+        })])
+
+        data = rollups.lookup([shape('a.last'), shape('b.last')])
+        self.assertEqual(sorted(data), ['a.last', 'b.last'])
+        self.assertEqual(list(data['a.last'].y), [1.0, 2.0])
+        self.assertEqual(rollups.stats()['served'], 1)
+
+    def test_refresh_missing(self):
+        rollups = self.mk_rollups()
+        self.record(
+            rollups, [shape('a.last'), shape('missing.last')], times=2)
+        rollups.clock.advance(10)
+
+        # Metrics graphite returned nothing for are left out of the results.
+        data = rollups.lookup([shape('a.last'), shape('missing.last')])
+        self.assertEqual(sorted(data), ['a.last'])
+
+    def test_refresh_max_age(self):
+        rollups = self.mk_rollups(max_age=60, check_interval=10)
+        self.record(rollups, [shape()], times=2)
+        rollups.clock.advance(10)
+        self.assertEqual(len(rollups.refresh.calls), 1)
+
+        # Shapes are refreshed before their results get too old to serve.
+        rollups.clock.advance(49)
+        self.assertEqual(len(rollups.refresh.calls), 1)
+        rollups.clock.advance(1)
+        self.assertEqual(len(rollups.refresh.calls), 2)
+        self.assertNotEqual(rollups.lookup([shape()]), None)
+
+    def test_refresh_bucket_boundary(self):
+        rollups = self.mk_rollups(max_age=3600)
+        self.record(rollups, [shape(interval=60)], times=2)
+        rollups.clock.advance(10)
+        self.assertEqual(len(rollups.refresh.calls), 1)
+
+        # The results stop being served as the next bucket starts, and are
+        # refreshed then.
+        rollups.clock.advance(19)
+        self.assertNotEqual(rollups.lookup([shape(interval=60)]), None)
+        rollups.refresh.error = MetricsBackendError("Oops")
+        rollups.clock.advance(1)
+        self.assertEqual(len(rollups.refresh.calls), 2)
+        self.assertEqual(rollups.refresh.calls[-1][1]['until'], str(NOW + 60))
+        self.assertEqual(rollups.lookup([shape(interval=60)]), None)
+
+    def test_refresh_matches_query(self):
+        def refresh(owner_id, params):
+            return succeed({'a.last': render(
+                int(params['from']), int(params['until']), 300)})
+
+        rollups = self.mk_rollups(max_age=3600, refresh=refresh)
+        rollup_shape = shape(from_offset=-3630, until_offset=-30, interval=300)
+        self.record(rollups, [rollup_shape], times=2)
+
+        # The results served always have the buckets a query for the shape
+        # would return at the time.
+        served = 0
+        for _ in range(1000):
+            rollups.clock.advance(10)
+            self.record(rollups, [rollup_shape])
+            data = rollups.lookup([rollup_shape])
+            if data is None:
+                continue
+            served += 1
+            now = int(rollups.clock.seconds())
+            self.assertEqual(
+                data['a.last'], render(now - 3630, now - 30, 300))
+        self.assertEqual(served, 1000)
+
+    def test_refresh_failed(self):
+        rollups = self.mk_rollups(check_interval=10)
+        rollups.refresh.error = MetricsBackendError("Oops")
+        self.record(rollups, [shape()], times=2)
+        rollups.clock.advance(10)
+        self.assertEqual(rollups.stats()['errors'], 1)
+        self.assertEqual(rollups.lookup([shape()]), None)
+
+        # The refresh is retried after the check interval.
+        rollups.refresh.error = None
+        rollups.clock.advance(10)
+        self.assertEqual(len(rollups.refresh.calls), 2)
+        self.assertNotEqual(rollups.lookup([shape()]), None)
+
+    def test_decay(self):
+        rollups = self.mk_rollups(min_requests=2, decay_interval=3600)
+        self.record(rollups, [shape('a.last')], times=4)
+        self.record(rollups, [shape('b.last')], times=1)
+        rollups.clock.advance(10)
+        self.assertEqual(rollups.admitted, set([shape('a.last')]))
+
+        rollups.clock.advance(3600)
+        # Counts are halved, and shapes no longer requested are forgotten.
+        self.assertEqual(rollups.counts, {shape('a.last'): 2})
+        rollups.clock.advance(3600)
+        self.assertEqual(rollups.counts, {shape('a.last'): 1})
+        self.assertEqual(rollups.admitted, set())
+        self.assertEqual(rollups.lookup([shape('a.last')]), None)
+
+    def test_max_tracked(self):
+        rollups = self.mk_rollups(max_tracked=1)
+        self.record(rollups, [shape('a.last'), shape('b.last')])
+        self.assertEqual(rollups.counts, {shape('a.last'): 1})
+        self.assertEqual(rollups.stats()['untracked'], 1)
+
+    def test_max_datapoints(self):
+        rollups = self.mk_rollups(max_datapoints=3)
+        self.record(rollups, [shape('a.last'), shape('b.last')], times=2)
+        rollups.clock.advance(10)
+
+        # Each shape holds 2 datapoints, so only one fits.
+        self.assertEqual(rollups.results.cost, 2)
+        self.assertEqual(rollups.lookup([shape('a.last')]), None)
+        self.assertNotEqual(rollups.lookup([shape('b.last')]), None)
+
+    def test_stop(self):
+        rollups = self.mk_rollups()
+        self.record(rollups, [shape()], times=2)
+        rollups.stop()
+        rollups.clock.advance(10)
+        self.assertEqual(rollups.refresh.calls, [])
+        self.assertEqual(rollups.clock.getDelayedCalls(), [])
@@ -0,0 +1,185 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.base import (
+    MetricsBackendBusyError, MetricsThrottledError)
+from go_metrics.metrics.schedule import QueryScheduler
+
+
+class TestQueryScheduler(TestCase):
+    def mk_scheduler(self, max_running=2, max_running_per_owner=2,
+                     max_queued=10, max_queued_per_owner=5, quantum=1,
+                     weights=None):
+        self.clock = Clock()
+        return QueryScheduler(
+            max_running, max_running_per_owner, max_queued,
+            max_queued_per_owner, quantum, self.clock, weights=weights)
+
+    def mk_calls(self):
+        calls = []
+
+        def call(name):
+            d = Deferred()
+            calls.append((name, d))
+            return d
+
+        return calls, call
+
+    def test_non_positive_allowance(self):
+        self.assertRaises(AssertionError, self.mk_scheduler, quantum=0)
+        self.assertRaises(AssertionError, self.mk_scheduler, quantum=-1)
+        self.assertRaises(
+            AssertionError, self.mk_scheduler, weights={'owner-1': 0})
+
+    def test_run(self):
+        scheduler = self.mk_scheduler()
+        d = scheduler.run('owner-1', 1, lambda x: x * 2, 21)
+        self.assertEqual(self.successResultOf(d), 42)
+        self.assertEqual(scheduler.running, 0)
+        self.assertEqual(scheduler.queued, 0)
+
+    def test_run_failure(self):
+        scheduler = self.mk_scheduler()
+
+        def fail():
+            raise ValueError(':(')
+
+        self.failureResultOf(scheduler.run('owner-1', 1, fail), ValueError)
+        self.assertEqual(scheduler.running, 0)
+
+    def test_run_global_limit(self):
+        scheduler = self.mk_scheduler(max_running=2)
+        calls, call = self.mk_calls()
+
+        d1 = scheduler.run('owner-1', 1, call, 'a')
+        scheduler.run('owner-2', 1, call, 'b')
+        d3 = scheduler.run('owner-3', 1, call, 'c')
+
+        self.assertEqual([name for name, _ in calls], ['a', 'b'])
+        self.assertEqual(scheduler.queued, 1)
+        self.assertNoResult(d3)
+
+        calls[0][1].callback('foo')
+        self.assertEqual(self.successResultOf(d1), 'foo')
+        self.assertEqual([name for name, _ in calls], ['a', 'b', 'c'])
+
+        calls[2][1].callback('bar')
+        self.assertEqual(self.successResultOf(d3), 'bar')
+
+    def test_run_owner_limit(self):
+        scheduler = self.mk_scheduler(
+            max_running=3, max_running_per_owner=1)
+        calls, call = self.mk_calls()
+
+        scheduler.run('owner-1', 1, call, 'a1')
+        scheduler.run('owner-1', 1, call, 'a2')
+        scheduler.run('owner-2', 1, call, 'b1')
+
+        # owner-1's second query waits even though there is room overall.
+        self.assertEqual([name for name, _ in calls], ['a1', 'b1'])
+
+        calls[0][1].callback(None)
+        self.assertEqual([name for name, _ in calls], ['a1', 'b1', 'a2'])
+
+    def test_run_fair_queuing(self):
+        scheduler = self.mk_scheduler(max_running=1)
+        calls, call = self.mk_calls()
+
+        scheduler.run('owner-1', 1, call, 'blocker')
+        for i in range(3):
+            scheduler.run('owner-1', 1, call, 'a%d' % i)
+        for i in range(2):
+            scheduler.run('owner-2', 1, call, 'b%d' % i)
+
+        while len(calls) < 6:
+            calls[-1][1].callback(None)
+
+        self.assertEqual(
+            [name for name, _ in calls],
+            ['blocker', 'a0', 'b0', 'a1', 'b1', 'a2'])
+
+    def test_run_fair_queuing_costs(self):
+        scheduler = self.mk_scheduler(max_running=1, quantum=2)
+        calls, call = self.mk_calls()
+
+        scheduler.run('owner-1', 1, call, 'blocker')
+        for i in range(2):
+            scheduler.run('owner-1', 4, call, 'a%d' % i)
+        for i in range(4):
+            scheduler.run('owner-2', 1, call, 'b%d' % i)
+
+        while len(calls) < 7:
+            calls[-1][1].callback(None)
+
+        # owner-1's queries cost twice its quantum, so owner-2 runs twice as
+        # many of its cheaper queries in the meantime.
+        self.assertEqual(
+            [name for name, _ in calls],
+            ['blocker', 'b0', 'b1', 'a0', 'b2', 'b3', 'a1'])
+
+    def test_run_fair_queuing_weights(self):
+        scheduler = self.mk_scheduler(
+            max_running=1, weights={'owner-2': 2})
+        calls, call = self.mk_calls()
+
+        scheduler.run('owner-1', 1, call, 'blocker')
+        for i in range(2):
+            scheduler.run('owner-1', 1, call, 'a%d' % i)
+        for i in range(4):
+            scheduler.run('owner-2', 1, call, 'b%d' % i)
+
+        while len(calls) < 7:
+            calls[-1][1].callback(None)
+
+        self.assertEqual(
+            [name for name, _ in calls],
+            ['blocker', 'a0', 'b0', 'b1', 'a1', 'b2', 'b3'])
+
+    def test_run_owner_queue_full(self):
+        scheduler = self.mk_scheduler(
+            max_running=1, max_queued_per_owner=1)
+        calls, call = self.mk_calls()
+
+        scheduler.run('owner-1', 1, call, 'a1')
+        scheduler.run('owner-1', 1, call, 'a2')
+        d = scheduler.run('owner-1', 1, call, 'a3')
+        self.failureResultOf(d, MetricsThrottledError)
+
+        # Other owners can still queue queries.
+        d = scheduler.run('owner-2', 1, call, 'b1')
+        self.assertNoResult(d)
+        self.assertEqual(scheduler.rejected, 1)
+
+    def test_run_queue_full(self):
+        scheduler = self.mk_scheduler(max_running=1, max_queued=2)
+        calls, call = self.mk_calls()
+
+        scheduler.run('owner-1', 1, call, 'a1')
+        scheduler.run('owner-1', 1, call, 'a2')
+        scheduler.run('owner-2', 1, call, 'b1')
+        d = scheduler.run('owner-3', 1, call, 'c1')
+        self.failureResultOf(d, MetricsBackendBusyError)
+        self.assertEqual(scheduler.rejected, 1)
+
+    def test_stats(self):
+        scheduler = self.mk_scheduler(max_running=1)
+        calls, call = self.mk_calls()
+
+        scheduler.run('owner-1', 1, call, 'a1')
+        scheduler.run('owner-1', 1, call, 'a2')
+        scheduler.run('owner-2', 1, call, 'b1')
+        self.clock.advance(2)
+        calls[0][1].callback(None)
+        self.clock.advance(2)
+        calls[1][1].callback(None)
+
+        self.assertEqual(scheduler.stats(), {
+            'running': 1,
+            'queued': 0,
+            'started': 3,
+            'rejected': 0,
+            'mean_queue_time': 2,
+            'max_queue_time': 4,
+            'owners': 1,
+        })
@@ -0,0 +1,128 @@
+import json
+
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.series import (
+    Series, NULL, is_null, json_default, null_indices, null_runs,
+    keep_nulls, omit_nulls, zeroize_nulls, ffill_nulls, bfill_nulls,
+    interpolate_nulls)
+from go_metrics.metrics.tests.helpers import mk_series
+
+
+class TestSeries(TestCase):
+    def test_is_null(self):
+        self.assertTrue(is_null(NULL))
+        self.assertFalse(is_null(0.0))
+        self.assertFalse(is_null(None))
+
+    def test_from_datapoints(self):
+        series = Series.from_datapoints([[5.0, 5695], [None, 5700]])
+        self.assertEqual(series.x.tolist(), [5695, 5700])
+        self.assertEqual(series.values(), [5.0, None])
+        self.assertEqual(series.x.typecode, 'l')
+        self.assertEqual(series.y.typecode, 'd')
+
+    def test_from_datapoints_empty(self):
+        self.assertEqual(len(Series.from_datapoints([])), 0)
+
+    def test_equality(self):
+        self.assertEqual(
+            Series([1, 2], [1.0, NULL]), Series([1, 2], [1.0, NULL]))
+        self.assertNotEqual(
+            Series([1, 2], [1.0, NULL]), Series([1, 2], [1.0, 0.0]))
+        self.assertNotEqual(
+            Series([1, 2], [1.0, NULL]), Series([1, 3], [1.0, NULL]))
+        self.assertNotEqual(Series([1], [1.0]), [{'x': 1000, 'y': 1.0}])
+
+    def test_to_points(self):
+        series = Series([5695, 5700], [5.0, NULL])
+        self.assertEqual(series.to_points(), [
+            {'x': 5695000, 'y': 5.0},
+            {'x': 5700000, 'y': None},
+        ])
+
+    def test_to_columns(self):
+        series = Series([5695, 5700], [5.0, NULL])
+        self.assertEqual(series.to_columns(), {
+            'x': [5695000, 5700000],
+            'y': [5.0, None],
+        })
+
+    def test_since(self):
+        series = Series([60, 120, 180], [1.0, NULL, 3.0])
+        self.assertEqual(series.since(120), Series([120, 180], [NULL, 3.0]))
+        self.assertEqual(series.since(121), Series([180], [3.0]))
+        self.assertEqual(series.since(0), series)
+        self.assertEqual(series.since(181), Series())
+
+    def test_before(self):
+        series = Series([60, 120, 180], [1.0, NULL, 3.0])
+        self.assertEqual(series.before(180), Series([60, 120], [1.0, NULL]))
+        self.assertEqual(series.before(121), Series([60, 120], [1.0, NULL]))
+        self.assertEqual(series.before(181), series)
+        self.assertEqual(series.before(60), Series())
+
+    def test_json_default(self):
+        data = {'foo': Series([5695], [5.0])}
+        self.assertEqual(
+            json.loads(json.dumps(data, default=json_default)),
+            {'foo': [{'x': 5695000, 'y': 5.0}]})
+        self.assertRaises(
+            TypeError, json.dumps, object(), default=json_default)
+
+
+class TestNullPolicies(TestCase):
+    def test_null_indices(self):
+        series = mk_series(NULL, 1.0, NULL, NULL, 2.0, NULL)
+        self.assertEqual(list(null_indices(series.y)), [0, 2, 3, 5])
+
+    def test_null_runs(self):
+        series = mk_series(NULL, 1.0, NULL, NULL, 2.0, NULL)
+        self.assertEqual(list(null_runs(series.y)), [(0, 0), (2, 3), (5, 5)])
+        self.assertEqual(list(null_runs(mk_series(1.0).y)), [])
+
+    def test_keep(self):
+        series = mk_series(NULL, 1.0)
+        self.assertTrue(keep_nulls(series) is series)
+
+    def test_omit(self):
+        series = omit_nulls(mk_series(NULL, 1.0, NULL, NULL, 2.0, NULL))
+        self.assertEqual(series, Series([10, 40], [1.0, 2.0]))
+
+    def test_omit_no_nulls(self):
+        series = mk_series(1.0, 2.0)
+        self.assertTrue(omit_nulls(series) is series)
+
+    def test_zeroize(self):
+        series = zeroize_nulls(mk_series(NULL, 1.0, NULL, 2.0))
+        self.assertEqual(series, mk_series(0.0, 1.0, 0.0, 2.0))
+
+    def test_zeroize_does_not_modify_original(self):
+        original = mk_series(NULL, 1.0)
+        zeroize_nulls(original)
+        self.assertEqual(original, mk_series(NULL, 1.0))
+
+    def test_ffill(self):
+        series = ffill_nulls(mk_series(NULL, 1.0, NULL, NULL, 2.0, NULL))
+        self.assertEqual(series, mk_series(NULL, 1.0, 1.0, 1.0, 2.0, 2.0))
+
+    def test_bfill(self):
+        series = bfill_nulls(mk_series(NULL, 1.0, NULL, NULL, 2.0, NULL))
+        self.assertEqual(series, mk_series(1.0, 1.0, 2.0, 2.0, 2.0, NULL))
+
+    def test_interpolate(self):
+        series = interpolate_nulls(
+            mk_series(NULL, 1.0, NULL, NULL, 4.0, NULL, 2.0, NULL))
+        self.assertEqual(
+            series, mk_series(NULL, 1.0, 2.0, 3.0, 4.0, 3.0, 2.0, NULL))
+
+    def test_interpolate_uneven_timestamps(self):
+        series = interpolate_nulls(
+            Series([0, 10, 40], [0.0, NULL, 8.0]))
+        self.assertEqual(series, Series([0, 10, 40], [0.0, 2.0, 8.0]))
+
+    def test_empty(self):
+        for policy in (
+                omit_nulls, zeroize_nulls, ffill_nulls, bfill_nulls,
+                interpolate_nulls):
+            self.assertEqual(policy(Series()), Series())
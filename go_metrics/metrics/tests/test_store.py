@@ -0,0 +1,44 @@
+from twisted.trial.unittest import TestCase
+
+from confmodel.errors import ConfigError
+
+from go_metrics.metrics.store import RingBuffer, parse_retention
+
+
+class TestParseRetention(TestCase):
+    def test_parse_retention(self):
+        self.assertEqual(parse_retention('1min:6h'), (60, 360))
+        self.assertEqual(parse_retention('10s:1min'), (10, 6))
+
+    def test_parse_retention_invalid(self):
+        self.assertRaises(ConfigError, parse_retention, '1min')
+        self.assertRaises(ConfigError, parse_retention, '1min:6h:1d')
+        self.assertRaises(ConfigError, parse_retention, '1fortnight:6h')
+        self.assertRaises(ConfigError, parse_retention, '0s:6h')
+        self.assertRaises(ConfigError, parse_retention, '1h:1min')
+
+
+class TestRingBuffer(TestCase):
+    def test_add(self):
+        buf = RingBuffer(60, 3)
+        buf.add(120, 1.0)
+        buf.add(150, 2.0)
+        buf.add(180, 3.0)
+        self.assertEqual(buf.fetch(60, 180, 'sum'), (120, [3.0, 3.0]))
+        self.assertEqual(buf.fetch(60, 180, 'last'), (120, [2.0, 3.0]))
+
+    def test_add_wraps(self):
+        buf = RingBuffer(60, 3)
+        buf.add(0, 1.0)
+        buf.add(60, 2.0)
+        buf.add(180, 4.0)
+        self.assertEqual(
+            buf.fetch(-60, 180, 'sum'), (0, [None, 2.0, None, 4.0]))
+
+        # Values older than the datapoint in their slot are dropped.
+        buf.add(0, 5.0)
+        self.assertEqual(buf.fetch(-60, 0, 'sum'), (0, [None]))
+
+    def test_fetch_empty(self):
+        buf = RingBuffer(60, 3)
+        self.assertEqual(buf.fetch(0, 120, 'sum'), (60, [None, None]))
@@ -0,0 +1,232 @@
+from twisted.internet.defer import fail, inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.base import (
+    BadMetricsQueryError, MetricsBackendBusyError, MetricsBackendError)
+from go_metrics.metrics.memory import MemoryBackend
+from go_metrics.metrics.series import Series
+from go_metrics.metrics.stream import StreamHub
+
+
+# 2015-02-01 00:00:00
+NOW = 1422748800
+
+
+class ToyMetrics(object):
+    def __init__(self, owner_id='owner-1', result=None):
+        self.owner_id = owner_id
+        self.result = result
+        self.gets = []
+
+    def get(self, **kw):
+        self.gets.append(kw)
+        if isinstance(self.result, Exception):
+            return fail(self.result)
+        if self.result is not None:
+            return self.result
+
+        start, end = int(kw['from']) + 1, int(kw['until']) + 1
+        xs = range(start, end + 1, 60)
+        return dict(
+            (name, Series(xs, [1.0] * len(xs))) for name in kw['m'])
+
+
+class TestStreamHub(TestCase):
+    def mk_hub(self, settle_time=0, retry_interval=10, max_age=3600,
+               max_subscriptions=10):
+        clock = Clock()
+        clock.advance(NOW + 30)
+        return StreamHub(
+            clock, settle_time, retry_interval, max_age, max_subscriptions)
+
+    def subscribe(self, hub, model, **query):
+        events = []
+        sub = hub.subscribe(
+            model, query, lambda event_id, data: events.append(
+                (event_id, data)))
+        return sub, events
+
+    def test_subscribe(self):
+        hub = self.mk_hub()
+        model = ToyMetrics()
+        _sub, events = self.subscribe(hub, model, m='a.last', interval='1min')
+
+        hub.clock.advance(29)
+        self.assertEqual(events, [])
+
+        hub.clock.advance(1)
+        self.assertEqual(model.gets, [{
+            'm': ['a.last'],
+            'interval': '1min',
+            'nulls': 'zeroize',
+            'format': 'points',
+            'from': str(NOW - 1),
+            'until': str(NOW + 59),
+        }])
+
+        # The backend's bucket starting at the end of the range isn't
+        # closed yet, and isn't sent.
+        self.assertEqual(events, [
+            ((NOW + 60) * 1000, {'a.last': Series([NOW], [1.0])}),
+        ])
+
+        hub.clock.advance(60)
+        self.assertEqual(events[-1], (
+            (NOW + 120) * 1000, {'a.last': Series([NOW + 60], [1.0])}))
+
+    def test_subscribe_shared(self):
+        hub = self.mk_hub()
+        model = ToyMetrics()
+        _sub1, events1 = self.subscribe(
+            hub, model, m=['a.last', 'b.last'], interval='1min')
+        _sub2, events2 = self.subscribe(
+            hub, model, m=['b.last', 'a.last'], interval='1min')
+        _sub3, events3 = self.subscribe(
+            hub, ToyMetrics('owner-2'), m='a.last', interval='1min')
+
+        self.assertEqual(hub.stats()['live'], 2)
+        self.assertEqual(hub.stats()['fanout'], [1, 2])
+
+        hub.clock.advance(30)
+        # The subscribers to the same metrics share a single query.
+        self.assertEqual(len(model.gets), 1)
+        self.assertEqual(events1, events2)
+        self.assertEqual(len(events3), 1)
+        self.assertEqual(hub.stats()['refreshes'], 2)
+        self.assertEqual(hub.stats()['events'], 3)
+
+    def test_settle_time(self):
+        hub = self.mk_hub(settle_time=10)
+        model = ToyMetrics()
+        _sub, events = self.subscribe(hub, model, m='a.last', interval='1min')
+
+        hub.clock.advance(30)
+        self.assertEqual(events, [])
+        hub.clock.advance(10)
+        self.assertEqual(len(events), 1)
+
+    def test_unsubscribe(self):
+        hub = self.mk_hub()
+        model = ToyMetrics()
+        sub, events = self.subscribe(hub, model, m='a.last', interval='1min')
+        hub.unsubscribe(sub)
+        self.assertTrue(sub.done.called)
+
+        # The refresh loop is stopped once it has no subscribers.
+        hub.clock.advance(60)
+        self.assertEqual(model.gets, [])
+        self.assertEqual(hub.stats()['live'], 0)
+        self.assertEqual(hub.stats()['subscriptions'], 0)
+
+    def test_expiry(self):
+        hub = self.mk_hub(max_age=90)
+        model = ToyMetrics()
+        sub, events = self.subscribe(hub, model, m='a.last', interval='1min')
+
+        hub.clock.advance(89)
+        self.assertFalse(sub.done.called)
+        hub.clock.advance(1)
+        self.assertTrue(sub.done.called)
+        self.assertEqual(hub.stats()['expired'], 1)
+        self.assertEqual(hub.stats()['live'], 0)
+
+    def test_refresh_failed(self):
+        hub = self.mk_hub(retry_interval=10)
+        model = ToyMetrics(result=MetricsBackendError("Oops"))
+        _sub, events = self.subscribe(hub, model, m='a.last', interval='1min')
+
+        hub.clock.advance(30)
+        self.assertEqual(hub.stats()['errors'], 1)
+
+        # The buckets are asked for again.
+        model.result = None
+        hub.clock.advance(10)
+        self.assertEqual(model.gets[-1]['from'], str(NOW - 1))
+        self.assertEqual(len(events), 1)
+
+    def test_send_failed(self):
+        hub = self.mk_hub()
+        model = ToyMetrics()
+
+        def send(event_id, data):
+            raise ValueError("Oops")
+
+        bad = hub.subscribe(
+            model, {'m': 'a.last', 'interval': '1min'}, send)
+        done = []
+        bad.done.addCallback(done.append)
+        _sub, events = self.subscribe(hub, model, m='a.last', interval='1min')
+
+        for _ in range(5):
+            hub.clock.advance(60)
+
+        # The failing subscriber is dropped, and the other still gets every
+        # bucket.
+        self.assertEqual(done, [None])
+        self.assertEqual(
+            [event_id for event_id, _data in events],
+            [(NOW + 60 * i) * 1000 for i in range(1, 6)])
+        self.assertEqual(hub.stats()['dropped'], 1)
+        self.assertEqual(hub.stats()['subscriptions'], 1)
+        self.assertEqual(hub.stats()['errors'], 0)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    @inlineCallbacks
+    def test_subscribe_memory_backend(self):
+        clock = Clock()
+        clock.advance(NOW)
+        self.patch(MemoryBackend, 'get_clock', lambda self: clock)
+        backend = MemoryBackend({})
+        model = backend.get_model('owner-1')
+        hub = StreamHub(clock, 0, 10, 3600, 10)
+
+        events = []
+        hub.subscribe(
+            model, {'m': 'stores.a.last', 'interval': '1min'},
+            lambda event_id, data: events.append((event_id, data)))
+
+        clock.advance(30)
+        yield model.fire(**{'stores.a.last': 1.0})
+        clock.advance(30)
+        yield model.fire(**{'stores.a.last': 2.0})
+        clock.advance(60)
+
+        self.assertEqual(hub.stats()['errors'], 0)
+        self.assertEqual(events, [
+            ((NOW + 60) * 1000, {'stores.a.last': Series([NOW], [1.0])}),
+            ((NOW + 120) * 1000, {
+                'stores.a.last': Series([NOW + 60], [2.0])}),
+        ])
+
+    def test_subscribe_invalid(self):
+        hub = self.mk_hub()
+        model = ToyMetrics()
+        self.assertRaises(
+            BadMetricsQueryError, self.subscribe, hub, model)
+        self.assertRaises(
+            BadMetricsQueryError, self.subscribe, hub, model,
+            m='a.last', interval='foo')
+        self.assertRaises(
+            BadMetricsQueryError, self.subscribe, hub, model,
+            m='a.last', nulls='foo')
+        self.assertRaises(
+            BadMetricsQueryError, self.subscribe, hub, model,
+            m='a.last', **{'from': '-1d'})
+
+    def test_max_subscriptions(self):
+        hub = self.mk_hub(max_subscriptions=1)
+        model = ToyMetrics()
+        self.subscribe(hub, model, m='a.last')
+        self.assertRaises(
+            MetricsBackendBusyError, self.subscribe, hub, model, m='b.last')
+
+    def test_close(self):
+        hub = self.mk_hub()
+        model = ToyMetrics()
+        sub1, _ = self.subscribe(hub, model, m='a.last')
+        sub2, _ = self.subscribe(hub, model, m='b.last')
+        hub.close()
+        self.assertTrue(sub1.done.called)
+        self.assertTrue(sub2.done.called)
+        self.assertEqual(hub.stats()['subscriptions'], 0)
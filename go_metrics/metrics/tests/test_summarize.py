@@ -0,0 +1,45 @@
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.series import NULL, Series
+from go_metrics.metrics.summarize import summarize
+
+
+class TestSummarize(TestCase):
+    def test_summarize(self):
+        self.assertEqual(
+            summarize(0, 10, [1, 2, None, 4, 5, 6], 30, 'sum', False),
+            Series([0, 30, 60], [3, 15, NULL]))
+
+    def test_summarize_aggregators(self):
+        values = [1, 3, 2, None, 5, 4]
+        self.assertEqual(
+            summarize(0, 10, values, 30, 'avg', False).values(),
+            [2.0, 4.5, None])
+        self.assertEqual(
+            summarize(0, 10, values, 30, 'max', False).values(),
+            [3, 5, None])
+        self.assertEqual(
+            summarize(0, 10, values, 30, 'min', False).values(),
+            [1, 4, None])
+        self.assertEqual(
+            summarize(0, 10, values, 30, 'last', False).values(),
+            [2, 4, None])
+
+    def test_summarize_unaligned_start(self):
+        self.assertEqual(
+            summarize(15, 10, [1, 2, 3], 20, 'sum', False),
+            Series([0, 20, 40], [1, 5, NULL]))
+
+    def test_summarize_align_to_from(self):
+        self.assertEqual(
+            summarize(15, 10, [1, 2, 3], 20, 'sum', True),
+            Series([15, 35], [3, 3]))
+
+    def test_summarize_empty_buckets(self):
+        self.assertEqual(
+            summarize(0, 10, [None, None, 1], 20, 'sum', False),
+            Series([0, 20], [NULL, 1]))
+
+    def test_summarize_no_values(self):
+        self.assertEqual(
+            summarize(0, 10, [], 20, 'sum', False), Series([0], [NULL]))
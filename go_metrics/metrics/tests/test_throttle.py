@@ -0,0 +1,63 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go_metrics.metrics.throttle import TokenBuckets
+
+
+class TestTokenBuckets(TestCase):
+    def mk_buckets(self, rate=10, capacity=100, max_buckets=10000):
+        self.clock = Clock()
+        return TokenBuckets(
+            rate, capacity, self.clock, max_buckets=max_buckets)
+
+    def test_spend(self):
+        buckets = self.mk_buckets()
+        self.assertEqual(buckets.tokens('foo'), 100)
+        self.assertEqual(buckets.spend('foo', 60), 0)
+        self.assertEqual(buckets.tokens('foo'), 40)
+        self.assertEqual(buckets.spend('foo', 40), 0)
+        self.assertEqual(buckets.tokens('foo'), 0)
+
+        # Other keys have their own buckets.
+        self.assertEqual(buckets.tokens('bar'), 100)
+
+    def test_spend_exhausted(self):
+        buckets = self.mk_buckets()
+        buckets.spend('foo', 80)
+        self.assertEqual(buckets.spend('foo', 50), 3)
+        # Rejected costs aren't taken from the bucket.
+        self.assertEqual(buckets.tokens('foo'), 20)
+
+    def test_spend_refilled(self):
+        buckets = self.mk_buckets()
+        buckets.spend('foo', 100)
+        self.clock.advance(3)
+        self.assertEqual(buckets.tokens('foo'), 30)
+        self.assertEqual(buckets.spend('foo', 30), 0)
+        self.clock.advance(100)
+        self.assertEqual(buckets.tokens('foo'), 100)
+
+    def test_spend_more_than_capacity(self):
+        buckets = self.mk_buckets()
+        self.assertEqual(buckets.spend('foo', 500), 0)
+        self.assertEqual(buckets.tokens('foo'), 0)
+        self.assertEqual(buckets.spend('foo', 500), 10)
+
+    def test_full_buckets_discarded(self):
+        buckets = self.mk_buckets(max_buckets=2)
+        buckets.spend('foo', 10)
+        buckets.spend('bar', 50)
+        self.clock.advance(1)
+        buckets.spend('baz', 10)
+        self.assertEqual(sorted(buckets._buckets.keys()), ['bar', 'baz'])
+
+    def test_stats(self):
+        buckets = self.mk_buckets()
+        buckets.spend('foo', 60)
+        buckets.spend('foo', 60)
+        buckets.spend('bar', 10)
+        self.assertEqual(buckets.stats(), {
+            'buckets': 2,
+            'spent': 70,
+            'rejected': 1,
+        })
@@ -0,0 +1,90 @@
+from twisted.trial.unittest import TestCase
+
+from vumi.blinkenlights.metrics import SUM
+
+from go_metrics.metrics.graphite import CompiledMetric
+from go_metrics.metrics.series import Series, is_null
+from go_metrics.metrics.tiers import (
+    HistoricalTier, RecentTier, missing_spans)
+
+
+def mk_metric(name='a.sum'):
+    return CompiledMetric(
+        name, SUM, 'go.owner-1.%s' % (name,), 'go.owner-1.a')
+
+
+class TestMissingSpans(TestCase):
+    def test_nothing_found(self):
+        self.assertEqual(
+            missing_spans([60, 120], {}, 30, 200, 60), [(30, 200, None)])
+
+    def test_found(self):
+        self.assertEqual(
+            missing_spans([60, 120], {60: 1.0, 120: 2.0}, 30, 200, 60),
+            [(30, 59, 60), (179, 200, None)])
+
+    def test_found_gap(self):
+        self.assertEqual(
+            missing_spans([60, 120, 180], {60: 1.0, 180: 2.0}, 30, 250, 60),
+            [(30, 59, 60), (119, 179, 180), (239, 250, None)])
+
+    def test_found_aligned(self):
+        # Nothing is left at either end when the time range starts and ends
+        # at bucket boundaries.
+        self.assertEqual(
+            missing_spans([60, 120], {60: 1.0, 120: 2.0}, 59, 179, 60), [])
+
+
+class TestRecentTier(TestCase):
+    def test_fetch(self):
+        tier = RecentTier((60, 60), 10, since=600)
+        tier.store([
+            ('go.owner-1.a', ('sum',), 600, 1.0),
+            ('go.owner-1.a', ('sum',), 660, 2.0),
+            ('go.owner-1.a', ('sum',), 750, 3.0),
+        ])
+        self.assertEqual(
+            tier.fetch(mk_metric(), 120, [480, 600, 720], 900),
+            {600: 3.0, 720: 3.0})
+
+    def test_fetch_retention(self):
+        tier = RecentTier((60, 5), 10, since=0)
+        tier.store([
+            ('go.owner-1.a', ('sum',), 600, 1.0),
+            ('go.owner-1.a', ('sum',), 720, 2.0),
+        ])
+        # Only buckets within the last 5 minutes are answered.
+        found = tier.fetch(mk_metric(), 60, [600, 660, 720], 900)
+        self.assertEqual(sorted(found), [660, 720])
+        self.assertTrue(is_null(found[660]))
+        self.assertEqual(found[720], 2.0)
+        self.assertEqual(tier.fetch(mk_metric(), 60, [600], 900), {})
+
+    def test_fetch_unknown(self):
+        tier = RecentTier((60, 60), 10, since=0)
+        self.assertEqual(tier.fetch(mk_metric(), 60, [0, 60], 120), {})
+
+
+class TestHistoricalTier(TestCase):
+    def test_received(self):
+        tier = HistoricalTier(10, 100, settle_time=60)
+        series = Series([0, 60, 120, 180], [1.0, 2.0, 3.0, 4.0])
+        tier.received(mk_metric(), 60, series, 30, 220, 210)
+
+        # The partial bucket at the start and the buckets that haven't
+        # settled yet aren't kept.
+        self.assertEqual(
+            tier.fetch(mk_metric(), 60, [0, 60, 120, 180], 210), {60: 2.0})
+        self.assertEqual(tier.stats()['stored'], 1)
+
+    def test_received_path(self):
+        path = self.mktemp()
+        tier = HistoricalTier(10, 100, settle_time=0, path=path)
+        series = Series([0, 60, 120], [1.0, 2.0, 3.0])
+        tier.received(mk_metric(), 60, series, -1, 179, 600)
+
+        tier = HistoricalTier(10, 100, settle_time=0, path=path)
+        self.assertEqual(
+            tier.fetch(mk_metric(), 60, [0, 60, 120], 600),
+            {0: 1.0, 60: 2.0, 120: 3.0})
+        self.assertEqual(tier.fetch(mk_metric(), 120, [0], 600), {})
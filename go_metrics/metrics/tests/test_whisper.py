@@ -0,0 +1,191 @@
+import os
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.tests.helpers import VumiTestCase, WorkerHelper
+
+import go_metrics.metrics.graphite
+from go_metrics.metrics.base import MetricsBackendError
+from go_metrics.metrics.graphite import MetricWorker
+from go_metrics.metrics.tests.helpers import points, write_whisper
+from go_metrics.metrics.tests.test_graphite import DummyWorkerCreatorClass
+from go_metrics.metrics.whisper import (
+    WhisperBackend, WhisperFile, WhisperMetrics)
+
+
+# 2015-02-01 00:00:00
+NOW = 1422748800
+
+
+class TestWhisperFile(TestCase):
+    def mk_whisper(self, archives, datapoints, aggregator='avg'):
+        path = os.path.join(self.mktemp(), 'metric.wsp')
+        write_whisper(path, archives, datapoints, aggregator)
+        return WhisperFile.open(path)
+
+    def test_header(self):
+        wsp = self.mk_whisper([(60, 60), (3600, 24)], [])
+        self.assertEqual(wsp.max_retention, 86400)
+        self.assertEqual(wsp.archives, [(40, 60, 60), (760, 3600, 24)])
+
+    def test_fetch(self):
+        wsp = self.mk_whisper([(60, 60)], [
+            (NOW - 180, 1.0),
+            (NOW - 120, 2.0),
+            (NOW - 60, 3.0),
+            (NOW, 4.0),
+        ])
+        self.assertEqual(
+            wsp.fetch(NOW - 300, NOW, NOW),
+            (NOW - 240, 60, [None, 1.0, 2.0, 3.0, 4.0]))
+        self.assertEqual(
+            wsp.fetch(NOW - 150, NOW - 90, NOW),
+            (NOW - 120, 60, [2.0]))
+
+    def test_fetch_wrapped(self):
+        wsp = self.mk_whisper([(60, 5)], [
+            (NOW - i * 60, float(i)) for i in range(8)])
+        # Only the most recent 5 datapoints are kept.
+        self.assertEqual(
+            wsp.fetch(NOW - 600, NOW, NOW),
+            (NOW - 240, 60, [4.0, 3.0, 2.0, 1.0, 0.0]))
+
+    def test_fetch_stale_points(self):
+        wsp = self.mk_whisper([(60, 5)], [(NOW - 600, 1.0), (NOW - 60, 2.0)])
+        # The datapoint from 10 minutes ago is still in the file, but it is
+        # outside the archive's window.
+        self.assertEqual(
+            wsp.fetch(NOW - 300, NOW, NOW),
+            (NOW - 240, 60, [None, None, None, 2.0, None]))
+
+    def test_fetch_lower_resolution(self):
+        wsp = self.mk_whisper([(60, 60), (3600, 24)], [
+            (NOW - 7200, 1.0),
+            (NOW - 7140, 3.0),
+            (NOW - 60, 5.0),
+        ])
+        self.assertEqual(
+            wsp.fetch(NOW - 3 * 3600, NOW, NOW),
+            (NOW - 7200, 3600, [2.0, 5.0, None]))
+
+    def test_fetch_empty(self):
+        wsp = self.mk_whisper([(60, 60)], [])
+        self.assertEqual(
+            wsp.fetch(NOW - 180, NOW, NOW),
+            (NOW - 120, 60, [None, None, None]))
+
+
+class TestWhisperMetrics(VumiTestCase):
+
+    def setUp(self):
+        self.worker_helper = self.add_helper(WorkerHelper())
+        self.whisper_dir = self.mktemp()
+
+    @inlineCallbacks
+    def mk_backend(self, **kw):
+        kw.setdefault('persistent', False)
+        kw.setdefault('whisper_dir', self.whisper_dir)
+        prefix = kw.setdefault('prefix', 'go.campaigns')
+        worker = yield self.worker_helper.get_worker(
+            MetricWorker, {'prefix': prefix})
+        self.patch(
+            go_metrics.metrics.graphite, 'WorkerCreator',
+            DummyWorkerCreatorClass(self, {'prefix': prefix}, worker))
+
+        clock = Clock()
+        clock.advance(NOW)
+        self.patch(WhisperBackend, 'get_clock', lambda self: clock)
+
+        backend = WhisperBackend(kw)
+        self.addCleanup(backend.teardown)
+        returnValue(backend)
+
+    def write_metric(self, name, datapoints, archives=((60, 1440),)):
+        path = os.path.join(self.whisper_dir, *name.split('.')) + '.wsp'
+        write_whisper(path, archives, datapoints)
+
+    @inlineCallbacks
+    def test_get(self):
+        self.write_metric('go.campaigns.owner-1.stores.a.b.last', [
+            (NOW - 240, 1.0),
+            (NOW - 180, 2.0),
+            (NOW - 60, 3.0),
+        ])
+        backend = yield self.mk_backend()
+        metrics = WhisperMetrics(backend, 'owner-1')
+
+        data = yield metrics.get(**{
+            'm': ['stores.a.b.last', 'stores.a.c.last'],
+            'from': '-5min',
+            'until': '-0s',
+            'interval': '2min',
+            'nulls': 'keep',
+        })
+
+        self.assertEqual(points(data), {
+            'stores.a.b.last': [
+                {'x': 1422748560000, 'y': 2.0},
+                {'x': 1422748680000, 'y': 3.0},
+                {'x': 1422748800000, 'y': None},
+            ],
+        })
+
+    @inlineCallbacks
+    def test_get_align_to_from(self):
+        self.write_metric('go.campaigns.owner-1.stores.a.b.sum', [
+            (NOW - 240, 1.0),
+            (NOW - 180, 2.0),
+            (NOW - 60, 3.0),
+        ])
+        backend = yield self.mk_backend()
+        metrics = WhisperMetrics(backend, 'owner-1')
+
+        data = yield metrics.get(**{
+            'm': 'stores.a.b.sum',
+            'from': '-5min',
+            'until': '-0s',
+            'interval': '2min',
+            'align_to_from': 'true',
+        })
+
+        self.assertEqual(data['stores.a.b.sum'].values(), [3.0, 3.0, 0.0])
+
+    @inlineCallbacks
+    def test_get_cached(self):
+        self.write_metric('go.campaigns.owner-1.stores.a.b.last', [
+            (NOW - 60, 3.0),
+        ])
+        backend = yield self.mk_backend()
+        metrics = WhisperMetrics(backend, 'owner-1')
+
+        yield metrics.get(m='stores.a.b.last', interval='1min')
+        yield metrics.get(m='stores.a.b.last', interval='2min')
+
+        self.assertEqual(backend.stats()['files']['size'], 1)
+        self.assertEqual(backend.stats()['files']['hits'], 1)
+
+    @inlineCallbacks
+    def test_get_invalid_name(self):
+        backend = yield self.mk_backend()
+        metrics = WhisperMetrics(backend, 'owner-1')
+        self.assertEqual(
+            backend.whisper_path('go.campaigns.owner-1.a/../b.last'), None)
+        self.assertEqual(
+            backend.whisper_path('go.campaigns.owner-1.a..b.last'), None)
+        data = yield metrics.get(m='stores.a/../../b.last')
+        self.assertEqual(data, {})
+
+    @inlineCallbacks
+    def test_get_corrupt_file(self):
+        path = os.path.join(
+            self.whisper_dir, 'go', 'campaigns', 'owner-1', 'a', 'last.wsp')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write('foo')
+
+        backend = yield self.mk_backend()
+        metrics = WhisperMetrics(backend, 'owner-1')
+        yield self.assertFailure(
+            metrics.get(m='a.last'), MetricsBackendError)
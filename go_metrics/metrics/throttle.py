@@ -0,0 +1,85 @@
+"""
+Rate limiting of the queries made by the metrics backends.
+"""
+
+
+class TokenBuckets(object):
+    """
+    A token bucket for each of a number of keys, each holding up to
+    ``capacity`` tokens and refilled at ``rate`` tokens per second.
+
+    Buckets start full, and a bucket that has refilled completely is the
+    same as one that was never used, so full buckets are discarded once
+    ``max_buckets`` buckets are being tracked.
+
+    :param float rate:
+        The number of tokens added to each bucket every second.
+    :param int capacity:
+        The maximum number of tokens a bucket can hold.
+    :param clock:
+        An object providing ``seconds()``.
+    :param int max_buckets:
+        The number of buckets to track before discarding full buckets.
+    """
+
+    def __init__(self, rate, capacity, clock, max_buckets=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.max_buckets = max_buckets
+        self.spent = 0
+        self.rejected = 0
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _tokens(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        tokens, updated = bucket
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def tokens(self, key):
+        """
+        Return the number of tokens currently in the bucket for ``key``.
+        """
+        return self._tokens(key, self.clock.seconds())
+
+    def spend(self, key, cost):
+        """
+        Take ``cost`` tokens from the bucket for ``key`` if it holds enough,
+        returning 0. Otherwise, leave the bucket untouched and return the
+        number of seconds until it will hold enough. Costs larger than the
+        capacity need a full bucket.
+        """
+        now = self.clock.seconds()
+        cost = min(cost, self.capacity)
+        tokens = self._tokens(key, now)
+
+        if tokens < cost:
+            self.rejected += 1
+            return float(cost - tokens) / self.rate
+
+        if key not in self._buckets and len(self._buckets) >= self.max_buckets:
+            self._discard_full(now)
+
+        self.spent += cost
+        self._buckets[key] = (tokens - cost, now)
+        return 0
+
+    def _discard_full(self, now):
+        for key in self._buckets.keys():
+            if self._tokens(key, now) >= self.capacity:
+                del self._buckets[key]
+
+    def stats(self):
+        """
+        Return a dict of counters describing the buckets' usage.
+        """
+        return {
+            'buckets': len(self._buckets),
+            'spent': self.spent,
+            'rejected': self.rejected,
+        }
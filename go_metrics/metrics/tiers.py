@@ -0,0 +1,203 @@
+"""
+Tiers the graphite backend answers parts of queries from before going to
+graphite, so that graphite is only asked for the parts of a query's time
+range the tiers can't answer.
+"""
+
+import errno
+import hashlib
+import os
+import struct
+from itertools import izip
+
+from go_metrics.metrics.base import MetricsBackendError
+from go_metrics.metrics.cache import LRUCache
+from go_metrics.metrics.store import StoredMetric
+from go_metrics.metrics.summarize import summarize
+
+
+BUCKET = struct.Struct('!ld')
+
+
+def missing_spans(buckets, found, from_time, until_time, interval):
+    """
+    Split the time range after ``from_time`` up to and including
+    ``until_time`` into the spans not covered by the buckets in ``found``,
+    where ``buckets`` are the start times of the ``interval`` second buckets
+    lying entirely within the time range.
+
+    Returns a list of ``(from, until, cut)`` tuples, where ``cut`` is the
+    start of the found bucket following the span, or ``None`` for a span
+    reaching the end of the time range.
+    """
+    spans = []
+    start = from_time
+    for timestamp in buckets:
+        if timestamp in found:
+            if start < timestamp - 1:
+                spans.append((start, timestamp - 1, timestamp))
+            start = timestamp + interval - 1
+
+    if start < until_time:
+        spans.append((start, until_time, None))
+    return spans
+
+
+class Tier(object):
+    """
+    A source of summarized datapoints for metrics, checked before graphite.
+    """
+
+    def fetch(self, metric, interval, buckets, now):
+        """
+        Return a dict mapping those of the start times in ``buckets`` that
+        this tier can answer for ``metric`` to the value of the ``interval``
+        second bucket starting then (``NULL`` for a null value).
+        """
+        raise NotImplementedError()
+
+    def received(self, metric, interval, series, from_time, until_time, now):
+        """
+        Called with the :class:`Series` of ``interval`` second buckets
+        graphite returned for ``metric`` for the time range after
+        ``from_time`` up to and including ``until_time``.
+        """
+
+    def stats(self):
+        return {}
+
+
+class RecentTier(Tier):
+    """
+    The values fired through the api since it started, kept in memory at a
+    single resolution for a limited time.
+
+    Buckets are only answered if values could have been fired for all of
+    their datapoints since the tier was created, so this is only correct if
+    the metrics are fired through this api alone, and if the resolution
+    matches the resolution carbon stores the metrics at.
+    """
+
+    def __init__(self, retention, max_metrics, since):
+        self.step, self.size = retention
+        self.since = since
+        self.metrics = LRUCache(max_metrics)
+
+    def store(self, values):
+        """
+        Store fired values, a list of ``(name, aggregators, timestamp,
+        value)`` tuples.
+        """
+        metrics = self.metrics
+        for name, aggs, timestamp, value in values:
+            key = (name, aggs[0])
+            stored = metrics.get(key)
+            if stored is None:
+                stored = StoredMetric(aggs[0], [(self.step, self.size)])
+                metrics.set(key, stored)
+            stored.add(timestamp, value)
+
+    def fetch(self, metric, interval, buckets, now):
+        aggregator = metric.aggregator.name
+        stored = self.metrics.get((metric.fire_name, aggregator))
+        if stored is None:
+            return {}
+
+        earliest = max(self.since, now - self.step * self.size + 1)
+        buckets = [t for t in buckets if t >= earliest]
+        if not buckets:
+            return {}
+
+        start, step, values = stored.fetch(
+            buckets[0] - 1, buckets[-1] + interval - 1, now)
+        series = summarize(start, step, values, interval, aggregator, False)
+        wanted = set(buckets)
+        return dict(
+            (x, y) for x, y in izip(series.x, series.y) if x in wanted)
+
+    def stats(self):
+        return self.metrics.stats()
+
+
+class HistoricalTier(Tier):
+    """
+    The buckets graphite has returned that have been complete for at least
+    ``settle_time`` seconds, and so shouldn't change anymore.
+
+    The buckets for each metric and interval are kept in memory, and, if
+    ``path`` is given, appended to a file in that directory so that they
+    survive restarts.
+    """
+
+    def __init__(self, max_entries, max_buckets, settle_time, path=None):
+        self.settle_time = settle_time
+        self.path = path
+        self.buckets = LRUCache(max_entries, max_buckets)
+        self.stored = 0
+
+    def _file_path(self, key):
+        return os.path.join(
+            self.path, hashlib.sha1(repr(key)).hexdigest() + '.buckets')
+
+    def _load(self, key):
+        buckets = self.buckets.get(key)
+        if buckets is not None or self.path is None:
+            return buckets
+
+        try:
+            with open(self._file_path(key), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise MetricsBackendError("Failed to read cached buckets")
+
+        data = data[:len(data) - len(data) % BUCKET.size]
+        values = struct.unpack('!' + 'ld' * (len(data) // BUCKET.size), data)
+        buckets = dict(izip(values[0::2], values[1::2]))
+        self.buckets.set(key, buckets, cost=max(1, len(buckets)))
+        return buckets
+
+    def _save(self, key, new):
+        if self.path is None:
+            return
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(self._file_path(key), 'ab') as f:
+                f.write(''.join(BUCKET.pack(x, y) for x, y in new))
+        except (IOError, OSError):
+            raise MetricsBackendError("Failed to write cached buckets")
+
+    def fetch(self, metric, interval, buckets, now):
+        stored = self._load((metric.full_name, interval))
+        if stored is None:
+            return {}
+        return dict((t, stored[t]) for t in buckets if t in stored)
+
+    def received(self, metric, interval, series, from_time, until_time, now):
+        end = min(until_time + 1, now - self.settle_time)
+        new = [
+            (x, y) for x, y in izip(series.x, series.y)
+            if x > from_time and x + interval <= end]
+        if not new:
+            return
+
+        key = (metric.full_name, interval)
+        buckets = self._load(key)
+        if buckets is None:
+            buckets = {}
+        new = [(x, y) for x, y in new if x not in buckets]
+        if not new:
+            return
+
+        buckets.update(new)
+        self.buckets.set(key, buckets, cost=len(buckets))
+        self.stored += len(new)
+        self._save(key, new)
+
+    def stats(self):
+        stats = self.buckets.stats()
+        stats['stored'] = self.stored
+        return stats
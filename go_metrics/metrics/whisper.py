@@ -0,0 +1,213 @@
+"""
+Whisper backend for the metrics api, reading the whisper files written by
+carbon directly instead of querying them through graphite's web app.
+"""
+
+import errno
+import mmap
+import os
+import struct
+from itertools import izip
+
+from confmodel.fields import ConfigText, ConfigInt
+
+from go_metrics.metrics.base import MetricsBackendError
+from go_metrics.metrics.cache import LRUCache
+from go_metrics.metrics.graphite import (
+    GraphiteBackend, GraphiteBackendConfig, GraphiteMetrics)
+from go_metrics.metrics.summarize import summarize
+
+
+METADATA = struct.Struct('!2LfL')
+
+ARCHIVE_INFO = struct.Struct('!3L')
+
+POINT = struct.Struct('!Ld')
+
+
+class WhisperFile(object):
+    """
+    A memory-mapped whisper file.
+
+    Only the header is read up front. Datapoints are read from the mapped
+    file as they are fetched, so updates made to the file by carbon are
+    seen without reopening it.
+    """
+
+    __slots__ = ('data', 'max_retention', 'archives')
+
+    def __init__(self, data):
+        self.data = data
+        _aggregation, self.max_retention, _xff, count = (
+            METADATA.unpack_from(data, 0))
+        self.archives = [
+            ARCHIVE_INFO.unpack_from(
+                data, METADATA.size + i * ARCHIVE_INFO.size)
+            for i in xrange(count)]
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(data)
+
+    def fetch(self, from_time, until_time, now):
+        """
+        Fetch the datapoints after ``from_time`` up to and including
+        ``until_time`` from the highest resolution archive covering the
+        window (or the longest archive, if none do), returning a ``(start,
+        step, values)`` tuple, where ``values`` holds the values for each
+        step from ``start`` onwards, or ``None`` for steps without a value.
+
+        This follows whisper's own ``fetch()``.
+        """
+        from_time = max(from_time, now - self.max_retention)
+        until_time = min(until_time, now)
+
+        for offset, step, points in self.archives:
+            if step * points >= now - from_time:
+                break
+
+        if until_time < from_time:
+            return from_time, step, []
+        return self._fetch_archive(
+            offset, step, points, from_time, until_time)
+
+    def _fetch_archive(self, offset, step, points, from_time, until_time):
+        data = self.data
+        start = from_time - from_time % step + step
+        end = until_time - until_time % step + step
+        if start == end:
+            end += step
+        count = (end - start) // step
+
+        base, _ = POINT.unpack_from(data, offset)
+        if base == 0:
+            # Nothing has been written to this archive yet.
+            return start, step, [None] * count
+
+        size = points * POINT.size
+        from_offset = offset + (
+            (start - base) // step * POINT.size) % size
+        until_offset = offset + (
+            (end - base) // step * POINT.size) % size
+
+        if from_offset < until_offset:
+            raw = data[from_offset:until_offset]
+        else:
+            raw = data[from_offset:offset + size] + data[offset:until_offset]
+
+        n = len(raw) // POINT.size
+        unpacked = struct.unpack('!' + 'Ld' * n, raw)
+        values = [
+            value if timestamp == expected else None
+            for timestamp, value, expected in izip(
+                unpacked[0::2], unpacked[1::2],
+                xrange(start, end, step))]
+        values.extend([None] * (count - len(values)))
+        return start, step, values
+
+
+class WhisperMetrics(GraphiteMetrics):
+    """
+    Metrics model for :class:`WhisperBackend`. Queries are answered by
+    reading and summarizing the metrics' whisper files locally. Everything
+    else, including caching and firing metrics, works as it does for
+    :class:`GraphiteMetrics`.
+
+    Metric names are read as exact paths, graphite's wildcards aren't
+    expanded.
+    """
+
+    def _fetch(self, url, params):
+        now, from_time, until_time = self._query_window(params)
+        interval, align_to_from = self._query_buckets(params)
+
+        data = {}
+        for name in params['m']:
+            metric = self._compile_metric(name)
+            wsp = self.backend.open_whisper(metric.full_name)
+            if wsp is None:
+                # Graphite leaves out metrics it has no values for.
+                continue
+
+            start, step, values = wsp.fetch(from_time, until_time, now)
+            data[name] = summarize(
+                start, step, values, interval, metric.aggregator.name,
+                align_to_from)
+
+        return data
+
+
+class WhisperBackendConfig(GraphiteBackendConfig):
+    whisper_dir = ConfigText(
+        ("Directory carbon stores whisper files in. Metric names are mapped "
+         "to files below it as carbon does, with each dot in the name "
+         "starting a new subdirectory."),
+        required=True)
+
+    whisper_max_open_files = ConfigInt(
+        "Maximum number of whisper files to keep memory-mapped.",
+        default=1000)
+
+    whisper_file_ttl = ConfigInt(
+        ("Number of seconds to keep a whisper file mapped for before "
+         "reopening it, so that files that have been recreated are picked "
+         "up."),
+        default=300)
+
+
+class WhisperBackend(GraphiteBackend):
+    """
+    A :class:`GraphiteBackend` that reads metrics from the whisper files
+    under ``whisper_dir`` rather than through graphite's web app, for when
+    the api runs alongside carbon.
+    """
+
+    model_class = WhisperMetrics
+    config_class = WhisperBackendConfig
+
+    def initialize(self):
+        super(WhisperBackend, self).initialize()
+        self.files = LRUCache(
+            self.config.whisper_max_open_files, clock=self.clock)
+
+    def whisper_path(self, name):
+        """
+        Return the path of the whisper file for the metric ``name``, or
+        ``None`` if the name can't refer to a whisper file.
+        """
+        parts = name.split('.')
+        if not all(parts) or any(os.sep in part for part in parts):
+            return None
+        return os.path.join(self.config.whisper_dir, *parts) + '.wsp'
+
+    def open_whisper(self, name):
+        """
+        Return the :class:`WhisperFile` for the metric ``name``, or ``None``
+        if there is no whisper file for it.
+        """
+        path = self.whisper_path(name)
+        if path is None:
+            return None
+
+        wsp = self.files.get(path)
+        if wsp is None:
+            try:
+                wsp = WhisperFile.open(path)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    return None
+                raise MetricsBackendError(
+                    "Failed to read metric %r" % (name,))
+            except (ValueError, struct.error):
+                raise MetricsBackendError(
+                    "Failed to read metric %r" % (name,))
+            self.files.set(path, wsp, ttl=self.config.whisper_file_ttl)
+
+        return wsp
+
+    def stats(self):
+        stats = super(WhisperBackend, self).stats()
+        stats['files'] = self.files.stats()
+        return stats
@@ -0,0 +1,107 @@
+"""
+Serializers for the JSON the api responds with, selected by name in the
+api's config.
+"""
+
+import json
+from itertools import izip
+
+from go_metrics.metrics.series import Series, json_default
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+MILLISECONDS = 1000
+
+
+def json_dumps(obj):
+    return json.dumps(obj, default=json_default)
+
+
+def simplejson_dumps(obj):
+    return simplejson.dumps(obj, default=json_default)
+
+
+def to_builtins(obj):
+    """
+    Return ``obj`` with the :class:`Series` in it converted to lists of
+    points, for serializers that don't support a ``default`` hook.
+    """
+    if isinstance(obj, Series):
+        return obj.to_points()
+    if isinstance(obj, dict):
+        return dict((k, to_builtins(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [to_builtins(v) for v in obj]
+    return obj
+
+
+def ujson_dumps(obj):
+    return ujson.dumps(to_builtins(obj))
+
+
+def series_to_json(series):
+    """
+    Serialize a :class:`Series` as a list of ``{"x": ..., "y": ...}`` points
+    straight from its timestamp and value arrays.
+    """
+    if not len(series):
+        return '[]'
+
+    # Each step is done for all of the points at once, to keep the work in
+    # C rather than in a python loop over the points.
+    xs = map(str, map(MILLISECONDS.__mul__, series.x))
+    ys = map(float.__repr__, series.y)
+    body = '[{"x":%s}]' % ('},{"x":'.join(
+        map('"y":'.join, izip([x + ',' for x in xs], ys))),)
+
+    # repr() doesn't give the representation json uses for nulls (stored
+    # as NaN) and infinities.
+    body = body.replace(':nan}', ':null}')
+    if 'inf}' in body:
+        body = body.replace(':inf}', ':Infinity}')
+        body = body.replace(':-inf}', ':-Infinity}')
+    return body
+
+
+def compact_dumps(obj):
+    return json.dumps(obj, default=json_default, separators=(',', ':'))
+
+
+def series_dumps(obj):
+    """
+    Serialize ``obj``, writing the :class:`Series` in it (including those in
+    dicts and lists of results) without building their points first.
+    """
+    if isinstance(obj, Series):
+        return series_to_json(obj)
+
+    if isinstance(obj, dict):
+        if not all(isinstance(k, basestring) for k in obj):
+            return compact_dumps(obj)
+        return '{%s}' % (','.join([
+            '%s:%s' % (json.dumps(k), series_dumps(v))
+            for k, v in obj.iteritems()]),)
+
+    if isinstance(obj, list):
+        return '[%s]' % (','.join([series_dumps(v) for v in obj]),)
+
+    return compact_dumps(obj)
+
+
+# Serializers that depend on packages that aren't installed fall back to the
+# standard library's json module.
+serializers = {
+    'json': json_dumps,
+    'series': series_dumps,
+    'simplejson': json_dumps if simplejson is None else simplejson_dumps,
+    'ujson': json_dumps if ujson is None else ujson_dumps,
+}
@@ -1,18 +1,32 @@
 import functools
 import base64
+import hashlib
+import json
+import math
 
 from urlparse import parse_qs as _parse_qs
 
+from twisted.internet import reactor
 from twisted.internet.defer import maybeDeferred, inlineCallbacks
 
 from confmodel import Config
-from confmodel.fields import ConfigDict
+from confmodel.errors import ConfigError
+from confmodel.fields import (
+    ConfigBool, ConfigDict, ConfigFloat, ConfigInt, ConfigText)
 
 from go_api.cyclone.handlers import ApiApplication, BaseHandler
-from cyclone.web import HTTPAuthenticationRequired
+from cyclone.web import HTTPAuthenticationRequired, RequestHandler, URLSpec
 
-from go_metrics.metrics.base import MetricsBackendError, BadMetricsQueryError
+from go_metrics.compression import compress, negotiate_encoding
+from go_metrics.metrics.base import (
+    MetricsBackendError, MetricsBackendBusyError, BadMetricsQueryError,
+    MetricsThrottledError)
+from go_metrics.metrics.bulk import iter_records
 from go_metrics.metrics.graphite import GraphiteBackend
+from go_metrics.metrics.memory import MemoryBackend
+from go_metrics.metrics.stream import StreamHub
+from go_metrics.metrics.whisper import WhisperBackend
+from go_metrics.serializers import serializers
 
 
 def parse_qs(qs):
@@ -52,14 +66,80 @@ def HTTPBasic(method):
     return wrapper
 
 
-class MetricsHandler(BaseHandler):
+class BaseMetricsHandler(BaseHandler):
+
+    def write_object(self, obj):
+        self.write(self.application.serialize(obj))
+
+    def write_response(self, obj):
+        """
+        Write ``obj`` out as JSON, compressed with the encoding the client
+        prefers if it is large enough to be worth compressing.
+
+        Responses to ``GET`` requests are given a strong ETag computed from
+        the JSON (and the encoding used), and are sent without a body as a
+        304 if the client already has them.
+        """
+        config = self.application.config
+        body = self.application.serialize(obj)
+
+        encoding = None
+        if config.compress_responses:
+            self.set_header('Vary', 'Accept-Encoding')
+            if len(body) >= config.compress_min_size:
+                encoding = negotiate_encoding(
+                    self.request.headers.get('Accept-Encoding'))
+
+        if self.request.method in ('GET', 'HEAD'):
+            etag = hashlib.sha1(body).hexdigest()
+            if encoding is not None:
+                etag = '%s-%s' % (etag, encoding)
+            etag = '"%s"' % (etag,)
+            self.set_header('Etag', etag)
+            if self.etag_matches(etag):
+                self.set_status(304)
+                return
+
+        if encoding is not None:
+            body = compress(body, encoding, config.compress_level)
+            self.set_header('Content-Encoding', encoding)
+        self.write(body)
+
+    def etag_matches(self, etag):
+        inm = self.request.headers.get('If-None-Match')
+        if not inm:
+            return False
+        tags = [tag.strip() for tag in inm.split(',')]
+        return '*' in tags or etag in tags
+
+    def catch_throttled(self, failure):
+        """
+        Respond with a 429 if the query was rejected because its owner has
+        too many queries outstanding or has used up its allowance of data
+        points, along with a ``Retry-After`` header if it is known when the
+        query may be retried.
+        """
+        # This isn't raised as an HTTPError, since cyclone only accepts the
+        # status codes known to httplib, which doesn't know about 429.
+        failure.trap(MetricsThrottledError)
+        retry_after = failure.value.retry_after
+        self.set_status(429, reason="Too Many Requests")
+        if retry_after is not None:
+            self.set_header(
+                "Retry-After", str(int(math.ceil(retry_after))))
+        self.write_error(429, exception=failure.value)
+
+
+class MetricsHandler(BaseMetricsHandler):
 
     @HTTPBasic
     def get(self):
         query = parse_qs(self.request.query)
         d = maybeDeferred(self.model.get, **query)
-        d.addCallback(self.write_object)
+        d.addCallback(self.write_response)
+        d.addErrback(self.catch_throttled)
         d.addErrback(self.catch_err, 400, BadMetricsQueryError)
+        d.addErrback(self.catch_err, 503, MetricsBackendBusyError)
         d.addErrback(self.catch_err, 500, MetricsBackendError)
         d.addErrback(self.raise_err, 500, "Failed to retrieve metrics.")
         return d
@@ -80,9 +160,141 @@ class MetricsHandler(BaseHandler):
         return d
 
 
+class MetricsBatchHandler(BaseMetricsHandler):
+
+    @HTTPBasic
+    def post(self):
+        data = self.parse_json(self.request.body)
+        d = maybeDeferred(self.model.get_batch, data)
+        d.addCallback(self.write_response)
+        d.addErrback(self.catch_throttled)
+        d.addErrback(self.catch_err, 400, BadMetricsQueryError)
+        d.addErrback(self.catch_err, 503, MetricsBackendBusyError)
+        d.addErrback(self.catch_err, 500, MetricsBackendError)
+        d.addErrback(self.raise_err, 500, "Failed to retrieve metrics.")
+        return d
+
+
+class MetricsBulkHandler(BaseMetricsHandler):
+
+    @HTTPBasic
+    def post(self):
+        d = maybeDeferred(
+            self.model.fire_bulk, iter_records(self.request.body))
+        d.addCallback(self.write_object)
+        d.addErrback(self.catch_err, 400, BadMetricsQueryError)
+        d.addErrback(self.raise_err, 500, "Failed to fire metrics.")
+        return d
+
+
+class MetricsStreamHandler(BaseMetricsHandler):
+    """
+    Streams the buckets of the requested metrics to the client as server-sent
+    events, as each bucket closes.
+    """
+
+    @HTTPBasic
+    def get(self):
+        query = parse_qs(self.request.query)
+        d = maybeDeferred(
+            self.application.streams.subscribe, self.model, query,
+            self.send_event)
+        d.addCallback(self.start_stream)
+        d.addErrback(self.catch_err, 400, BadMetricsQueryError)
+        d.addErrback(self.catch_err, 503, MetricsBackendBusyError)
+        d.addErrback(self.raise_err, 500, "Failed to stream metrics.")
+        return d
+
+    def start_stream(self, sub):
+        self.subscription = sub
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.flush()
+        # The response is finished once the subscription ends.
+        return sub.done
+
+    def send_event(self, event_id, data):
+        self.write('id: %s\ndata: ' % (event_id,))
+        self.write_object(data)
+        self.write('\n\n')
+        self.flush()
+
+    def on_connection_close(self, *args, **kw):
+        sub = getattr(self, 'subscription', None)
+        if sub is not None:
+            self.application.streams.unsubscribe(sub)
+
+
+class StatsHandler(RequestHandler):
+    """
+    Reports the counters describing the backend's and the streams' internal
+    state, for monitoring the api alongside its health check. Like the health
+    check, this isn't authenticated, so the counters are aggregates that
+    don't give away the owners or the metrics being queried.
+    """
+    suppress_request_log = True
+
+    def get(self, *args, **kw):
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.write(json.dumps({
+            'backend': self.application.backend.stats(),
+            'streams': self.application.streams.stats(),
+        }))
+
+
 class MetricsApiConfig(Config):
     backend = ConfigDict("Config for metrics backend", default={})
 
+    stream_settle_time = ConfigInt(
+        ("Number of seconds to wait after a bucket closes before sending it "
+         "to the clients streaming its metrics, allowing for values that "
+         "reach the backend late."),
+        default=10)
+
+    stream_retry_interval = ConfigFloat(
+        ("Number of seconds to wait before trying again when the backend "
+         "fails to return the buckets for a stream."),
+        default=10)
+
+    stream_max_age = ConfigInt(
+        ("Number of seconds to keep a stream open for before closing it. "
+         "Clients are expected to reconnect, so this only cleans up streams "
+         "left open by clients that have gone away."),
+        default=3600)
+
+    stream_max_subscriptions = ConfigInt(
+        ("Maximum number of streams to have open at once. Further streams are "
+         "rejected with a 503 response."),
+        default=1000)
+
+    serializer = ConfigText(
+        ("Serializer to write responses with: 'series' (the default), which "
+         "writes metric series without building their points first, 'json' "
+         "(the standard library's json module), 'simplejson' or 'ujson'. "
+         "The last two fall back to 'json' if they aren't installed."),
+        default='series')
+
+    compress_responses = ConfigBool(
+        ("Flag telling the api whether to compress the metrics it responds "
+         "with, using gzip (or brotli, if installed) as negotiated with the "
+         "client's Accept-Encoding header."),
+        default=True)
+
+    compress_min_size = ConfigInt(
+        "Minimum size in bytes of the responses to compress.",
+        default=1024)
+
+    compress_level = ConfigInt(
+        ("Level to compress responses at, from 1 (fastest) to 9 (smallest). "
+         "This is used as brotli's quality, which goes up to 11."),
+        default=6)
+
+    def post_validate(self):
+        if self.serializer not in serializers:
+            raise ConfigError(
+                "Unknown serializer %r, should be one of %s" % (
+                    self.serializer, ', '.join(sorted(serializers))))
+
 
 class MetricsApi(ApiApplication):
     config_required = True
@@ -90,15 +302,53 @@ class MetricsApi(ApiApplication):
 
     @property
     def models(self):
-        return (('/metrics/', MetricsHandler, self.get_metrics_model),)
+        return (
+            ('/metrics/', MetricsHandler, self.get_metrics_model),
+            ('/metrics/batch/', MetricsBatchHandler, self.get_metrics_model),
+            ('/metrics/bulk/', MetricsBulkHandler, self.get_metrics_model),
+            ('/metrics/stream/', MetricsStreamHandler,
+             self.get_metrics_model),
+        )
 
     def initialize(self, settings, config):
-        config = MetricsApiConfig(config)
+        self.config = config = MetricsApiConfig(config)
+        self.serialize = serializers[config.serializer]
         self.backend = self.backend_class(config.backend)
+        self.streams = StreamHub(
+            self.get_clock(),
+            config.stream_settle_time,
+            config.stream_retry_interval,
+            config.stream_max_age,
+            config.stream_max_subscriptions)
+
+    def get_clock(self):
+        return reactor
+
+    def _build_routes(self, path_prefix=""):
+        routes = ApiApplication._build_routes(self, path_prefix)
+        routes.append(URLSpec('/stats/', StatsHandler))
+        return routes
 
     @inlineCallbacks
     def teardown(self):
+        self.streams.close()
         yield self.backend.teardown()
 
     def get_metrics_model(self, owner_id):
         return self.backend.get_model(owner_id)
+
+
+class MemoryMetricsApi(MetricsApi):
+    """
+    Metrics api storing and querying fired metric values in-process rather
+    than through graphite.
+    """
+    backend_class = MemoryBackend
+
+
+class WhisperMetricsApi(MetricsApi):
+    """
+    Metrics api querying the whisper files written by carbon directly rather
+    than through graphite's web app.
+    """
+    backend_class = WhisperBackend
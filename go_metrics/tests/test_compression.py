@@ -0,0 +1,41 @@
+"""
+Tests for the compression of the metrics API's responses.
+"""
+import zlib
+
+from twisted.trial.unittest import TestCase
+
+from go_metrics import compression
+from go_metrics.compression import (
+    compress, negotiate_encoding, parse_accept_encoding)
+
+
+class TestCompression(TestCase):
+    def test_parse_accept_encoding(self):
+        self.assertEqual(
+            parse_accept_encoding('gzip, deflate;q=0.5, br;q=foo, , *;q=0'), {
+                'gzip': 1.0,
+                'deflate': 0.5,
+                'br': 0.0,
+                '*': 0.0,
+            })
+
+    def test_negotiate_encoding(self):
+        self.patch(compression, 'compressors', compression.OrderedDict([
+            ('br', None),
+            ('gzip', None),
+        ]))
+        self.assertEqual(negotiate_encoding(None), None)
+        self.assertEqual(negotiate_encoding('identity'), None)
+        self.assertEqual(negotiate_encoding('gzip'), 'gzip')
+        self.assertEqual(negotiate_encoding('gzip, br'), 'br')
+        self.assertEqual(negotiate_encoding('gzip, br;q=0.5'), 'gzip')
+        self.assertEqual(negotiate_encoding('*'), 'br')
+        self.assertEqual(negotiate_encoding('*, br;q=0'), 'gzip')
+
+    def test_compress_gzip(self):
+        data = '{"x": 1, "y": 2.0}' * 100
+        compressed = compress(data, 'gzip', 6)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(
+            zlib.decompress(compressed, 16 + zlib.MAX_WBITS), data)
@@ -0,0 +1,50 @@
+"""
+Tests for the serializers the metrics API's responses can be written with.
+"""
+import json
+
+from twisted.trial.unittest import TestCase
+
+from go_metrics import serializers
+from go_metrics.metrics.series import Series, NULL
+from go_metrics.serializers import series_dumps, to_builtins
+
+
+class TestSerializers(TestCase):
+    def test_series_dumps(self):
+        series = Series([0, 60, 120], [1.5, NULL, 1e16])
+        self.assertEqual(
+            series_dumps({'a.last': series}),
+            '{"a.last":[{"x":0,"y":1.5},{"x":60000,"y":null},'
+            '{"x":120000,"y":1e+16}]}')
+
+    def test_series_dumps_empty(self):
+        self.assertEqual(series_dumps({'a.last': Series()}), '{"a.last":[]}')
+
+    def test_series_dumps_infinity(self):
+        series = Series([0, 60], [float('inf'), float('-inf')])
+        self.assertEqual(
+            series_dumps(series),
+            '[{"x":0,"y":Infinity},{"x":60000,"y":-Infinity}]')
+
+    def test_series_dumps_matches_json(self):
+        obj = [
+            {'a.last': Series([5695, 5700], [5.0, NULL])},
+            {'b.last': {'x': [5695000], 'y': [None]}},
+            {1: 'foo', u'b\xe9': [True, None, 'bar']},
+        ]
+        self.assertEqual(
+            json.loads(series_dumps(obj)),
+            json.loads(serializers.json_dumps(obj)))
+
+    def test_to_builtins(self):
+        self.assertEqual(
+            to_builtins([{'a.last': Series([5695], [NULL])}, ('foo',)]),
+            [{'a.last': [{'x': 5695000, 'y': None}]}, ['foo']])
+
+    def test_serializers(self):
+        obj = {'a.last': Series([5695], [5.0])}
+        for name, serialize in serializers.serializers.iteritems():
+            self.assertEqual(
+                json.loads(serialize(obj)),
+                {'a.last': [{'x': 5695000, 'y': 5.0}]}, name)
@@ -1,20 +1,27 @@
 """
 Tests for the metrics API's server.
 """
+import hashlib
 import json
 import yaml
 from base64 import b64encode
 
 from twisted.internet.defer import succeed, inlineCallbacks, maybeDeferred
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 
+from confmodel.errors import ConfigError
 from confmodel.fields import ConfigText
 
 from go_api.cyclone.helpers import AppHelper
 
-from go_metrics.server import MetricsApi
-from go_metrics.metrics.base import MetricsBackendError, BadMetricsQueryError
+from go_metrics.server import MetricsApi, MemoryMetricsApi
+from go_metrics.metrics.base import (
+    MetricsBackendError, MetricsBackendBusyError, BadMetricsQueryError,
+    MetricsThrottledError)
 from go_metrics.metrics.dummy import DummyBackend
+from go_metrics.metrics.memory import MemoryBackend
+from go_metrics.metrics.series import Series, NULL
 
 
 class DummyMetricsApi(MetricsApi):
@@ -127,6 +134,85 @@ class TestMetricsApi(TestCase):
         self.assertTrue(isinstance(app.backend.config, ToyBackendConfig))
         self.assertEqual(app.backend.config.foo, 'bar')
 
+    def test_memory_metrics_api(self):
+        app = MemoryMetricsApi(self.mk_config(backend={
+            'retentions': ['1min:1h'],
+        }))
+        self.assertTrue(isinstance(app.backend, MemoryBackend))
+        self.assertEqual(app.backend.retentions, [(60, 60)])
+
+    @inlineCallbacks
+    def test_stats(self):
+        app = MemoryMetricsApi(self.mk_config(backend={
+            'retentions': ['1min:1h'],
+        }))
+        yield app.backend.get_model('owner-1').fire(**{'a.last': 1})
+
+        resp = yield AppHelper(app).get('/stats/')
+        self.assertEqual(resp.code, 200)
+        stats = yield resp.json()
+        self.assertEqual(stats['backend']['metrics']['size'], 1)
+        self.assertEqual(stats['backend']['metric_cache']['size'], 1)
+        self.assertEqual(stats['streams']['live'], 0)
+        self.assertEqual(stats['streams']['subscriptions'], 0)
+        self.assertFalse('owner-1' in json.dumps(stats))
+
+    @inlineCallbacks
+    def test_stats_dummy_backend(self):
+        app = DummyMetricsApi(self.mk_config())
+        resp = yield AppHelper(app).get('/stats/')
+        stats = yield resp.json()
+        self.assertEqual(stats['backend'], {})
+        self.assertEqual(stats['streams']['events'], 0)
+
+    @inlineCallbacks
+    def test_metrics_stream(self):
+        # 2015-02-01 00:00:00
+        now = 1422748800
+        clock = Clock()
+        clock.advance(now + 30)
+        self.patch(DummyMetricsApi, 'get_clock', lambda self: clock)
+
+        app = DummyMetricsApi(self.mk_config(
+            stream_settle_time=0, stream_max_age=60))
+        app.backend.fixtures.add(
+            m=['a.last'],
+            interval='1min',
+            nulls='zeroize',
+            format='points',
+            result={'a.last': Series([now, now + 60], [1.0, 0.0])},
+            **{'from': str(now - 1), 'until': str(now + 59)})
+
+        get = AppHelper(app).get
+        resp = yield get('/metrics/stream/', params={
+            'm': 'a.last',
+            'interval': '1min',
+        })
+        self.assertEqual(
+            resp.headers.getRawHeaders('content-type'), ['text/event-stream'])
+        self.assertEqual(app.streams.stats()['subscriptions'], 1)
+
+        # The response ends once the stream is closed.
+        clock.advance(60)
+        body = yield resp.content()
+        [event] = body.split('\n\n')[:-1]
+        event_id, data = event.split('\n')
+        self.assertEqual(event_id, 'id: %d' % ((now + 60) * 1000,))
+        self.assertEqual(json.loads(data[len('data: '):]), {
+            'a.last': [{'x': now * 1000, 'y': 1.0}],
+        })
+        self.assertEqual(app.streams.stats()['subscriptions'], 0)
+
+    @inlineCallbacks
+    def test_metrics_stream_query_error(self):
+        app = DummyMetricsApi(self.mk_config())
+        get = AppHelper(app).get
+        resp = yield get('/metrics/stream/', params={'interval': '1min'})
+        self.assertEqual((yield resp.json()), {
+            'status_code': 400,
+            'reason': 'No metrics given to stream',
+        })
+
     def test_get_metrics_model(self):
         app = DummyMetricsApi(self.mk_config())
         model = app.get_metrics_model('owner-1')
@@ -155,6 +241,101 @@ class TestMetricsApi(TestCase):
         resp = yield get('/metrics/', params={'foo': 'bar'})
         self.assertEqual((yield resp.json()), {'baz': 'quux'})
 
+    @inlineCallbacks
+    def test_metrics_get_series(self):
+        app = DummyMetricsApi(self.mk_config())
+        app.backend.fixtures.add(
+            foo='bar', result={'baz': Series([5695, 5700], [5.0, NULL])})
+        get = AppHelper(app).get
+        resp = yield get('/metrics/', params={'foo': 'bar'})
+        self.assertEqual((yield resp.json()), {
+            'baz': [
+                {'x': 5695000, 'y': 5.0},
+                {'x': 5700000, 'y': None},
+            ],
+        })
+
+    @inlineCallbacks
+    def test_metrics_get_compressed(self):
+        app = DummyMetricsApi(self.mk_config(compress_min_size=100))
+        result = {'baz': [{'x': x, 'y': 1.0} for x in range(100)]}
+        app.backend.fixtures.add(foo='bar', result=result)
+
+        # treq asks for gzipped responses, and decompresses them.
+        get = AppHelper(app).get
+        resp = yield get('/metrics/', params={'foo': 'bar'})
+        self.assertEqual(
+            resp.headers.getRawHeaders('vary'), ['Accept-Encoding'])
+        [etag] = resp.headers.getRawHeaders('etag')
+        self.assertTrue(etag.endswith('-gzip"'))
+        self.assertEqual((yield resp.json()), result)
+
+    @inlineCallbacks
+    def test_metrics_get_compressed_small(self):
+        app = DummyMetricsApi(self.mk_config(compress_min_size=100))
+        app.backend.fixtures.add(foo='bar', result={'baz': 'quux'})
+
+        get = AppHelper(app).get
+        resp = yield get('/metrics/', params={'foo': 'bar'})
+        [etag] = resp.headers.getRawHeaders('etag')
+        self.assertFalse(etag.endswith('-gzip"'))
+        self.assertEqual((yield resp.json()), {'baz': 'quux'})
+
+    @inlineCallbacks
+    def test_metrics_get_compression_disabled(self):
+        app = DummyMetricsApi(self.mk_config(
+            compress_responses=False, compress_min_size=0))
+        app.backend.fixtures.add(foo='bar', result={'baz': 'quux'})
+
+        get = AppHelper(app).get
+        resp = yield get('/metrics/', params={'foo': 'bar'})
+        [etag] = resp.headers.getRawHeaders('etag')
+        self.assertFalse(etag.endswith('-gzip"'))
+        self.assertEqual(resp.headers.getRawHeaders('vary'), None)
+        self.assertEqual((yield resp.json()), {'baz': 'quux'})
+
+    @inlineCallbacks
+    def test_metrics_get_etag(self):
+        app = DummyMetricsApi(self.mk_config(compress_min_size=0))
+        app.backend.fixtures.add(foo='bar', result={'baz': 'quux'})
+        get = AppHelper(app).get
+
+        resp = yield get('/metrics/', params={'foo': 'bar'})
+        [etag] = resp.headers.getRawHeaders('etag')
+        self.assertEqual(etag, '"%s-gzip"' % (
+            hashlib.sha1('{"baz":"quux"}').hexdigest(),))
+        yield resp.content()
+
+        resp = yield get(
+            '/metrics/', params={'foo': 'bar'},
+            headers={'If-None-Match': '"foo", %s' % (etag,)})
+        self.assertEqual(resp.code, 304)
+        self.assertEqual((yield resp.content()), '')
+
+        resp = yield get(
+            '/metrics/', params={'foo': 'bar'},
+            headers={'If-None-Match': '"foo"'})
+        self.assertEqual(resp.code, 200)
+        self.assertEqual((yield resp.json()), {'baz': 'quux'})
+
+    @inlineCallbacks
+    def test_metrics_get_serializer(self):
+        app = DummyMetricsApi(self.mk_config(serializer='json'))
+        app.backend.fixtures.add(
+            foo='bar', result={'baz': Series([5695], [5.0])})
+        get = AppHelper(app).get
+        resp = yield get('/metrics/', params={'foo': 'bar'})
+        # The standard library's json module separates items with spaces.
+        body = yield resp.content()
+        self.assertTrue(body.startswith('{"baz": [{'))
+        self.assertEqual(json.loads(body), {
+            'baz': [{'x': 5695000, 'y': 5.0}],
+        })
+
+    def test_serializer_unknown(self):
+        self.assertRaises(
+            ConfigError, DummyMetricsApi, self.mk_config(serializer='foo'))
+
     @inlineCallbacks
     def test_metrics_get_query_error(self):
         app = DummyMetricsApi(self.mk_config())
@@ -189,6 +370,61 @@ class TestMetricsApi(TestCase):
             'reason': ':(',
         })
 
+    @inlineCallbacks
+    def test_metrics_get_throttled(self):
+        app = DummyMetricsApi(self.mk_config())
+
+        def fail():
+            raise MetricsThrottledError(":(")
+
+        app.backend.fixtures.add(foo='bar', result=maybeDeferred(fail))
+
+        get = AppHelper(app).get
+        resp = yield get('/metrics/', params={'foo': 'bar'})
+
+        self.assertEqual(resp.code, 429)
+        self.assertEqual((yield resp.json()), {
+            'status_code': 429,
+            'reason': ':(',
+        })
+
+    @inlineCallbacks
+    def test_metrics_get_throttled_retry_after(self):
+        app = DummyMetricsApi(self.mk_config())
+
+        def fail():
+            raise MetricsThrottledError(":(", retry_after=2.5)
+
+        app.backend.fixtures.add(foo='bar', result=maybeDeferred(fail))
+
+        get = AppHelper(app).get
+        resp = yield get('/metrics/', params={'foo': 'bar'})
+
+        self.assertEqual(resp.code, 429)
+        self.assertEqual(resp.headers.getRawHeaders('retry-after'), ['3'])
+        self.assertEqual((yield resp.json()), {
+            'status_code': 429,
+            'reason': ':(',
+        })
+
+    @inlineCallbacks
+    def test_metrics_get_backend_busy(self):
+        app = DummyMetricsApi(self.mk_config())
+
+        def fail():
+            raise MetricsBackendBusyError(":(")
+
+        app.backend.fixtures.add(foo='bar', result=maybeDeferred(fail))
+
+        get = AppHelper(app).get
+        resp = yield get('/metrics/', params={'foo': 'bar'})
+
+        self.assertEqual(resp.code, 503)
+        self.assertEqual((yield resp.json()), {
+            'status_code': 503,
+            'reason': ':(',
+        })
+
     @inlineCallbacks
     def test_metrics_get_uncaught_error(self):
         app = DummyMetricsApi(self.mk_config())
@@ -278,3 +514,74 @@ class TestMetricsApi(TestCase):
 
         [f] = self.flushLoggedErrors(DummyError)
         self.assertEqual(str(f.value), ":(")
+
+    @inlineCallbacks
+    def test_metrics_batch(self):
+        app = DummyMetricsApi(self.mk_config())
+        app.backend.fixtures.add(
+            method='get_batch',
+            queries=[{'m': 'foo.last'}, {'m': 'bar.last', 'from': '-1d'}],
+            result=[
+                {'foo.last': Series([5695], [5.0])},
+                {'bar.last': Series([5700], [NULL])},
+            ])
+
+        post = AppHelper(app).post
+        resp = yield post('/metrics/batch/', data=json.dumps([
+            {'m': 'foo.last'},
+            {'m': 'bar.last', 'from': '-1d'},
+        ]))
+        self.assertEqual((yield resp.json()), [
+            {'foo.last': [{'x': 5695000, 'y': 5.0}]},
+            {'bar.last': [{'x': 5700000, 'y': None}]},
+        ])
+
+    @inlineCallbacks
+    def test_metrics_batch_query_error(self):
+        app = DummyMetricsApi(self.mk_config())
+
+        def fail():
+            raise BadMetricsQueryError(":(")
+
+        app.backend.fixtures.add(
+            method='get_batch', queries=[], result=maybeDeferred(fail))
+
+        post = AppHelper(app).post
+        resp = yield post('/metrics/batch/', data=json.dumps([]))
+
+        self.assertEqual((yield resp.json()), {
+            'status_code': 400,
+            'reason': ':(',
+        })
+
+    @inlineCallbacks
+    def test_metrics_bulk(self):
+        app = DummyMetricsApi(self.mk_config())
+        app.backend.fixtures.add(
+            method='fire_bulk',
+            records=[
+                (1, {'name': 'foo.sum', 'value': 1}, None),
+                (2, None, 'Invalid json'),
+            ],
+            result={'fired': 1, 'failed': 1, 'errors': [
+                {'line': 2, 'reason': 'Invalid json'},
+            ]})
+
+        post = AppHelper(app).post
+        resp = yield post(
+            '/metrics/bulk/', data='{"name": "foo.sum", "value": 1}\nfoo\n')
+        self.assertEqual((yield resp.json()), {
+            'fired': 1,
+            'failed': 1,
+            'errors': [{'line': 2, 'reason': 'Invalid json'}],
+        })
+
+    @inlineCallbacks
+    def test_metrics_bulk_query_error(self):
+        app = DummyMetricsApi(self.mk_config())
+        post = AppHelper(app).post
+        resp = yield post('/metrics/bulk/', data='[{"name": ')
+        self.assertEqual((yield resp.json()), {
+            'status_code': 400,
+            'reason': 'Invalid json array of records',
+        })